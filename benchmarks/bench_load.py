@@ -0,0 +1,357 @@
+# Load test of the gunicorn deployment: throughput, latency percentiles, worker RSS
+#
+#   python benchmarks/bench_load.py
+#   python benchmarks/bench_load.py --concurrency 1 4 8 16 --duration 30 --mix upload=3 url=1
+#   python benchmarks/bench_load.py --gunicorn-args "--worker-class gthread --threads 4"
+#   python benchmarks/bench_load.py --compare benchmarks/results/load-<earlier>.json
+#
+# Starts the app under gunicorn on a free local port (as in Procfile: --preload
+# with MARC_PRELOAD=1, unless --no-preload) and a local static HTTP server for
+# the URL-ingest requests, then runs each --concurrency level for --duration
+# seconds: that many client threads send POST /api/convert requests back to
+# back, each picked at random by the --mix weights:
+#   upload  multipart upload of --file
+#   url     {"url": ...} pointing at --file on the static server
+# While a level runs, GET /health is probed every --health-interval seconds,
+# as the load balancer would, and each worker's peak RSS (VmHWM, reset at the
+# start of the level where the kernel allows it) is read from /proc.
+# Reported per level: requests/sec, error rate, p50/p95/p99 latency (overall,
+# per request kind and for /health) and the largest worker peak RSS. The
+# output cache is off unless --cache, so every request is a real conversion.
+# Results are saved as JSON; --compare reports the change against an earlier
+# run and exits non-zero if any level's throughput dropped by more than
+# --threshold.
+import argparse
+import functools
+import http.server
+import json
+import math
+import os
+import random
+import shlex
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+from corpus import ROOT, resolve
+from bench_pipeline import RESULTS_DIR, metadata
+from bench_startup import BOOT_TIMEOUT, free_port, worker_pids
+
+KINDS = ("upload", "url")
+REQUEST_TIMEOUT = 120
+
+
+# --- Local servers --- #
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_static_server(directory):
+    # Serve directory on a free local port from a background thread.
+    handler = functools.partial(_QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_gunicorn(workers, preload, cache, extra_args):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, LOG_LEVEL="WARNING")
+    env.pop("DEBUG", None)
+    if not cache:
+        env["MARC_CACHE_MAX_BYTES"] = "0"
+    args = list(extra_args)
+    if preload:
+        env["MARC_PRELOAD"] = "1"
+        args.append("--preload")
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", *args, "-w", str(workers),
+                             "-b", f"127.0.0.1:{port}", "marc_converter.app:app"], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    started = time.perf_counter()
+    while True:
+        try:
+            if requests.get(f"{url}/health", timeout=5).status_code == 200:
+                break
+        except (requests.ConnectionError, requests.Timeout):
+            pass
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {proc.returncode}")
+        if time.perf_counter() - started > BOOT_TIMEOUT:
+            stop(proc)
+            raise RuntimeError("gunicorn did not answer in time")
+        time.sleep(0.05)
+    # Wait for all workers, so the first level is not measured against a
+    # half-started pool.
+    deadline = time.perf_counter() + 10
+    while len(worker_pids(proc.pid)) < workers and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    return proc, url
+
+
+def stop(proc):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+# --- Worker memory --- #
+def peak_rss_kb(pid):
+    # Peak resident set size of a process (VmHWM), in kB.
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def reset_peak_rss(pid):
+    # Writing 5 to clear_refs resets VmHWM to the current RSS (Linux 4.0+).
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+
+
+class MemorySampler:
+    # Largest peak RSS of each worker seen while running, including workers
+    # that are replaced during the level.
+    def __init__(self, master_pid, interval=0.5):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peaks = {}
+        self.stopped = threading.Event()
+        for pid in worker_pids(master_pid):
+            reset_peak_rss(pid)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        for pid in worker_pids(self.master_pid):
+            self.peaks[pid] = max(self.peaks.get(pid, 0), peak_rss_kb(pid))
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self._sample()
+        return self.peaks
+
+
+# --- Load generation --- #
+def parse_mix(items):
+    # ["upload=3", "url=1"] -> {"upload": 3.0, "url": 1.0}
+    mix = {}
+    for item in items:
+        kind, _, weight = item.partition("=")
+        if kind not in KINDS:
+            raise ValueError(f"unknown request kind in --mix: {kind} (expected one of {', '.join(KINDS)})")
+        mix[kind] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("--mix needs at least one positive weight")
+    return mix
+
+
+def send(session, kind, app_url, fmt, body, file_name, file_url):
+    if kind == "upload":
+        return session.post(f"{app_url}/api/convert?format={fmt}", files={"file": (file_name, body)},
+                            timeout=REQUEST_TIMEOUT)
+    return session.post(f"{app_url}/api/convert?format={fmt}", json={"url": file_url}, timeout=REQUEST_TIMEOUT)
+
+
+def client(deadline, mix, samples, seed, **request):
+    # One client thread: requests back to back until the deadline. Samples
+    # are (kind, seconds, ok, error) tuples.
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    with requests.Session() as session:
+        while time.perf_counter() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            started = time.perf_counter()
+            try:
+                status = send(session, kind, **request).status_code
+                ok, error = status == 200, None if status == 200 else f"HTTP {status}"
+            except requests.RequestException as e:
+                ok, error = False, type(e).__name__
+            samples.append((kind, time.perf_counter() - started, ok, error))
+
+
+def probe_health(app_url, interval, stopped, samples):
+    with requests.Session() as session:
+        while not stopped.wait(interval):
+            started = time.perf_counter()
+            try:
+                ok = session.get(f"{app_url}/health", timeout=REQUEST_TIMEOUT).status_code == 200
+            except requests.RequestException:
+                ok = False
+            samples.append(("health", time.perf_counter() - started, ok, None if ok else "health"))
+
+
+def percentiles(seconds):
+    # p50/p95/p99 in ms (nearest rank), or None without samples.
+    if not seconds:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    ordered = sorted(seconds)
+    pick = lambda q: ordered[max(0, math.ceil(q * len(ordered)) - 1)] * 1000
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+
+def run_level(proc, concurrency, duration, mix, health_interval, **request):
+    samples, health = [], []
+    sampler = MemorySampler(proc.pid)
+    stopped = threading.Event()
+    prober = threading.Thread(target=probe_health, args=(request["app_url"], health_interval, stopped, health),
+                              daemon=True)
+    prober.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(started + duration, mix, samples, seed), kwargs=request)
+               for seed in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stopped.set()
+    prober.join()
+    peaks = sampler.stop()
+
+    errors = [error for _, _, ok, error in samples if not ok]
+    return {
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "requests": len(samples),
+        "errors": len(errors),
+        "error_rate": len(errors) / len(samples) if samples else 0.0,
+        "error_kinds": {error: errors.count(error) for error in set(errors)},
+        "requests_per_sec": len(samples) / elapsed if elapsed else 0.0,
+        **percentiles([seconds for _, seconds, ok, _ in samples if ok]),
+        "by_kind": {kind: {"requests": sum(1 for k, *_ in samples if k == kind),
+                           **percentiles([seconds for k, seconds, ok, _ in samples if k == kind and ok])}
+                    for kind in mix if mix[kind]},
+        "health": {"probes": len(health), "failed": sum(1 for *_, ok, _ in health if not ok),
+                   **percentiles([seconds for _, seconds, ok, _ in health if ok])},
+        "workers_seen": len(peaks),
+        "worker_peak_rss_mb": max(peaks.values(), default=0) / 1024,
+        "worker_mean_peak_rss_mb": statistics.mean(peaks.values()) / 1024 if peaks else 0.0,
+    }
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as fh:
+        baseline = {r["concurrency"]: r for r in json.load(fh)["results"] if "error" not in r}
+    regressions = []
+    print(f"\nCompared with {baseline_path}:")
+    for r in results:
+        old = baseline.get(r["concurrency"])
+        if old is None or "error" in r or not old["requests_per_sec"]:
+            continue
+        change = r["requests_per_sec"] / old["requests_per_sec"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions.append(r)
+        p95 = (f"p95 {old['p95_ms']:.0f} -> {r['p95_ms']:.0f} ms"
+               if old.get("p95_ms") is not None and r.get("p95_ms") is not None else "")
+        print(f"  c={r['concurrency']:<5}{old['requests_per_sec']:>8.1f} -> {r['requests_per_sec']:>7.1f} req/s "
+              f"({change:+.1%})  {p95}{flag}")
+    return regressions
+
+
+def fmt_ms(value):
+    return f"{value:>9.0f}" if value is not None else f"{'-':>9}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the app under gunicorn.")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16],
+                        help="client threads per level (default: 1 4 8 16)")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per level (default: 20)")
+    parser.add_argument("--mix", nargs="+", default=["upload=1", "url=1"],
+                        help="request kinds and weights (default: upload=1 url=1)")
+    parser.add_argument("--file", default="sample",
+                        help="MARC file to send: sample, oapen, 10k, 100k, 1m or a path (default: sample)")
+    parser.add_argument("--format", default="json", help="output format requested (default: json)")
+    parser.add_argument("--health-interval", type=float, default=0.5,
+                        help="seconds between /health probes during a level (default: 0.5)")
+    parser.add_argument("--no-preload", action="store_true", help="start gunicorn without --preload")
+    parser.add_argument("--cache", action="store_true", help="keep the conversion cache on")
+    parser.add_argument("--gunicorn-args", default="",
+                        help='extra gunicorn arguments, e.g. "--worker-class gthread --threads 4"')
+    parser.add_argument("--output", help="results file (default: benchmarks/results/load-<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="throughput drop that counts as a regression (default: 0.10)")
+    args = parser.parse_args()
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    path = os.path.abspath(resolve(args.file))
+    with open(path, "rb") as fh:
+        body = fh.read()
+    static, static_url = start_static_server(os.path.dirname(path))
+    proc, app_url = start_gunicorn(args.workers, not args.no_preload, args.cache, shlex.split(args.gunicorn_args))
+    request = {"app_url": app_url, "fmt": args.format, "body": body, "file_name": os.path.basename(path),
+               "file_url": f"{static_url}/{os.path.basename(path)}"}
+    config = {"workers": args.workers, "duration": args.duration, "mix": mix, "file": args.file,
+              "file_bytes": len(body), "format": args.format, "preload": not args.no_preload,
+              "cache": args.cache, "gunicorn_args": args.gunicorn_args}
+    results = []
+    try:
+        # One unmeasured request of each kind, so no level pays for first use.
+        with requests.Session() as session:
+            for kind in mix:
+                send(session, kind, **request)
+        print(f"{path} ({len(body) / 1024:.0f} KB), {args.workers} workers, {args.duration:g}s per level, "
+              f"mix {' '.join(f'{k}={w:g}' for k, w in mix.items())}")
+        print(f"{'conc':>5}{'req/s':>9}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+              f"{'health p99':>12}{'peak RSS MB':>13}")
+        for concurrency in args.concurrency:
+            try:
+                result = run_level(proc, concurrency, args.duration, mix, args.health_interval, **request)
+            except Exception as e:
+                print(f"{concurrency:>5}  error: {e}")
+                results.append({"concurrency": concurrency, "error": repr(e)})
+                continue
+            print(f"{concurrency:>5}{result['requests_per_sec']:>9.1f}{result['error_rate']:>8.1%}"
+                  f"{fmt_ms(result['p50_ms'])}{fmt_ms(result['p95_ms'])}{fmt_ms(result['p99_ms'])}"
+                  f"{fmt_ms(result['health']['p99_ms'])}   {result['worker_peak_rss_mb']:>10.1f}")
+            results.append(result)
+    finally:
+        stop(proc)
+        static.shutdown()
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, "load-" + time.strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(output, "w") as fh:
+        json.dump({"meta": metadata(), "config": config, "results": results}, fh, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
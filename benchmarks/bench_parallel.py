@@ -0,0 +1,58 @@
+# Speedup benchmark for the parallel conversion engine
+#
+#   python benchmarks/bench_parallel.py --scale 20 --workers 1 2 4
+#
+# Builds a corpus of sample.mrc's records repeated --scale times, converts it
+# serially (MARCReader + marc_to_row, as the web paths do) and then with the
+# process pool at each worker count, and prints records/sec and speedup.
+import argparse
+import os
+import time
+
+from corpus import SAMPLE, build_corpus
+
+from pymarc import MARCReader
+from marc_converter.framing import iter_raw_records
+from marc_converter.logic import marc_to_row
+from marc_converter.parallel import iter_rows_parallel, open_buffer
+
+
+def run_serial(path):
+    with open(path, "rb") as fh:
+        return sum(1 for _ in (marc_to_row(rec) for rec in MARCReader(fh)))
+
+
+def run_parallel(path, workers, batch_size):
+    with open(path, "rb") as fh:
+        return sum(1 for _ in iter_rows_parallel(open_buffer(fh), workers, batch_size))
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    count = fn(*args)
+    return count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel conversion speedup benchmark.")
+    parser.add_argument("--source", default=SAMPLE)
+    parser.add_argument("--scale", type=int, default=20)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    with open(args.source, "rb") as fh:
+        source_records = sum(1 for _ in iter_raw_records([fh.read()]))
+    path = build_corpus(source_records * args.scale, args.source)
+    size_mb = os.path.getsize(path) / (1024 * 1024)
+    count, serial = timed(run_serial, path)
+    print(f"corpus: {count} records, {size_mb:.1f} MB ({os.cpu_count()} CPUs)")
+    print(f"{'mode':<12}{'seconds':>10}{'rec/s':>12}{'speedup':>10}")
+    print(f"{'serial':<12}{serial:>10.2f}{count / serial:>12.0f}{1.0:>10.2f}")
+    for workers in args.workers:
+        _, elapsed = timed(run_parallel, path, workers, args.batch_size)
+        print(f"{f'workers={workers}':<12}{elapsed:>10.2f}{count / elapsed:>12.0f}{serial / elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
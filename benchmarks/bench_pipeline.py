@@ -0,0 +1,273 @@
+# Conversion pipeline benchmark: per-stage records/sec and peak RSS
+#
+#   python benchmarks/bench_pipeline.py                      # sample, oapen, 10k
+#   python benchmarks/bench_pipeline.py --corpus 100k 1m --stages parse marc_to_row
+#   python benchmarks/bench_pipeline.py --compare benchmarks/results/<earlier>.json
+#
+# Each (corpus, stage) pair runs in a fresh child process, so the reported
+# peak RSS belongs to that stage alone. Serialization stages reuse up to
+# ROW_CACHE_LIMIT converted rows, cycled to the corpus size, so that a 1M
+# record run does not need every row in memory at once. Results are written
+# as JSON; --compare reports the change against an earlier run and exits
+# non-zero if any stage got slower than --threshold.
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from corpus import ROOT, resolve
+
+from pymarc import MARCReader
+from marc_converter.app import app
+from marc_converter.framing import iter_raw_records, parse_record
+from marc_converter.fastpath import extract_row
+from marc_converter.logic import marc_to_row, clean_unicode, serialize_rows, generate_output_file
+from marc_converter.mapping import KBART_PLAN, _field_value
+from marc_converter.normalize import cache_stats, clean_column
+
+READ_CHUNK = 1024 * 1024
+ROW_CACHE_LIMIT = 50_000
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+
+def read_raw(path):
+    with open(path, "rb") as fh:
+        yield from iter_raw_records(iter(lambda: fh.read(READ_CHUNK), b""))
+
+
+def cached_rows(path):
+    rows = []
+    for raw in read_raw(path):
+        rows.append(KBART_PLAN.values(parse_record(raw)))
+        if len(rows) >= ROW_CACHE_LIMIT:
+            break
+    return rows
+
+
+def cached_raw_values(path):
+    # Per record, the uncleaned subfield values that KBART_PLAN's clean_unicode
+    # columns read from the parsed record (every candidate field of each
+    # column), i.e. what clean_unicode gets inside marc_to_row.
+    columns = [column for column in KBART_PLAN.columns
+               if column.clean is clean_unicode and not callable(column.select)]
+    records = []
+    for raw in read_raw(path):
+        record = parse_record(raw)
+        values = []
+        for column in columns:
+            for tag in column.tags:
+                predicate = column.where.get(tag)
+                for field in record.get_fields(tag):
+                    if predicate is None or predicate(field):
+                        value = _field_value(field, column.subfields)
+                        if value:
+                            values.append(value)
+        records.append(values)
+        if len(records) >= ROW_CACHE_LIMIT:
+            break
+    return records
+
+
+def count_records(path):
+    return sum(1 for _ in read_raw(path))
+
+
+def repeat_rows(rows, count):
+    return itertools.islice(itertools.cycle(rows), count)
+
+
+# --- Stages: each returns (records, seconds spent in the stage[, extra results]) --- #
+def stage_parse(path):
+    start = time.perf_counter()
+    with open(path, "rb") as fh:
+        count = sum(1 for _ in MARCReader(fh))
+    return count, time.perf_counter() - start
+
+
+def stage_marc_to_row(path):
+    count = 0
+    elapsed = 0.0
+    for raw in read_raw(path):
+        record = parse_record(raw)
+        start = time.perf_counter()
+        marc_to_row(record)
+        elapsed += time.perf_counter() - start
+        count += 1
+    return count, elapsed, {"clean_cache": KBART_PLAN.clean_stats()}
+
+
+def stage_fastpath(path):
+    # Parse and convert together: the fast path never builds a pymarc Record.
+    count = 0
+    start = time.perf_counter()
+    for raw in read_raw(path):
+        extract_row(raw)
+        count += 1
+    return count, time.perf_counter() - start
+
+
+def stage_clean_unicode(path):
+    # Raw values, not cached_rows: those are already clean, and nearly all of
+    # them would take the ASCII shortcut instead of NFC and the translate table.
+    records = cached_raw_values(path)
+    count = count_records(path)
+    start = time.perf_counter()
+    for values in repeat_rows(records, count):
+        for value in values:
+            clean_unicode(value)
+    return count, time.perf_counter() - start, {"clean_cache": cache_stats({"clean_unicode": clean_unicode})}
+
+
+def stage_clean_column(path):
+    # The batched form: each column of ROW_CACHE_LIMIT rows at once.
+    rows = cached_rows(path)
+    count = count_records(path)
+    columns = list(zip(*rows))
+    start = time.perf_counter()
+    done = 0
+    while done < count:
+        n = min(len(rows), count - done)
+        for column in columns:
+            clean_column(column[:n])
+        done += n
+    return count, time.perf_counter() - start
+
+
+def _serialize(fmt):
+    def stage(path):
+        rows = cached_rows(path)
+        count = count_records(path)
+        with app.app_context():
+            start = time.perf_counter()
+            size = 0
+            for piece in serialize_rows(repeat_rows(rows, count), fmt):
+                size += len(piece)
+            return count, time.perf_counter() - start
+    return stage
+
+
+def _kbart(fmt):
+    def stage(path):
+        rows = cached_rows(path)
+        count = count_records(path)
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            generate_output_file(repeat_rows(rows, count), fmt, os.path.join(tmp, f"output.{fmt}"))
+            return count, time.perf_counter() - start
+    return stage
+
+
+STAGES = {
+    "parse": stage_parse,
+    "marc_to_row": stage_marc_to_row,
+    "fastpath": stage_fastpath,
+    "clean_unicode": stage_clean_unicode,
+    "clean_column": stage_clean_column,
+    "json": _serialize("json"),
+    "ndjson": _serialize("ndjson"),
+    "csv": _serialize("csv"),
+    "tsv": _serialize("tsv"),
+    "kbart": _kbart("tsv"),
+    "xlsx": _kbart("xlsx"),
+}
+
+
+def _child(stage, path, queue):
+    try:
+        count, elapsed, *extra = STAGES[stage](path)
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put({"records": count, "seconds": elapsed, "peak_rss_kb": peak_kb, **(extra[0] if extra else {})})
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def run_stage(stage, path):
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_child, args=(stage, path, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as fh:
+        baseline = {(r["corpus"], r["stage"]): r for r in json.load(fh)["results"] if "error" not in r}
+    regressions = []
+    print(f"\nCompared with {baseline_path}:")
+    for r in results:
+        old = baseline.get((r["corpus"], r["stage"]))
+        if old is None or "error" in r:
+            continue
+        change = r["records_per_sec"] / old["records_per_sec"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions.append(r)
+        print(f"  {r['corpus']:<12}{r['stage']:<15}{old['records_per_sec']:>12.0f} -> "
+              f"{r['records_per_sec']:>10.0f} rec/s ({change:+.1%}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MARC conversion pipeline.")
+    parser.add_argument("--corpus", nargs="+", default=["sample", "oapen", "10k"],
+                        help="sample, oapen, 10k, 100k, 1m or a path to a .mrc file")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES))
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown that counts as a regression (default: 0.10)")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'corpus':<12}{'stage':<15}{'records':>10}{'seconds':>10}{'rec/s':>12}{'peak RSS MB':>13}")
+    for name in args.corpus:
+        path = resolve(name)
+        for stage in args.stages:
+            result = {"corpus": name, "stage": stage, **run_stage(stage, path)}
+            if "error" in result:
+                print(f"{name:<12}{stage:<15}  error: {result['error']}")
+            else:
+                result["records_per_sec"] = result["records"] / result["seconds"] if result["seconds"] else 0.0
+                print(f"{name:<12}{stage:<15}{result['records']:>10}{result['seconds']:>10.3f}"
+                      f"{result['records_per_sec']:>12.0f}{result['peak_rss_kb'] / 1024:>13.1f}")
+            results.append(result)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(output, "w") as fh:
+        json.dump({"meta": metadata(), "results": results}, fh, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
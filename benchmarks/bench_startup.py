@@ -0,0 +1,150 @@
+# Cold-start benchmark: gunicorn spawn to first response, with and without preload
+#
+#   python benchmarks/bench_startup.py
+#   python benchmarks/bench_startup.py --workers 4 --runs 5 --modes lazy preload
+#
+# For each mode a fresh gunicorn is started on a free local port and timed:
+#   first_health_ms   spawn until GET /health first answers 200
+#   first_convert_ms  the first POST /api/convert (sample.mrc) after that
+#   first_xlsx_ms     the first xlsx conversion, which needs openpyxl
+# plus each worker's RSS and PSS from /proc (PSS counts pages shared with the
+# master and the other workers only in part, so it shows what copy-on-write
+# sharing saves). "lazy" is the plain `gunicorn -w N`; "preload" is
+# MARC_PRELOAD=1 with gunicorn --preload. The output cache is off, so every
+# conversion is real. Medians over --runs are printed and saved as JSON.
+import argparse
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+from corpus import ROOT, SAMPLE
+from bench_pipeline import RESULTS_DIR, metadata
+
+MODES = {
+    "lazy": ([], {}),
+    "preload": (["--preload"], {"MARC_PRELOAD": "1"}),
+}
+BOOT_TIMEOUT = 60
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def worker_pids(master_pid):
+    try:
+        with open(f"/proc/{master_pid}/task/{master_pid}/children") as fh:
+            return [int(pid) for pid in fh.read().split()]
+    except OSError:
+        return []
+
+
+def memory_kb(pid):
+    # (rss, pss) in kB from smaps_rollup.
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as fh:
+            for line in fh:
+                key, _, rest = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    values[key] = int(rest.split()[0])
+    except OSError:
+        pass
+    return values.get("Rss", 0), values.get("Pss", 0)
+
+
+def convert(url, fmt):
+    with open(SAMPLE, "rb") as fh:
+        started = time.perf_counter()
+        r = requests.post(f"{url}/api/convert?format={fmt}", files={"file": ("sample.mrc", fh)}, timeout=120)
+        elapsed = time.perf_counter() - started
+    r.raise_for_status()
+    return elapsed * 1000
+
+
+def run_once(mode, workers):
+    args, env = MODES[mode]
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, MARC_CACHE_MAX_BYTES="0", LOG_LEVEL="WARNING", **env)
+    env.pop("DEBUG", None)
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", *args, "-w", str(workers), "-b", f"127.0.0.1:{port}",
+                             "marc_converter.app:app"], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                if requests.get(f"{url}/health", timeout=5).status_code == 200:
+                    break
+            except (requests.ConnectionError, requests.Timeout):
+                pass
+            if proc.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with status {proc.returncode}")
+            if time.perf_counter() - started > BOOT_TIMEOUT:
+                raise RuntimeError("gunicorn did not answer in time")
+            time.sleep(0.005)
+        result = {"first_health_ms": (time.perf_counter() - started) * 1000}
+        result["first_convert_ms"] = convert(url, "json")
+        result["first_xlsx_ms"] = convert(url, "xlsx")
+        # Let the remaining workers finish booting before measuring them.
+        deadline = time.perf_counter() + 10
+        while len(worker_pids(proc.pid)) < workers and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.5)
+        memory = [memory_kb(pid) for pid in worker_pids(proc.pid)]
+        result["worker_rss_mb"] = statistics.mean(rss for rss, _ in memory) / 1024 if memory else 0.0
+        result["worker_pss_mb"] = statistics.mean(pss for _, pss in memory) / 1024 if memory else 0.0
+        return result
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure gunicorn cold start to first response.")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--output", help="results file (default: benchmarks/results/startup-<timestamp>.json)")
+    args = parser.parse_args()
+
+    keys = ("first_health_ms", "first_convert_ms", "first_xlsx_ms", "worker_rss_mb", "worker_pss_mb")
+    results = []
+    print(f"{'mode':<10}" + "".join(f"{key:>18}" for key in keys))
+    for mode in args.modes:
+        try:
+            runs = [run_once(mode, args.workers) for _ in range(args.runs)]
+        except Exception as e:
+            print(f"{mode:<10}  error: {e}")
+            results.append({"mode": mode, "error": repr(e)})
+            continue
+        result = {"mode": mode, "workers": args.workers, "runs": args.runs,
+                  **{key: statistics.median(run[key] for run in runs) for key in keys}}
+        print(f"{mode:<10}" + "".join(f"{result[key]:>18.1f}" for key in keys))
+        results.append(result)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, "startup-" + time.strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(output, "w") as fh:
+        json.dump({"meta": metadata(), "results": results}, fh, indent=2)
+    print(f"\nResults saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# Benchmark corpora: the sample files plus synthetic files of N records
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from marc_converter.framing import iter_raw_records
+
+CORPUS_DIR = os.path.join(ROOT, "benchmarks", ".corpus")
+SAMPLE = os.path.join(ROOT, "sample.mrc")
+OAPEN_SAMPLE = os.path.join(ROOT, "OAPENSample.mrc")
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+
+def build_corpus(n_records, source=SAMPLE, path=None):
+    # Write n_records by cycling through the records of source. Files are
+    # cached under benchmarks/.corpus so repeated runs reuse them.
+    if path is None:
+        os.makedirs(CORPUS_DIR, exist_ok=True)
+        name = os.path.splitext(os.path.basename(source))[0]
+        path = os.path.join(CORPUS_DIR, f"{name}-{n_records}.mrc")
+        if os.path.exists(path):
+            return path
+    with open(source, "rb") as fh:
+        records = list(iter_raw_records([fh.read()]))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as out:
+        for idx in range(n_records):
+            out.write(records[idx % len(records)])
+    os.replace(tmp_path, path)
+    return path
+
+
+def resolve(name):
+    # Corpus names: "sample", "oapen", a size key such as "100k", or a path.
+    if name == "sample":
+        return SAMPLE
+    if name == "oapen":
+        return OAPEN_SAMPLE
+    if name.lower() in SIZES:
+        return build_corpus(SIZES[name.lower()])
+    return name
@@ -6,7 +6,11 @@ import os
 import logging
 from flask import request, jsonify
 from marc_converter.app import app, logger
-from marc_converter.logic import process_marc_file_upload, process_marc_url_api
+from marc_converter.logic import (process_marc_file_upload, process_marc_url_api,
+                                  process_marc_upload_paginated, process_upload_page,
+                                  cached_response, DEFAULT_PAGE_SIZE)
+from marc_converter.uploads import UploadNotFound, remove_upload
+from marc_converter import jobs, batch, metrics, store
 
 def check_token():
     required_token = os.environ.get('API_TOKEN')
@@ -19,7 +23,13 @@ def check_token():
             return False
     return True
 
+def page_args():
+    # offset/limit from the query string; raises ValueError if not integers.
+    return (int(request.args.get('offset', 0)),
+            int(request.args.get('limit', DEFAULT_PAGE_SIZE)))
+
 @app.route('/api/convert', methods=['POST'])
+@metrics.profiled
 def api_convert():
     logger.info(f"/api/convert called. Method: {request.method}, Content-Type: {request.content_type}")
     try:
@@ -27,6 +37,7 @@ def api_convert():
             logger.warning("Unauthorized API access attempt.")
             return jsonify({'error': 'Unauthorized'}), 401
         fmt = request.args.get('format', 'json').lower()
+        stream = request.args.get('stream', '').lower() in ('1', 'true', 'yes')
         # Accept file upload
         logger.info(f"Request.files keys: {list(request.files.keys())}")
         if 'file' in request.files:
@@ -35,8 +46,18 @@ def api_convert():
             if not file or not getattr(file, 'filename', None):
                 logger.error("File object is None or missing filename.")
                 return jsonify({'error': 'No file uploaded or filename missing'}), 400
+            # offset/limit (or paginate=1) keeps the upload under a handle
+            # and returns one page of rows; see GET /api/convert/<handle>.
+            if any(k in request.args for k in ('offset', 'limit', 'paginate')):
+                if fmt != 'json':
+                    return jsonify({'error': 'Paginated results are always json'}), 400
+                try:
+                    offset, limit = page_args()
+                except ValueError:
+                    return jsonify({'error': 'offset and limit must be integers'}), 400
+                return process_marc_upload_paginated(file, offset, limit)
             try:
-                return process_marc_file_upload(file, fmt)
+                return process_marc_file_upload(file, fmt, stream=stream)
             except Exception as e:
                 logger.exception(f"Error in process_marc_file_upload: {e}")
                 return jsonify({'error': f'File upload failed: {str(e)}'}), 500
@@ -46,7 +67,7 @@ def api_convert():
             marc_url = data.get('url')
             logger.info(f"URL ingestion request: {marc_url}")
             if marc_url:
-                return process_marc_url_api(marc_url, fmt)
+                return process_marc_url_api(marc_url, fmt, stream=stream)
             else:
                 logger.error("No url provided in JSON body.")
                 return jsonify({'error': 'No url provided'}), 400
@@ -64,3 +85,208 @@ def api_convert():
                 'traceback': tb_str
             }), 500
         return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/convert/<handle>', methods=['GET', 'DELETE'])
+@metrics.profiled
+def api_convert_page(handle):
+    if not check_token():
+        logger.warning("Unauthorized API access attempt.")
+        return jsonify({'error': 'Unauthorized'}), 401
+    if request.method == 'DELETE':
+        try:
+            if remove_upload(handle):
+                return '', 204
+        except UploadNotFound:
+            pass
+        return jsonify({'error': 'Unknown or expired upload handle'}), 404
+    if request.args.get('format', 'json').lower() != 'json':
+        return jsonify({'error': 'Paginated results are always json'}), 400
+    try:
+        offset, limit = page_args()
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    logger.info(f"Page request: handle={handle}, offset={offset}, limit={limit}")
+    return process_upload_page(handle, offset, limit)
+
+@app.route('/api/batch', methods=['POST'])
+@metrics.profiled
+def api_batch():
+    # {"urls": [...]}: fetch all feeds concurrently and return one merged
+    # output with a source column and per-feed timings and errors.
+    if not check_token():
+        logger.warning("Unauthorized API access attempt.")
+        return jsonify({'error': 'Unauthorized'}), 401
+    fmt = request.args.get('format', 'json').lower()
+    urls = (request.get_json(silent=True) or {}).get('urls') if request.is_json else None
+    if not isinstance(urls, list) or not urls:
+        return jsonify({'error': 'No urls provided'}), 400
+    if len(urls) > batch.MAX_BATCH_URLS:
+        return jsonify({'error': f'At most {batch.MAX_BATCH_URLS} urls per batch'}), 400
+    if not all(isinstance(url, str) and url.startswith('http') for url in urls):
+        return jsonify({'error': 'Invalid URL format'}), 400
+    dedup = request.args.get('dedup', '').lower() or None
+    if dedup not in (None, 'flag', 'drop'):
+        return jsonify({'error': 'dedup must be flag or drop'}), 400
+    logger.info(f"Batch ingestion request: {len(urls)} urls, format={fmt}, dedup={dedup}")
+    try:
+        return batch.batch_response(urls, fmt, dedup)
+    except Exception as e:
+        logger.exception(f"Error in /api/batch: {e}")
+        return jsonify({'error': f'Batch conversion failed: {str(e)}'}), 500
+
+@app.route('/api/collections/<name>', methods=['POST'])
+def api_load_collection(name):
+    # Convert a file upload or {"url": ...} into a new snapshot of the
+    # collection in the inventory store.
+    if not check_token():
+        logger.warning("Unauthorized API access attempt.")
+        return jsonify({'error': 'Unauthorized'}), 401
+    from marc_converter.logic import DOWNLOAD_CHUNK_SIZE, fetch_marc
+    try:
+        if 'file' in request.files:
+            file = request.files['file']
+            if not file or not getattr(file, 'filename', None):
+                return jsonify({'error': 'No file uploaded or filename missing'}), 400
+            chunks = iter(lambda: file.stream.read(DOWNLOAD_CHUNK_SIZE), b'')
+            snapshot = store.load_marc(name, chunks, file.filename)
+        elif request.is_json and (request.get_json() or {}).get('url'):
+            marc_url = request.get_json()['url']
+            if not marc_url.startswith('http'):
+                return jsonify({'error': 'Invalid URL format'}), 400
+            with fetch_marc(marc_url) as response:
+                snapshot = store.load_marc(name, response.iter_content(DOWNLOAD_CHUNK_SIZE), marc_url)
+        else:
+            return jsonify({'error': 'No file or url provided'}), 400
+    except Exception as e:
+        logger.exception(f"Error loading collection {name}: {e}")
+        return jsonify({'error': f'Loading collection failed: {str(e)}'}), 400
+    return jsonify(snapshot), 201
+
+@app.route('/api/collections', methods=['GET'])
+def api_collections():
+    if not check_token():
+        logger.warning("Unauthorized API access attempt.")
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(store.collections())
+
+@app.route('/api/records', methods=['GET'])
+def api_records():
+    # Indexed lookup in the latest snapshot of each stored collection, e.g.
+    # ?isbn=9780472902842 or ?publisher=...&offset=0&limit=100.
+    if not check_token():
+        logger.warning("Unauthorized API access attempt.")
+        return jsonify({'error': 'Unauthorized'}), 401
+    filters = {name: request.args.get(name, '').strip()
+               for name in ('isbn', 'doi', 'title_id', 'source_id', 'publisher')}
+    if not any(filters.values()):
+        return jsonify({'error': 'Provide isbn, doi, title_id, source_id or publisher'}), 400
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', store.DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    try:
+        return jsonify(store.find_records(filters, request.args.get('collection') or None, offset, limit))
+    except store.CollectionNotFound:
+        return jsonify({'error': 'Unknown collection'}), 404
+
+@app.route('/api/collections/<name>/kbart', methods=['GET'])
+def api_collection_kbart(name):
+    # The collection's latest snapshot as KBART, streamed from the store.
+    if not check_token():
+        logger.warning("Unauthorized API access attempt.")
+        return jsonify({'error': 'Unauthorized'}), 401
+    from itertools import chain
+    from flask import Response, stream_with_context
+    from marc_converter.logic import MIMETYPES, serialize_kbart
+    fmt = request.args.get('format', 'tsv').lower()
+    if fmt not in ('tsv', 'csv'):
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    rows = store.iter_snapshot_rows(name)
+    try:
+        first = next(rows, None)
+    except store.CollectionNotFound:
+        return jsonify({'error': 'Unknown collection'}), 404
+    body = serialize_kbart(chain([first] if first is not None else [], rows), fmt)
+    return Response(stream_with_context(body), mimetype=MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={name}_kbart.{fmt}'})
+
+def job_links(job_id):
+    return {'status_url': f'/api/jobs/{job_id}', 'output_url': f'/api/jobs/{job_id}/output'}
+
+@app.route('/api/jobs', methods=['POST'])
+def api_create_job():
+    # Same inputs as /api/convert, but the conversion runs in the background
+    # and the response is the job id to poll.
+    if not check_token():
+        logger.warning("Unauthorized API access attempt.")
+        return jsonify({'error': 'Unauthorized'}), 401
+    fmt = request.args.get('format', 'json').lower()
+    if fmt not in jobs.JOB_FORMATS:
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    if 'file' in request.files:
+        file = request.files['file']
+        if not file or not getattr(file, 'filename', None):
+            return jsonify({'error': 'No file uploaded or filename missing'}), 400
+        state = jobs.create_job(fmt, fileobj=file.stream)
+    elif request.is_json and (request.get_json() or {}).get('url'):
+        marc_url = request.get_json()['url']
+        if not marc_url.startswith('http'):
+            return jsonify({'error': 'Invalid URL format'}), 400
+        state = jobs.create_job(fmt, url=marc_url)
+    else:
+        return jsonify({'error': 'No file or url provided'}), 400
+    logger.info(f"Job {state['id']} queued: format={fmt}, source={state['source']}")
+    return jsonify({**jobs.public_state(state), **job_links(state['id'])}), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET', 'DELETE'])
+def api_job(job_id):
+    if not check_token():
+        logger.warning("Unauthorized API access attempt.")
+        return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        if request.method == 'DELETE':
+            if jobs.remove_job(job_id):
+                return '', 204
+            raise jobs.JobNotFound(job_id)
+        state = jobs.get_job(job_id)
+    except jobs.JobNotFound:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    return jsonify({**jobs.public_state(state), **job_links(job_id)})
+
+@app.route('/api/jobs/<job_id>/resume', methods=['POST'])
+def api_resume_job(job_id):
+    # Requeue a failed job; checkpointed jobs continue from their last checkpoint.
+    if not check_token():
+        logger.warning("Unauthorized API access attempt.")
+        return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        state = jobs.resume_job(job_id)
+    except jobs.JobNotFound:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    if state is None:
+        return jsonify({'error': 'Only failed jobs can be resumed'}), 409
+    logger.info(f"Job {job_id} resumed")
+    return jsonify({**jobs.public_state(state), **job_links(job_id)}), 202
+
+@app.route('/api/jobs/<job_id>/output', methods=['GET'])
+def api_job_output(job_id):
+    if not check_token():
+        logger.warning("Unauthorized API access attempt.")
+        return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        state = jobs.get_job(job_id)
+    except jobs.JobNotFound:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    if state['state'] != 'done':
+        return jsonify({'error': f"Job is {state['state']}", **jobs.public_state(state)}), 409
+    return cached_response(jobs.output_path(job_id, state['format']), state['format'])
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Prometheus metrics, summed over all gunicorn workers. They show
+    # traffic and error types, so they need the API token like the API does.
+    if not check_token():
+        logger.warning("Unauthorized metrics access attempt.")
+        return jsonify({'error': 'Unauthorized'}), 401
+    return metrics.metrics_response()
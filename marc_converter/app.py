@@ -22,6 +22,14 @@ if os.environ.get('DEBUG'):
 else:
 	app.config['DEBUG'] = False
 
+# Per-request conversion metrics, served at /metrics
+from marc_converter import metrics
+metrics.init_app(app)
+# gzip responses for clients that accept it; registered after metrics so it
+# runs first and the metrics count the compressed bytes
+from marc_converter import compression
+compression.init_app(app)
+
 # Import routes to register them with the app
 import marc_converter.views
 import marc_converter.api
@@ -33,9 +41,37 @@ def health():
 	return 'OK', 200
 
 
+# Preload mode, for gunicorn --preload: the master imports the app once,
+# including the modules workers would otherwise import on their first
+# request (requests, openpyxl, the process-pool and checkpoint code), and
+# freezes the result so forked workers share it copy-on-write instead of
+# each paying for it. The compiled regexes and mapping tables (KBART_PLAN,
+# source ID rules, dedup patterns) are built at import, so they are shared
+# too. Nothing here opens sockets or starts threads or processes.
+PRELOAD = os.environ.get('MARC_PRELOAD', '').lower() in ('1', 'true', 'yes')
+
+
+def preload():
+	import gc
+	import mimetypes
+	import encodings.idna
+	import requests.adapters
+	import openpyxl.writer.excel
+	from marc_converter import checkpoint, parallel, store
+	mimetypes.init()
+	# Move everything loaded so far out of the garbage collector's reach, so
+	# collections in the workers do not write to (and copy) the shared pages.
+	gc.collect()
+	gc.freeze()
+	logger.info(f'Preloaded shared state: {gc.get_freeze_count()} objects frozen')
+
+
 def log_startup_info():
 	logger.info('Starting marc_converter app')
 	logger.info(f"DEBUG={os.environ.get('DEBUG')}, FLASK_ENV={os.environ.get('FLASK_ENV')}, LOG_LEVEL={os.environ.get('LOG_LEVEL')}")
 
 
 log_startup_info()
+
+if PRELOAD:
+	preload()
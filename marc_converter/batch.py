@@ -0,0 +1,315 @@
+# Concurrent conversion of several MARC feeds into one output
+#
+# Each URL is fetched on a bounded thread pool through the shared keep-alive
+# session (logic.http_session()) and converted while it downloads, so a batch
+# takes about as long as its slowest feed rather than the sum of all of them.
+# The rows of all feeds are merged in the order the URLs were given, with a
+# trailing `source` column holding the feed URL. Every feed gets a report
+# entry with its record count, skipped bad records, timing and error; a feed
+# that fails contributes no rows and does not fail the others.
+#
+# All FETCH_WORKERS fetches run all the time, whatever order the feeds finish
+# in. A feed's rows are pickled in batches to a temp file as they are
+# converted (kept in memory only up to MARC_BATCH_SPOOL_MEMORY_BYTES per feed)
+# and read back when it is the feed's turn to be written, so a slow feed early
+# in the list neither stalls the others nor makes finished feeds pile up in
+# memory. The merged output is written to a temp file and then sent, so that the
+# response headers can carry the per-feed reports. X-Marc-Sources is capped at
+# MARC_BATCH_SOURCES_HEADER_BYTES; past that it only lists the failed feeds
+# that fit, X-Marc-Sources-Omitted counts the reports left out, and every
+# report is still in the body of a format=json answer.
+#
+#   python -m marc_converter.batch URL [URL ...] [-f urls.txt] -o kbart.tsv
+import os
+import sys
+import time
+import pickle
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from marc_converter.logic import fetch_marc, RecordErrors, RecordStream, DOWNLOAD_CHUNK_SIZE
+from marc_converter.mapping import KBART_PLAN
+from marc_converter.rows import RowSchema
+
+logger = logging.getLogger('marc_converter')
+
+# Feeds fetched at once; the HTTP session keeps up to 16 connections per host.
+FETCH_WORKERS = int(os.environ.get('MARC_BATCH_FETCH_WORKERS', '8'))
+MAX_BATCH_URLS = int(os.environ.get('MARC_BATCH_MAX_URLS', '100'))
+# Proxies commonly reject responses with more than 4-8 KB of headers.
+SOURCES_HEADER_MAX_BYTES = int(os.environ.get('MARC_BATCH_SOURCES_HEADER_BYTES', '4096'))
+# Spooled rows of a feed kept in memory before they go to disk.
+SPOOL_MEMORY_BYTES = int(os.environ.get('MARC_BATCH_SPOOL_MEMORY_BYTES', str(1024 * 1024)))
+SPOOL_BATCH_ROWS = 1000
+
+SOURCE_SCHEMA = RowSchema(KBART_PLAN.fields, KBART_PLAN.interned).extend(('source',), interned=('source',))
+
+
+class SpooledRows:
+    # Row tuples pickled to a temp file SPOOL_BATCH_ROWS at a time. Iterating
+    # reads them back once, in order, and then closes the file.
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+        self.batch = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, row):
+        self.batch.append(row)
+        self.count += 1
+        if len(self.batch) == SPOOL_BATCH_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if self.batch:
+            pickle.dump(self.batch, self.file, pickle.HIGHEST_PROTOCOL)
+            self.batch = []
+
+    def __iter__(self):
+        self._flush()
+        self.file.seek(0)
+        try:
+            while True:
+                try:
+                    batch = pickle.load(self.file)
+                except EOFError:
+                    return
+                yield from batch
+        finally:
+            self.close()
+
+    def close(self):
+        self.file.close()
+
+
+def fetch_feed(url):
+    # Returns (rows, report) for one feed. Rows are tuples in SOURCE_SCHEMA
+    # order, spooled to a SpooledRows.
+    started = time.perf_counter()
+    report = {'url': url, 'records': 0, 'skipped': 0, 'bytes': 0, 'seconds': 0.0, 'error': None}
+    source = sys.intern(url)
+    rows = SpooledRows()
+    try:
+        response = fetch_marc(url)
+        try:
+            chunks = response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+            errors = RecordErrors()
+            for row in RecordStream(_counted(chunks, report), errors):
+                rows.append(row + (source,))
+        finally:
+            response.close()
+        report['records'] = len(rows)
+        report['skipped'] = errors.count
+    except Exception as e:
+        logger.warning(f"Batch feed {url} failed: {e}")
+        report['error'] = str(e) or e.__class__.__name__
+        rows.close()
+        rows = []
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return rows, report
+
+
+def _counted(chunks, report):
+    for chunk in chunks:
+        report['bytes'] += len(chunk)
+        yield chunk
+
+
+def iter_feeds(urls, workers=None):
+    # (rows, report) for each URL, in URL order, with up to `workers` feeds
+    # fetched at once.
+    workers = max(1, min(workers or FETCH_WORKERS, len(urls) or 1))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='marc-batch') as pool:
+        yield from pool.map(fetch_feed, urls)
+
+
+def merged_rows(feeds, reports):
+    # The rows of (rows, report) pairs one feed after another; each report is
+    # appended to `reports` when its feed is reached.
+    for rows, report in feeds:
+        reports.append(report)
+        yield from rows
+
+
+def dedup_merged(rows, mode):
+    # Flag or drop titles that appear in several feeds (see dedup.py).
+    # Returns (rows, schema, Deduplicator); the rows are checked as they are
+    # consumed, after which the Deduplicator has the stats and must be
+    # closed. Without a mode the rows are unchanged and there is none.
+    if not mode:
+        return rows, SOURCE_SCHEMA, None
+    from marc_converter.dedup import dedup_rows
+    return dedup_rows(rows, SOURCE_SCHEMA, mode)
+
+
+def batch_summary(reports, seconds):
+    return {'feeds': len(reports),
+            'failed': sum(1 for r in reports if r['error']),
+            'records': sum(r['records'] for r in reports),
+            'seconds': round(seconds, 3),
+            'slowest_feed_seconds': max((r['seconds'] for r in reports), default=0.0)}
+
+
+def sources_headers(reports, dumps):
+    # X-Marc-Sources with the per-feed reports, or, if they do not fit in
+    # SOURCES_HEADER_MAX_BYTES, the failed feeds' reports that do, plus the
+    # number of reports left out in X-Marc-Sources-Omitted.
+    sources = dumps(reports)
+    if len(sources) <= SOURCES_HEADER_MAX_BYTES:
+        return {'X-Marc-Sources': sources}
+    kept, size = [], 2
+    for report in reports:
+        if report['error']:
+            size += len(dumps(report)) + 1
+            if size > SOURCES_HEADER_MAX_BYTES:
+                break
+            kept.append(report)
+    return {'X-Marc-Sources': dumps(kept), 'X-Marc-Sources-Omitted': str(len(reports) - len(kept))}
+
+
+def write_merged(rows, fmt, schema, trailer=None):
+    # Serialize the merged rows to a per-request temp file; returns its path.
+    # json is an object whose "records" array is followed by the members
+    # returned by trailer(), which is called once all rows are written.
+    from marc_converter.logic import output_file_path, remove_output_file, serialize_rows, write_xlsx
+    if fmt == 'xlsx':
+        return write_xlsx(rows, schema=schema)
+    path = output_file_path(fmt)
+    try:
+        with open(path, 'w', encoding='utf-8', newline='') as out:
+            if fmt == 'json':
+                out.write('{"records":')
+            for piece in serialize_rows(rows, fmt, schema):
+                out.write(piece.rstrip('\n') if fmt == 'json' else piece)
+            if fmt == 'json':
+                out.write(trailer() + '}\n')
+    except BaseException:
+        remove_output_file(path)
+        raise
+    return path
+
+
+def batch_response(urls, fmt='json', dedup=None):
+    # /api/batch: json answers {"records": [...], "sources": [...], "summary": {...}};
+    # other formats are the merged file, with the batch summary in
+    # X-Marc-Batch-Summary and the per-feed reports in X-Marc-Sources (see
+    # sources_headers). 502 if no feed could be converted. dedup is None,
+    # 'flag' or 'drop'.
+    from flask import current_app, jsonify, send_file
+    from marc_converter import metrics
+    from marc_converter.logic import MIMETYPES, remove_output_file
+    if fmt not in MIMETYPES:
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    dumps = current_app.json.dumps
+    started = time.perf_counter()
+    reports, summary = [], {}
+    rows, schema, deduplicator = dedup_merged(merged_rows(iter_feeds(urls), reports), dedup)
+
+    def summarize():
+        if not summary:
+            summary.update(batch_summary(reports, time.perf_counter() - started))
+            if deduplicator is not None:
+                summary['dedup'] = deduplicator.stats()
+        return summary
+
+    try:
+        path = write_merged(metrics.timed('map', rows, 'records'), fmt, schema,
+                            lambda: ',"sources":' + dumps(reports) + ',"summary":' + dumps(summarize()))
+        summarize()
+    finally:
+        if deduplicator is not None:
+            deduplicator.close()
+    logger.info(f"Batch of {summary['feeds']} feeds: {summary['records']} records, "
+                f"{summary['failed']} failed, {summary['seconds']}s")
+    if reports and all(r['error'] for r in reports):
+        remove_output_file(path)
+        return jsonify({'error': 'No feed could be converted', 'sources': reports, 'summary': summary}), 502
+    # The open file is the response body, so the name can go at once.
+    attachment = fmt in ('csv', 'tsv', 'xlsx')
+    try:
+        response = send_file(open(path, 'rb'), mimetype=MIMETYPES[fmt], as_attachment=attachment,
+                             download_name=f'output.{fmt}' if attachment else None)
+    finally:
+        remove_output_file(path)
+    if fmt != 'json':
+        response.headers['X-Marc-Batch-Summary'] = dumps(summary)
+        response.headers.update(sources_headers(reports, dumps))
+    if 'dedup' in summary:
+        response.headers['X-Marc-Dedup'] = dumps(summary['dedup'])
+    return response
+
+
+def process_marc_urls(urls, fmt):
+    # Form view with several URLs: one merged KBART file.
+    from marc_converter.logic import generate_output_file, remove_output_file, send_output_file
+    if not all(url.startswith('http') for url in urls):
+        return "<h3>Invalid URL format. Please provide a valid URL for the MARC file.</h3>"
+    reports = []
+    try:
+        path = generate_output_file(merged_rows(iter_feeds(urls), reports), fmt, schema=SOURCE_SCHEMA)
+    except Exception as e:
+        return f"<h3>Error generating output file: {e}</h3>"
+    failed = [r for r in reports if r['error']]
+    if len(failed) == len(reports):
+        remove_output_file(path)
+        return "<h3>Error fetching MARC files: " + "; ".join(f"{r['url']}: {r['error']}" for r in failed) + "</h3>"
+    return send_output_file(path, fmt)
+
+
+def parse_url_list(text):
+    # URLs separated by whitespace or newlines; lines starting with '#' are skipped.
+    return [url for line in text.splitlines() if not line.lstrip().startswith('#')
+            for url in line.split()]
+
+
+# CLI: merge several MARC feeds into one file
+if __name__ == "__main__":
+    import json
+    import argparse
+    from marc_converter.app import app
+    from marc_converter.logic import generate_output_file, serialize_rows
+    parser = argparse.ArgumentParser(prog="python -m marc_converter.batch",
+                                     description="Fetch several MARC feeds concurrently and merge them into one output.")
+    parser.add_argument("urls", nargs="*", metavar="URL")
+    parser.add_argument("-f", "--url-file", help="file with one URL per line")
+    parser.add_argument("-o", "--output", required=True, help="file to write")
+    parser.add_argument("--format", choices=["json", "ndjson", "csv", "tsv", "xlsx", "kbart"],
+                        help="output format (default: from the output file extension; kbart = KBART tsv)")
+    parser.add_argument("--workers", type=int, default=FETCH_WORKERS, help="feeds fetched at once")
+    parser.add_argument("--dedup", choices=["flag", "drop"],
+                        help="flag (duplicate_of/duplicate_key columns) or drop titles already seen by ISBN/DOI/source ID")
+    args = parser.parse_args()
+    urls = list(args.urls)
+    if args.url_file:
+        with open(args.url_file, encoding="utf-8") as fh:
+            urls.extend(parse_url_list(fh.read()))
+    if not urls:
+        parser.error("no URLs given")
+    fmt = args.format or os.path.splitext(args.output)[1].lstrip(".").lower() or "tsv"
+    started = time.perf_counter()
+    reports, dedup_stats = [], None
+    rows, schema, deduplicator = dedup_merged(merged_rows(iter_feeds(urls, args.workers), reports), args.dedup)
+    try:
+        if fmt in ("kbart", "tsv", "csv", "xlsx"):
+            generate_output_file(rows, "tsv" if fmt == "kbart" else fmt, args.output, schema)
+        else:
+            with app.app_context(), open(args.output, "w", encoding="utf-8", newline="") as out:
+                for piece in serialize_rows(rows, fmt, schema):
+                    out.write(piece)
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        if deduplicator is not None:
+            dedup_stats = deduplicator.stats()
+            deduplicator.close()
+    for report in reports:
+        status = f"error: {report['error']}" if report['error'] else f"{report['records']} records"
+        print(f"{report['seconds']:8.3f}s  {report['url']}  {status}", file=sys.stderr)
+    summary = batch_summary(reports, time.perf_counter() - started)
+    if dedup_stats:
+        summary["dedup"] = dedup_stats
+    print(json.dumps(summary), file=sys.stderr)
+    sys.exit(1 if all(r['error'] for r in reports) else 0)
@@ -0,0 +1,202 @@
+# Disk-backed conversion cache keyed by input content hash and output kind
+#
+# Converted outputs are stored as <cache dir>/outputs/<sha256 of MARC input>.<kind>
+# (kind is an API format such as "json", or "kbart.tsv" for the form view).
+# For URL ingestion, the ETag/Last-Modified headers and the content hash of
+# the last download are kept per URL, so refetches can be conditional and a
+# 304 is served straight from the cache.
+#
+# All writes go through a temp file and os.replace, and eviction (least
+# recently used first, by mtime, which is refreshed on every hit) runs under
+# an flock, so the cache can be shared by all gunicorn workers.
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+
+CACHE_DIR = os.environ.get('MARC_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'marc_converter', 'cache'))
+CACHE_MAX_BYTES = int(os.environ.get('MARC_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+CACHE_ENABLED = CACHE_MAX_BYTES > 0
+
+# Bump when the mapping or serializers change output, to invalidate old entries.
+CACHE_VERSION = '2'
+
+OUTPUTS_DIR = os.path.join(CACHE_DIR, 'outputs')
+URLS_DIR = os.path.join(CACHE_DIR, 'urls')
+LOCK_PATH = os.path.join(CACHE_DIR, '.lock')
+
+
+def output_path(content_hash, kind):
+    return os.path.join(OUTPUTS_DIR, f'{content_hash}.v{CACHE_VERSION}.{kind}')
+
+
+def lookup(content_hash, kind):
+    # Path of a cached output, or None. A hit refreshes the entry's LRU position.
+    if not CACHE_ENABLED or not content_hash:
+        return None
+    path = output_path(content_hash, kind)
+    try:
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+def file_digest(fileobj, chunk_size=1024 * 1024):
+    # sha256 of a seekable file object, leaving its position at the start.
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+class HashedChunks:
+    # Wraps an iterable of byte chunks (e.g. a streamed download) and hashes
+    # them as they pass through.
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._digest = hashlib.sha256()
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self._digest.update(chunk)
+            yield chunk
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+class CacheWriter:
+    # Collects an output as it is produced and publishes it under its content
+    # hash on commit(); discard() drops a partial output. `key` is the content
+    # hash, or a callable returning it once the input has been read, and
+    # on_commit(content_hash) runs after publishing.
+    def __init__(self, kind, key=None, mode='w', on_commit=None):
+        os.makedirs(OUTPUTS_DIR, exist_ok=True)
+        self.kind = kind
+        self.key = key
+        self.on_commit = on_commit
+        fd, self.tmp_path = tempfile.mkstemp(dir=OUTPUTS_DIR, suffix='.tmp')
+        if 'b' in mode:
+            self._fh = os.fdopen(fd, mode)
+        else:
+            self._fh = os.fdopen(fd, mode, encoding='utf-8', newline='')
+
+    def write(self, data):
+        self._fh.write(data)
+
+    def commit(self, content_hash=None):
+        self._fh.close()
+        if content_hash is None:
+            content_hash = self.key() if callable(self.key) else self.key
+        path = output_path(content_hash, self.kind)
+        os.replace(self.tmp_path, path)
+        if self.on_commit is not None:
+            self.on_commit(content_hash)
+        evict()
+        return path
+
+    def discard(self):
+        self._fh.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def store_file(content_hash, kind, src_path):
+    # Copy an already written output file into the cache.
+    if not CACHE_ENABLED:
+        return None
+    writer = CacheWriter(kind, content_hash, mode='wb')
+    try:
+        with open(src_path, 'rb') as src:
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                writer.write(chunk)
+    except Exception:
+        writer.discard()
+        raise
+    return writer.commit(content_hash)
+
+
+# --- Per-URL validators for conditional fetching --- #
+def _url_meta_path(url):
+    return os.path.join(URLS_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+
+def url_meta(url):
+    try:
+        with open(_url_meta_path(url)) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def save_url_meta(url, headers, content_hash):
+    if not CACHE_ENABLED:
+        return
+    os.makedirs(URLS_DIR, exist_ok=True)
+    meta = {
+        'url': url,
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'content_hash': content_hash,
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=URLS_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(meta, fh)
+    os.replace(tmp_path, _url_meta_path(url))
+
+
+def conditional_headers(url, kind):
+    # Request headers for a conditional GET, only sent when the output for the
+    # last seen content is still cached. Returns (headers, meta).
+    meta = url_meta(url) if CACHE_ENABLED else None
+    if not meta or not os.path.exists(output_path(meta.get('content_hash') or '', kind)):
+        return {}, None
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers, meta
+
+
+# --- Size limit --- #
+def evict(max_bytes=None):
+    # Remove least recently used outputs until the cache fits max_bytes. If
+    # another process is already evicting, leave it to that process.
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(LOCK_PATH, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        try:
+            entries = []
+            total = 0
+            with os.scandir(OUTPUTS_DIR) as it:
+                for entry in it:
+                    if entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,166 @@
+# Checkpointed, resumable conversion of a MARC file to an output file
+#
+# Every MARC_CHECKPOINT_INTERVAL seconds the output written so far is flushed
+# to disk and a checkpoint file records the byte offset in the MARC file just
+# past the last converted record, the matching output size, and the counts so
+# far. If the run is interrupted, the next run with the same input, output
+# and format truncates the output to the checkpointed size, seeks the input to
+# the checkpointed offset and carries on from there. Bad records are skipped
+# (see logic.RecordStream). The checkpoint is removed once the output is
+# complete. MARCXML and MARC-in-JSON input is converted without checkpoints.
+#
+#   python -m marc_converter.checkpoint huge.mrc huge.ndjson
+import os
+import io
+import csv
+import json
+import time
+import logging
+from flask import current_app
+from marc_converter.fastpath import FASTPATH_ENABLED
+from marc_converter.logic import DOWNLOAD_CHUNK_SIZE, RecordErrors, RecordStream, json_batch_encoder
+from marc_converter.rows import iter_batches
+
+logger = logging.getLogger('marc_converter')
+
+CHECKPOINT_SUFFIX = '.checkpoint'
+CHECKPOINT_INTERVAL = float(os.environ.get('MARC_CHECKPOINT_INTERVAL', '30'))
+CHECKPOINT_VERSION = 1
+# Formats whose output can be cut at a record boundary and appended to.
+RESUMABLE_FORMATS = ('json', 'ndjson', 'csv', 'tsv')
+
+
+def source_identity(marc_path, fmt, fast):
+    # What a checkpoint must match to be resumed: the same input file,
+    # unchanged, converted the same way.
+    st = os.stat(marc_path)
+    return {'version': CHECKPOINT_VERSION, 'input': os.path.abspath(marc_path), 'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns, 'format': fmt, 'fast': bool(fast)}
+
+
+def load_checkpoint(checkpoint_path, identity, output_path):
+    try:
+        with open(checkpoint_path) as fh:
+            state = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if any(state.get(key) != value for key, value in identity.items()):
+        logger.info(f"Ignoring checkpoint {checkpoint_path}: input or format changed")
+        return None
+    try:
+        if os.path.getsize(output_path) < state['output_offset']:
+            return None
+    except OSError:
+        return None
+    return state
+
+
+def save_checkpoint(checkpoint_path, state):
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(state, fh)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def _batch_writer(fmt):
+    # (prefix, encode(batch, out_offset), suffix) for appending batches to an
+    # output that may already hold earlier batches.
+    if fmt in ('json', 'ndjson'):
+        encode = json_batch_encoder(current_app.json)
+        if fmt == 'ndjson':
+            return b'', lambda batch, at: ('\n'.join(encode(batch)) + '\n').encode('utf-8'), b''
+        # Every batch after the first (at > 1, past the '[') starts with a comma.
+        return b'[', lambda batch, at: ((',' if at > 1 else '') + ','.join(encode(batch))).encode('utf-8'), b']\n'
+    delimiter = '\t' if fmt == 'tsv' else ','
+
+    def encode_delimited(batch, at):
+        text = io.StringIO()
+        writer = csv.writer(text, delimiter=delimiter)
+        if at == 0:
+            writer.writerow(batch.fields)
+        writer.writerows(batch.rows())
+        return text.getvalue().encode('utf-8')
+    return b'', encode_delimited, b''
+
+
+def convert_file(marc_path, output_path, fmt, checkpoint_path=None, interval=None, fast=None,
+                 resume=True, progress=None):
+    # Convert marc_path to output_path (json, ndjson, csv or tsv; API row
+    # formats), resuming from a checkpoint if there is a matching one. Must
+    # run in an app context (JSON settings). progress(records, input_offset),
+    # if given, is called after every batch. Returns a summary dict.
+    if fmt not in RESUMABLE_FORMATS:
+        raise ValueError(f'Unsupported format for checkpointed conversion: {fmt}')
+    checkpoint_path = checkpoint_path or output_path + CHECKPOINT_SUFFIX
+    interval = CHECKPOINT_INTERVAL if interval is None else interval
+    fast = FASTPATH_ENABLED if fast is None else fast
+    identity = source_identity(marc_path, fmt, fast)
+    state = load_checkpoint(checkpoint_path, identity, output_path) if resume else None
+    resumed_from = state['input_offset'] if state else None
+    records = state['records'] if state else 0
+    skipped = state['skipped'] if state else 0
+    errors = RecordErrors()
+    prefix, encode, suffix = _batch_writer(fmt)
+    with open(marc_path, 'rb') as src, open(output_path, 'r+b' if state else 'wb') as out:
+        if state:
+            logger.info(f"Resuming {marc_path} at byte {state['input_offset']} ({records} records done)")
+            out.truncate(state['output_offset'])
+            out.seek(state['output_offset'])
+            src.seek(state['input_offset'])
+        else:
+            out.write(prefix)
+        stream = RecordStream(iter(lambda: src.read(DOWNLOAD_CHUNK_SIZE), b''), errors, fast=fast,
+                              offset=src.tell())
+        last_checkpoint = time.monotonic()
+        for batch in iter_batches(stream):
+            out.write(encode(batch, out.tell()))
+            records += len(batch)
+            if progress is not None:
+                # Compressed input is reported by how much of the file is read.
+                progress(records, stream.position if not stream.compressed else src.tell())
+            now = time.monotonic()
+            # Compressed input, MARCXML and MARC-in-JSON cannot be picked up mid-file.
+            if now - last_checkpoint >= interval and stream.resumable:
+                # The output must be on disk before the checkpoint points past it.
+                out.flush()
+                os.fsync(out.fileno())
+                save_checkpoint(checkpoint_path, dict(identity, input_offset=stream.position,
+                                                      output_offset=out.tell(), records=records,
+                                                      skipped=skipped + errors.count))
+                last_checkpoint = now
+        out.write(suffix)
+    try:
+        os.remove(checkpoint_path)
+    except OSError:
+        pass
+    return {'records': records, 'skipped': skipped + errors.count, 'resumed_from': resumed_from,
+            'errors': errors.samples}
+
+
+# CLI: convert a large MARC file, picking up where an interrupted run stopped
+if __name__ == "__main__":
+    import sys
+    import argparse
+    from marc_converter.app import app
+    parser = argparse.ArgumentParser(prog="python -m marc_converter.checkpoint",
+                                     description="Convert a MARC file with checkpoints; rerun to resume.")
+    parser.add_argument("marc_path", metavar="file.mrc")
+    parser.add_argument("output", help="file to write (.json, .ndjson, .csv or .tsv)")
+    parser.add_argument("--format", choices=RESUMABLE_FORMATS, help="default: from the output file extension")
+    parser.add_argument("--interval", type=float, default=CHECKPOINT_INTERVAL,
+                        help=f"seconds between checkpoints (default: {CHECKPOINT_INTERVAL:g})")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--fast", action="store_true", help="use the fast-path extractor")
+    args = parser.parse_args()
+    fmt = args.format or os.path.splitext(args.output)[1].lstrip(".").lower()
+    if fmt not in RESUMABLE_FORMATS:
+        parser.error(f"cannot tell the format from {args.output}; use --format")
+    try:
+        with app.app_context():
+            summary = convert_file(args.marc_path, args.output, fmt, interval=args.interval,
+                                   fast=True if args.fast else None, resume=not args.restart)
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    resumed = f", resumed at byte {summary['resumed_from']}" if summary['resumed_from'] is not None else ""
+    print(f"{summary['records']} records, {summary['skipped']} skipped{resumed}", file=sys.stderr)
@@ -0,0 +1,231 @@
+# Compressed input and gzip-compressed responses
+#
+# Input: gzip (.gz, including multi-member files) and zip archives are
+# recognized by their magic bytes (readers.sniff_format) and decompressed
+# chunk by chunk as the reader asks for data, so a compressed upload or
+# download is never expanded to a temp file or held in memory. Zip archives
+# are read front to back from their local file headers, without the central
+# directory at the end, which a download does not have until it is complete;
+# the members are read in order (directories and __MACOSX/ entries skipped).
+#
+# Output: when the client sends Accept-Encoding: gzip, text responses (JSON,
+# NDJSON, CSV, TSV, HTML) are gzip-compressed by an after_request hook.
+# Streamed responses are compressed chunk by chunk as they are produced, with
+# a sync flush after each chunk so the client can decode every chunk as it
+# arrives. xlsx files are already zip-compressed and are sent as they are.
+import os
+import zlib
+import struct
+
+GZIP_ENABLED = os.environ.get('MARC_GZIP', '1').lower() not in ('0', 'false', 'no')
+GZIP_LEVEL = int(os.environ.get('MARC_GZIP_LEVEL', '6'))
+# Buffered bodies smaller than this are not worth compressing.
+GZIP_MIN_BYTES = 1024
+COMPRESSIBLE_MIMETYPES = ('text/', 'application/json', 'application/x-ndjson')
+
+COMPRESSED_FORMATS = ('gzip', 'zip')
+# Decompressed bytes per chunk handed to the reader, whatever the ratio.
+OUTPUT_CHUNK_SIZE = 256 * 1024
+
+_ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_ZIP_LOCAL_SIGNATURE = b'PK\x03\x04'
+_ZIP_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+
+
+class CompressedInputError(ValueError):
+    pass
+
+
+def _inflate(decompressor, data):
+    # Decompress data, OUTPUT_CHUNK_SIZE bytes at a time; stops at the end
+    # of the compressed stream, leaving what follows in unused_data.
+    while True:
+        out = decompressor.decompress(data, OUTPUT_CHUNK_SIZE)
+        if out:
+            yield out
+        data = decompressor.unconsumed_tail
+        if decompressor.eof or (not data and len(out) < OUTPUT_CHUNK_SIZE):
+            return
+
+
+def gunzip_chunks(chunks):
+    # Decompressed chunks of a gzip stream; concatenated members (as written
+    # by `cat a.gz b.gz` or pigz) are read one after another.
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    in_member = False
+    for chunk in chunks:
+        while chunk:
+            in_member = True
+            yield from _inflate(decompressor, chunk)
+            if not decompressor.eof:
+                break
+            in_member = False
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            # Zero padding after the last member is allowed.
+            if not chunk.strip(b'\0'):
+                break
+    if in_member:
+        raise CompressedInputError('Truncated gzip input')
+
+
+class _Buffer:
+    # Bytes from chunks, read front to back for the zip parser.
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.data = b''
+
+    def fill(self, size):
+        # At least `size` bytes buffered, or False at the end of the input.
+        while len(self.data) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return False
+            self.data += chunk
+        return True
+
+    def take(self, size):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+
+def unzip_chunks(chunks):
+    # Decompressed chunks of the members of a zip archive, in order.
+    source = _Buffer(chunks)
+    while source.fill(4) and source.data[:4] == _ZIP_LOCAL_SIGNATURE:
+        if not source.fill(_ZIP_LOCAL_HEADER.size):
+            raise CompressedInputError('Truncated zip input')
+        (_, _, flags, method, _, _, _, compressed_size, _,
+         name_len, extra_len) = _ZIP_LOCAL_HEADER.unpack(source.take(_ZIP_LOCAL_HEADER.size))
+        if not source.fill(name_len + extra_len):
+            raise CompressedInputError('Truncated zip input')
+        name = source.take(name_len).decode('utf-8', 'replace')
+        extra = source.take(extra_len)
+        if flags & 0x1:
+            raise CompressedInputError(f'Encrypted zip member: {name}')
+        skip = name.endswith('/') or name.startswith('__MACOSX/')
+        if method == 8:
+            members = _inflate_member(source, skip)
+        elif method == 0 and not flags & 0x8:
+            members = _stored_member(source, compressed_size, skip)
+        else:
+            raise CompressedInputError(f'Unsupported zip compression method {method} for {name}')
+        yield from members
+        if flags & 0x8:
+            _skip_descriptor(source, zip64=_has_zip64_extra(extra))
+
+
+def _inflate_member(source, skip):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    while not decompressor.eof:
+        if not source.fill(1):
+            raise CompressedInputError('Truncated zip input')
+        data = source.take(len(source.data))
+        for out in _inflate(decompressor, data):
+            if not skip:
+                yield out
+        if decompressor.eof:
+            source.data = decompressor.unused_data + source.data
+
+
+def _stored_member(source, size, skip):
+    while size:
+        if not source.fill(1):
+            raise CompressedInputError('Truncated zip input')
+        data = source.take(min(size, len(source.data)))
+        size -= len(data)
+        if not skip:
+            yield data
+
+
+def _has_zip64_extra(extra):
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, size = struct.unpack_from('<HH', extra, pos)
+        if header_id == 0x0001:
+            return True
+        pos += 4 + size
+    return False
+
+
+def _skip_descriptor(source, zip64):
+    # crc-32 and the two sizes (8 bytes each for zip64), optionally signed.
+    source.fill(4)
+    size = 20 if zip64 else 12
+    if source.data[:4] == _ZIP_DESCRIPTOR_SIGNATURE:
+        size += 4
+    source.fill(size)
+    source.take(size)
+
+
+DECOMPRESSORS = {'gzip': gunzip_chunks, 'zip': unzip_chunks}
+
+
+def decompress_chunks(chunks, kind):
+    # Decompressed chunks of gzip or zip input; corrupt input raises
+    # CompressedInputError where it is found.
+    try:
+        yield from DECOMPRESSORS[kind](chunks)
+    except zlib.error as e:
+        raise CompressedInputError(f'Corrupt {kind} input: {e}') from e
+
+
+# --- Responses --- #
+def _accepts_gzip(request):
+    return request.accept_encodings['gzip'] > 0
+
+
+def _compressible(response):
+    mimetype = response.mimetype or ''
+    return (response.status_code == 200 and 'Content-Encoding' not in response.headers
+            and 'Content-Range' not in response.headers and mimetype.startswith(COMPRESSIBLE_MIMETYPES))
+
+
+def gzip_chunks(chunks, level=None):
+    # gzip stream of byte chunks, one compressed piece per input chunk.
+    compressor = zlib.compressobj(GZIP_LEVEL if level is None else level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        if chunk:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def gzip_response(response, request):
+    # Compress a response for a client that accepts gzip; other responses
+    # are returned as they are.
+    response.vary.add('Accept-Encoding')
+    if not _compressible(response) or not _accepts_gzip(request):
+        return response
+    if response.is_streamed:
+        # Streamed bodies and send_file responses; their length is unknown
+        # once compressed, so they are sent chunked.
+        body = response.response
+        response.response = gzip_chunks(response.iter_encoded())
+        response.direct_passthrough = False
+        if hasattr(body, 'close'):
+            # The open file or generator is no longer the response body.
+            response.call_on_close(body.close)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < GZIP_MIN_BYTES:
+            return response
+        response.set_data(b''.join(gzip_chunks([body])))
+    response.headers['Content-Encoding'] = 'gzip'
+    # The compressed body is a different representation of the same
+    # content: the ETag stays, as a weak one.
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    if not GZIP_ENABLED:
+        return
+
+    from flask import request
+
+    @app.after_request
+    def compress_response(response):
+        return gzip_response(response, request)
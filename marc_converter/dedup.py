@@ -0,0 +1,198 @@
+# Cross-collection deduplication of converted rows by ISBN, DOI and source ID
+#
+# Each row's identifiers are normalized into match keys: every valid ISBN in
+# online_identifier as an ISBN-13 ("isbn:9780472902842", ISBN-10s converted),
+# every DOI as a lowercase bare DOI ("doi:10.3998/mpub.123"), and any other
+# typed source_id ("File Handle:20.500.12657/1"). Rows are checked against a
+# key index in one streaming pass: the first row with a key is kept, and a
+# later row sharing any key with it is a duplicate. Keys of a duplicate are
+# added to the index too, so ISBN-only and DOI-only copies of the same title
+# are linked through a row that has both.
+#
+# The index is a dict until it holds MARC_DEDUP_MEMORY_KEYS keys; past that
+# it moves to an SQLite file in the temp directory, so memory stays bounded
+# for collections with millions of rows. Lookups are O(1) in memory and one
+# primary-key probe on disk, so a pass is O(n) either way.
+import os
+import re
+import sqlite3
+import tempfile
+from marc_converter.mapping import DOI_PATTERN
+from marc_converter.rows import RowSchema
+
+MEMORY_KEYS = int(os.environ.get('MARC_DEDUP_MEMORY_KEYS', '2000000'))
+DEDUP_MODES = ('flag', 'drop')
+DEDUP_FIELDS = ('duplicate_of', 'duplicate_key')
+
+_doi_search = re.compile(DOI_PATTERN, re.IGNORECASE)
+_isbn_candidates = re.compile(r'[0-9][0-9-]{8,15}[0-9Xx]')
+
+
+def _isbn10_valid(digits):
+    total = sum((10 - idx) * (10 if ch in 'Xx' else int(ch)) for idx, ch in enumerate(digits))
+    return total % 11 == 0
+
+
+def _isbn13_check(digits12):
+    return str((10 - sum((3 if idx % 2 else 1) * int(ch) for idx, ch in enumerate(digits12)) % 10) % 10)
+
+
+def normalize_isbn(text):
+    # The ISBN-13 for an ISBN-10 or ISBN-13 (hyphens allowed), or
+    # None if text is not a valid ISBN.
+    digits = text.replace('-', '')
+    if len(digits) == 10 and digits[:9].isdigit() and (digits[9].isdigit() or digits[9] in 'Xx'):
+        if not _isbn10_valid(digits):
+            return None
+        return '978' + digits[:9] + _isbn13_check('978' + digits[:9])
+    if len(digits) == 13 and digits.isdigit() and digits[:3] in ('978', '979'):
+        return digits if _isbn13_check(digits[:12]) == digits[12] else None
+    return None
+
+
+def isbns(text):
+    # All valid ISBNs in an online_identifier value such as
+    # "9780472902842 (ebook); 0-472-90284-9", as ISBN-13s.
+    found = []
+    for candidate in _isbn_candidates.findall(text or ''):
+        isbn = normalize_isbn(candidate)
+        if isbn and isbn not in found:
+            found.append(isbn)
+    return found
+
+
+def normalize_doi(text):
+    # The lowercase bare DOI in text (e.g. a https://doi.org/ URL), or None.
+    match = _doi_search.search(text or '')
+    return match.group(0).lower().rstrip('.') if match else None
+
+
+def row_keys(online_identifier, source_id, source_id_type):
+    # Match keys of a row, in the order duplicates are reported by. (An ISBN
+    # source_id is the first online_identifier, so it needs no key of its own.)
+    keys = []
+    for text in (source_id if source_id_type == 'DOI' else '', online_identifier):
+        doi = normalize_doi(text)
+        if doi and 'doi:' + doi not in keys:
+            keys.append('doi:' + doi)
+    keys.extend('isbn:' + isbn for isbn in isbns(online_identifier))
+    if source_id and source_id_type not in ('DOI', 'ISBN', 'Unknown', ''):
+        keys.append(f'{source_id_type}:{source_id}')
+    return keys
+
+
+class KeyIndex:
+    # key -> id of the first row seen with it; a dict that moves to SQLite
+    # once it holds max_memory_keys keys.
+    def __init__(self, max_memory_keys=None, directory=None):
+        self.max_memory_keys = MEMORY_KEYS if max_memory_keys is None else max_memory_keys
+        self.directory = directory
+        self.memory = {}
+        self.db = None
+        self.path = None
+
+    def __len__(self):
+        if self.db is None:
+            return len(self.memory)
+        return self.db.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+
+    @property
+    def on_disk(self):
+        return self.db is not None
+
+    def get(self, key):
+        if self.db is None:
+            return self.memory.get(key)
+        found = self.db.execute('SELECT row FROM keys WHERE key = ?', (key,)).fetchone()
+        return found[0] if found else None
+
+    def add(self, keys, row_id):
+        # Point keys not yet in the index at row_id.
+        if self.db is None:
+            for key in keys:
+                self.memory.setdefault(key, row_id)
+            if len(self.memory) >= self.max_memory_keys:
+                self._spill()
+        else:
+            self.db.executemany('INSERT OR IGNORE INTO keys (key, row) VALUES (?, ?)',
+                                ((key, row_id) for key in keys))
+
+    def _spill(self):
+        fd, self.path = tempfile.mkstemp(prefix='marc_dedup_', suffix='.sqlite', dir=self.directory)
+        os.close(fd)
+        self.db = sqlite3.connect(self.path)
+        # A scratch index: durability does not matter, speed does.
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE keys (key TEXT PRIMARY KEY, row TEXT) WITHOUT ROWID')
+        self.db.executemany('INSERT INTO keys (key, row) VALUES (?, ?)', self.memory.items())
+        self.memory = {}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class Deduplicator:
+    # Streaming dedup stage. mode='flag' keeps every row and appends
+    # duplicate_of (title_id of the first row with a shared key, '' for
+    # first occurrences) and duplicate_key (the key that matched);
+    # mode='drop' keeps only first occurrences, unchanged.
+    def __init__(self, schema, mode='flag', index=None):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f'Unknown dedup mode: {mode}')
+        self.mode = mode
+        self.index = index if index is not None else KeyIndex()
+        self.title_idx = schema.fields.index('title_id')
+        self.key_columns = [schema.fields.index(name) if name in schema.fields else None
+                            for name in ('online_identifier', 'source_id', 'source_id_type')]
+        self.rows = 0
+        self.duplicates = 0
+
+    def output_schema(self, schema):
+        if self.mode == 'drop':
+            return schema
+        return RowSchema(schema.fields, schema.interned).extend(DEDUP_FIELDS)
+
+    def __call__(self, rows):
+        index, title_idx, flag = self.index, self.title_idx, self.mode == 'flag'
+        key_columns = self.key_columns
+        for row in rows:
+            self.rows += 1
+            keys = row_keys(*(row[idx] if idx is not None else '' for idx in key_columns))
+            match = None
+            for key in keys:
+                first = index.get(key)
+                if first is not None:
+                    match = (first, key)
+                    break
+            if match is None:
+                index.add(keys, row[title_idx])
+                if flag:
+                    yield row + ('', '')
+                else:
+                    yield row
+                continue
+            self.duplicates += 1
+            index.add(keys, match[0])
+            if flag:
+                yield row + match
+
+    def stats(self):
+        return {'rows': self.rows, 'duplicates': self.duplicates, 'keys': len(self.index),
+                'index': 'sqlite' if self.index.on_disk else 'memory'}
+
+    def close(self):
+        self.index.close()
+
+
+def dedup_rows(rows, schema, mode='flag', index=None):
+    # (rows, output schema, Deduplicator) for a row iterator; close the
+    # Deduplicator once the rows have been consumed.
+    dedup = Deduplicator(schema, mode, index)
+    return dedup(rows), dedup.output_schema(schema), dedup
@@ -0,0 +1,220 @@
+# Incremental KBART conversion keyed on the MARC 001 (title_id)
+#
+# A state file next to the KBART output (<output>.state) holds, per record,
+# the 001 value, a hash of the raw record bytes and where the record's line
+# is in the KBART file written by the last run. On the next run only records
+# that are new or whose bytes changed are converted; unchanged lines are
+# copied from the previous KBART file. The run writes the merged full KBART
+# file and, optionally, a change set of added, changed and removed rows.
+#
+#   python -m marc_converter.delta collection.mrc kbart.tsv --delta changes.tsv
+import os
+import json
+import mmap
+import hashlib
+from contextlib import nullcontext
+from marc_converter.framing import iter_record_frames, parse_record
+from marc_converter.fastpath import FASTPATH_ENABLED, FastRecord, extract_values
+from marc_converter.logic import KBART_HEADERS, kbart_line, record_errors
+from marc_converter.mapping import KBART_PLAN
+
+STATE_SUFFIX = '.state'
+# Bump when KBART lines are formatted differently, so that old lines are not
+# copied into new files.
+STATE_VERSION = 2
+READ_CHUNK = 1024 * 1024
+
+
+def record_key(raw):
+    # The record's 001, read from the directory without converting the record.
+    # Tabs and newlines are replaced so the key fits on one state line.
+    try:
+        field = FastRecord(raw, force_utf8=True, utf8_handling='replace', tags=('001',)).get('001')
+    except Exception:
+        field = None
+    value = field.value() if field is not None else ''
+    return value.strip().replace('\t', ' ').replace('\n', ' ')
+
+
+def record_digest(raw):
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def load_state(state_path):
+    # Returns (header, {key: (digest, offset, length)}), or (None, {}) if there
+    # is no usable state file. The header is None for a state file of another
+    # version: its hashes still give the change set, but no lines are reused.
+    try:
+        with open(state_path, encoding='utf-8') as fh:
+            header = json.loads(fh.readline())
+            if header.get('version') != STATE_VERSION:
+                header = None
+            entries = {}
+            for line in fh:
+                key, digest, offset, length = line.rstrip('\n').split('\t')
+                entries[key] = (digest, int(offset), int(length))
+    except (OSError, ValueError):
+        return None, {}
+    return header, entries
+
+
+def save_state(state_path, output_path, entries):
+    st = os.stat(output_path)
+    header = {'version': STATE_VERSION, 'output': os.path.abspath(output_path),
+              'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        fh.write(json.dumps(header) + '\n')
+        for key, digest, offset, length in entries:
+            fh.write(f'{key}\t{digest}\t{offset}\t{length}\n')
+    os.replace(tmp_path, state_path)
+
+
+def _map_previous_output(header):
+    # The KBART file the state refers to, if it is still the file that run
+    # wrote; otherwise unchanged records are converted again.
+    if header is None:
+        return None
+    try:
+        with open(header['output'], 'rb') as fh:
+            st = os.fstat(fh.fileno())
+            if st.st_size != header['size'] or st.st_mtime_ns != header['mtime_ns'] or not st.st_size:
+                return None
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+
+
+def _unique(key, seen):
+    # Duplicate 001s (or records without one) get an occurrence suffix.
+    n = seen.get(key, 0)
+    seen[key] = n + 1
+    return key if n == 0 else f'{key}#{n}'
+
+
+def convert_incremental(marc_path, output_path, delta_path=None, state_path=None, fast=None):
+    # Returns counts of added, changed, removed and unchanged records, of
+    # records skipped as unreadable, and of previous records kept because of
+    # them. A record that cannot be converted keeps its previous line and
+    # state entry. A record that cannot even be framed has no known 001, so
+    # when there is one, previous records missing from this run are kept
+    # rather than reported removed; they are removed by the next clean run.
+    # With MARC_SKIP_BAD_RECORDS=0 a bad record ends the run instead.
+    fast = FASTPATH_ENABLED if fast is None else fast
+    convert = extract_values if fast else (lambda raw: KBART_PLAN.values(parse_record(raw)))
+    fmt = 'csv' if output_path.endswith('.csv') else 'tsv'
+    delimiter = ',' if fmt == 'csv' else '\t'
+    state_path = state_path or output_path + STATE_SUFFIX
+    header, previous = load_state(state_path)
+    previous_output = _map_previous_output(header)
+    counts = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0, 'skipped': 0, 'kept': 0}
+    errors = record_errors()
+    unframed = []
+    entries = []
+    seen = {}
+    tmp_output = output_path + '.tmp'
+    tmp_delta = delta_path + '.tmp' if delta_path else None
+    try:
+        with open(marc_path, 'rb') as src, open(tmp_output, 'wb') as out, \
+                (open(tmp_delta, 'wb') if tmp_delta else nullcontext()) as delta:
+            out.write((delimiter.join(KBART_HEADERS) + '\n').encode('utf-8'))
+            if delta is not None:
+                delta.write((delimiter.join(['change'] + KBART_HEADERS) + '\n').encode('utf-8'))
+            offset = out.tell()
+            def frame_error(pos, exc):
+                unframed.append(pos)
+                errors.add(pos, exc)
+
+            on_error = frame_error if errors is not None else None
+            for record_offset, raw in iter_record_frames(iter(lambda: src.read(READ_CHUNK), b''), on_error):
+                key = _unique(record_key(raw), seen)
+                digest = record_digest(raw)
+                old = previous.pop(key, None)
+                if old is not None and old[0] == digest and previous_output is not None:
+                    line = previous_output[old[1]:old[1] + old[2]]
+                    counts['unchanged'] += 1
+                else:
+                    try:
+                        line = kbart_line(convert(raw), fmt).encode('utf-8')
+                    except Exception as e:
+                        if errors is None:
+                            raise
+                        errors.add(record_offset, e)
+                        if old is None or previous_output is None:
+                            continue
+                        # Keep the previous line and digest: the record is
+                        # converted again on the next run.
+                        line = previous_output[old[1]:old[1] + old[2]]
+                        out.write(line)
+                        entries.append((key, old[0], offset, len(line)))
+                        offset += len(line)
+                        continue
+                    if old is None:
+                        change = 'added'
+                    elif old[0] != digest:
+                        change = 'changed'
+                    else:
+                        change = None
+                    if change:
+                        counts[change] += 1
+                        if delta is not None:
+                            delta.write(change.encode('ascii') + delimiter.encode('ascii') + line)
+                    else:
+                        counts['unchanged'] += 1
+                out.write(line)
+                entries.append((key, digest, offset, len(line)))
+                offset += len(line)
+            for key, (digest, old_offset, length) in previous.items():
+                if unframed and previous_output is not None:
+                    # Possibly one of the unreadable records: keep it.
+                    line = previous_output[old_offset:old_offset + length]
+                    out.write(line)
+                    entries.append((key, digest, offset, len(line)))
+                    offset += len(line)
+                    counts['kept'] += 1
+                    continue
+                counts['removed'] += 1
+                if delta is None:
+                    continue
+                if previous_output is not None:
+                    line = previous_output[old_offset:old_offset + length]
+                else:
+                    title_id = key.partition('#')[0]
+                    placeholder = tuple(title_id if name == 'title_id' else '' for name in KBART_PLAN.fields)
+                    line = kbart_line(placeholder, fmt).encode('utf-8')
+                delta.write(b'removed' + delimiter.encode('ascii') + line)
+        os.replace(tmp_output, output_path)
+        if tmp_delta:
+            os.replace(tmp_delta, delta_path)
+    except BaseException:
+        for path in (tmp_output, tmp_delta):
+            if path and os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        if previous_output is not None:
+            previous_output.close()
+    save_state(state_path, output_path, entries)
+    counts['skipped'] = errors.count if errors is not None else 0
+    return counts
+
+
+# CLI: refresh a KBART file from the current MARC export
+if __name__ == "__main__":
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m marc_converter.delta",
+                                     description="Incrementally convert a MARC file to KBART.")
+    parser.add_argument("marc_path", metavar="file.mrc")
+    parser.add_argument("output", help="full KBART file to write (.tsv or .csv)")
+    parser.add_argument("--delta", help="also write the added/changed/removed rows to this file")
+    parser.add_argument("--state", help=f"state file (default: <output>{STATE_SUFFIX})")
+    parser.add_argument("--fast", action="store_true", help="use the fast-path extractor")
+    args = parser.parse_args()
+    try:
+        counts = convert_incremental(args.marc_path, args.output, args.delta, args.state,
+                                     fast=True if args.fast else None)
+        print(", ".join(f"{n} {name}" for name, n in counts.items()), file=sys.stderr)
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
@@ -0,0 +1,134 @@
+# Fast-path row extraction straight from MARC transmission-format bytes
+#
+# marc_to_row only reads a handful of tags, but a pymarc Record decodes every
+# field and subfield of the record. FastRecord reads the leader and directory
+# through a memoryview, keeps only the tags the mapping plan reads, and
+# decodes nothing else. It offers the small part of the pymarc Record/Field
+# interface that the plan relies on, so both paths share the same mapping
+# code. Anything unusual (MARC-8 records, bad subfield codes, malformed
+# leaders or directories) falls back to a full pymarc parse. Fields that are
+# not read are not validated either, so a record that pymarc would reject
+# only because of damage in such a field still converts here.
+import os
+from marc_converter.framing import LEADER_LEN, parse_record
+from marc_converter.mapping import KBART_PLAN
+
+SUBFIELD_DELIMITER = b'\x1f'
+DIRECTORY_ENTRY_LEN = 12
+
+# Tags read by the default KBART mapping plan.
+NEEDED_TAGS = KBART_PLAN.tags
+
+# Opt-in for the web paths and the parallel engine.
+FASTPATH_ENABLED = os.environ.get('MARC_FASTPATH', '').lower() in ('1', 'true', 'yes')
+
+
+class FallbackToPymarc(Exception):
+    pass
+
+
+class FastField:
+    __slots__ = ('tag', 'control_field', 'data', 'indicator1', 'indicator2', 'subfields')
+
+    def __init__(self, tag, raw, utf8_handling):
+        self.tag = tag
+        self.control_field = tag < '010' and tag.isdigit()
+        if self.control_field:
+            # pymarc decodes control fields strictly, whatever utf8_handling says.
+            self.data = bytes(raw).decode('utf-8')
+            self.indicator1 = self.indicator2 = None
+            self.subfields = []
+            return
+        self.data = None
+        chunks = bytes(raw).split(SUBFIELD_DELIMITER)
+        indicators = chunks[0].decode('ascii')
+        self.indicator1 = indicators[0] if indicators else ' '
+        self.indicator2 = indicators[1] if len(indicators) > 1 else ' '
+        # Decoded eagerly so that bad data fails here, before marc_to_row's
+        # per-column fallbacks could hide it, and the record goes to pymarc.
+        subfields = []
+        for chunk in chunks[1:]:
+            if not chunk:
+                continue
+            if chunk[0] > 0x7F:
+                raise FallbackToPymarc('non-ascii subfield code')
+            subfields.append((chr(chunk[0]), chunk[1:].decode('utf-8', utf8_handling)))
+        self.subfields = subfields
+
+    def get_subfields(self, *codes):
+        if self.control_field or not codes:
+            return []
+        return [value for code, value in self.subfields if code in codes]
+
+    def value(self):
+        if self.control_field:
+            return self.data or ""
+        return " ".join(value.strip() for _, value in self.subfields)
+
+    def __contains__(self, code):
+        if self.control_field:
+            return False
+        return any(c == code for c, _ in self.subfields)
+
+
+class FastRecord:
+    __slots__ = ('leader', 'fields')
+
+    def __init__(self, raw, force_utf8=False, utf8_handling='strict', tags=NEEDED_TAGS):
+        mv = memoryview(raw)
+        leader = bytes(mv[:LEADER_LEN]).decode('ascii')
+        if len(leader) != LEADER_LEN:
+            raise FallbackToPymarc('short leader')
+        if leader[9] != 'a' and not force_utf8:
+            raise FallbackToPymarc('not a UTF-8 record')
+        base_address = int(leader[12:17])
+        if base_address <= 0 or base_address >= len(mv) or len(mv) < int(leader[:5]):
+            raise FallbackToPymarc('bad base address or length')
+        directory = bytes(mv[LEADER_LEN:base_address - 1])
+        if not directory or len(directory) % DIRECTORY_ENTRY_LEN:
+            raise FallbackToPymarc('bad directory')
+        self.leader = leader
+        self.fields = []
+        for start in range(0, len(directory), DIRECTORY_ENTRY_LEN):
+            tag = directory[start:start + 3].decode('ascii')
+            if tag not in tags:
+                continue
+            length = int(directory[start + 3:start + 7])
+            offset = base_address + int(directory[start + 7:start + 12])
+            self.fields.append(FastField(tag, mv[offset:offset + length - 1], utf8_handling))
+
+    def get_fields(self, *tags):
+        if not tags:
+            return self.fields
+        return [field for field in self.fields if field.tag in tags]
+
+    def get(self, tag, default=None):
+        for field in self.fields:
+            if field.tag == tag:
+                return field
+        return default
+
+    def __getitem__(self, tag):
+        field = self.get(tag)
+        if field is None:
+            raise KeyError(tag)
+        return field
+
+    def __contains__(self, tag):
+        return self.get(tag) is not None
+
+
+def extract_values(raw, plan=KBART_PLAN, **options):
+    # Same result as plan.values(parse_record(raw, **options)), without
+    # building a full pymarc Record for well-formed UTF-8 records.
+    try:
+        record = FastRecord(raw, force_utf8=options.get('force_utf8', False),
+                            utf8_handling=options.get('utf8_handling', 'strict'), tags=plan.tags)
+        return plan.values(record)
+    except Exception:
+        return plan.values(parse_record(bytes(raw), **options))
+
+
+def extract_row(raw, plan=KBART_PLAN, **options):
+    # The row as a dict, like marc_to_row.
+    return plan.as_dict(extract_values(raw, plan, **options))
@@ -0,0 +1,128 @@
+# Incremental framing of MARC21 transmission-format records from a byte stream
+import itertools
+from pymarc import Record
+from pymarc.exceptions import RecordLengthInvalid, EndOfRecordNotFound, TruncatedRecord
+
+LEADER_LEN = 24
+RECORD_TERMINATOR = 0x1D
+
+
+def record_length(buffer, pos=0):
+    # The first five leader bytes hold the record length, terminator included.
+    try:
+        length = int(bytes(buffer[pos:pos + 5]))
+    except ValueError:
+        raise RecordLengthInvalid()
+    if length <= LEADER_LEN:
+        raise RecordLengthInvalid()
+    return length
+
+
+def iter_raw_records(chunks):
+    # Split complete records out of an iterable of byte chunks (e.g. a streamed
+    # download) as soon as each one has fully arrived. Only the current partial
+    # record is kept in memory.
+    buffer = bytearray()
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer += chunk
+        pos = 0
+        while len(buffer) - pos >= 5:
+            length = record_length(buffer, pos)
+            end = pos + length
+            if end > len(buffer):
+                break
+            if buffer[end - 1] != RECORD_TERMINATOR:
+                raise EndOfRecordNotFound()
+            yield bytes(buffer[pos:end])
+            pos = end
+        if pos:
+            del buffer[:pos]
+    # Trailing whitespace (e.g. a final newline) is not a record.
+    if buffer.strip():
+        raise TruncatedRecord()
+
+
+def iter_record_frames(chunks, on_error=None, offset=0):
+    # Like iter_raw_records, but yields (offset, raw) with each record's byte
+    # offset in the stream, which starts at `offset`. With on_error, a record
+    # whose leader length or terminator is wrong is reported as
+    # on_error(offset, exc) and skipped: reading resynchronizes just after the
+    # next record terminator (0x1D), so only that record is lost. That holds at
+    # the end of the input too, where a length pointing past the end is
+    # reported as TruncatedRecord and the records behind it are still read.
+    buffer = bytearray()
+    base = offset
+    resync = False
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        if not final:
+            if not chunk:
+                continue
+            buffer += chunk
+        pos = 0
+        while True:
+            if resync:
+                end = buffer.find(RECORD_TERMINATOR, pos)
+                if end < 0:
+                    pos = len(buffer)
+                    break
+                pos = end + 1
+                resync = False
+            # Trailing whitespace (e.g. a final newline) is not a record.
+            if final and not buffer[pos:].strip():
+                break
+            try:
+                if len(buffer) - pos < 5:
+                    if final:
+                        raise TruncatedRecord()
+                    break
+                length = record_length(buffer, pos)
+                end = pos + length
+                if end > len(buffer):
+                    if final:
+                        raise TruncatedRecord()
+                    break
+                if buffer[end - 1] != RECORD_TERMINATOR:
+                    raise EndOfRecordNotFound()
+            except (RecordLengthInvalid, EndOfRecordNotFound, TruncatedRecord) as e:
+                if on_error is None:
+                    raise
+                on_error(base + pos, e)
+                resync = True
+                continue
+            yield base + pos, bytes(buffer[pos:end])
+            pos = end
+        if pos:
+            del buffer[:pos]
+            base += pos
+
+
+def iter_record_spans(buffer):
+    # Walk the leader lengths of an in-memory (or memory-mapped) file and yield
+    # (offset, length) for each record without copying any record data.
+    pos = 0
+    size = len(buffer)
+    while size - pos >= 5:
+        length = record_length(buffer, pos)
+        end = pos + length
+        if end > size:
+            raise TruncatedRecord()
+        if buffer[end - 1] != RECORD_TERMINATOR:
+            raise EndOfRecordNotFound()
+        yield pos, length
+        pos = end
+    if bytes(buffer[pos:]).strip():
+        raise TruncatedRecord()
+
+
+def parse_record(raw, **options):
+    # With no options this decodes exactly like a default MARCReader; options
+    # are passed through to pymarc (force_utf8, utf8_handling, ...).
+    return Record(raw, **options)
+
+
+def iter_records(chunks, **options):
+    for raw in iter_raw_records(chunks):
+        yield parse_record(raw, **options)
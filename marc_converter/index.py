@@ -0,0 +1,153 @@
+# Memory-mapped record offset index for local MARC files
+#
+# A RecordIndex maps a .mrc file and holds the byte offset and length of every
+# record in two compact arrays, so record N can be reached in O(1), the record
+# count is known immediately, and slices can be converted without reading the
+# file into Python bytes objects. The arrays can be saved to a sidecar file
+# (<file>.mrc.idx) that is reused while the MARC file is unchanged.
+import os
+import mmap
+import struct
+from array import array
+from marc_converter.framing import iter_record_spans, parse_record
+
+SIDECAR_SUFFIX = '.idx'
+SIDECAR_MAGIC = b'MRCIDX01'
+# magic, file size, file mtime (ns), record count
+SIDECAR_HEADER = struct.Struct('<8sQQQ')
+
+
+class RecordIndex:
+    def __init__(self, path, offsets, lengths, mm):
+        self.path = path
+        self.offsets = offsets
+        self.lengths = lengths
+        self._mmap = mm
+
+    @classmethod
+    def build(cls, path):
+        mm = _map_file(path)
+        offsets = array('Q')
+        lengths = array('Q')
+        if mm is not None:
+            for offset, length in iter_record_spans(mm):
+                offsets.append(offset)
+                lengths.append(length)
+        return cls(path, offsets, lengths, mm)
+
+    @classmethod
+    def load(cls, path, sidecar=None):
+        # Returns None if there is no sidecar or it is stale.
+        sidecar = sidecar or path + SIDECAR_SUFFIX
+        try:
+            with open(sidecar, 'rb') as fh:
+                magic, size, mtime_ns, count = SIDECAR_HEADER.unpack(fh.read(SIDECAR_HEADER.size))
+                st = os.stat(path)
+                if magic != SIDECAR_MAGIC or size != st.st_size or mtime_ns != st.st_mtime_ns:
+                    return None
+                offsets = array('Q')
+                lengths = array('Q')
+                offsets.fromfile(fh, count)
+                lengths.fromfile(fh, count)
+        except (OSError, EOFError, struct.error):
+            return None
+        return cls(path, offsets, lengths, _map_file(path))
+
+    @classmethod
+    def open(cls, path, save=True):
+        # Reuse a valid sidecar, otherwise scan the file (and save a sidecar
+        # when the directory is writable).
+        index = cls.load(path)
+        if index is None:
+            index = cls.build(path)
+            if save:
+                try:
+                    index.save()
+                except OSError:
+                    pass
+        return index
+
+    def save(self, sidecar=None):
+        sidecar = sidecar or self.path + SIDECAR_SUFFIX
+        st = os.stat(self.path)
+        tmp_path = sidecar + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, st.st_size, st.st_mtime_ns, len(self.offsets)))
+            self.offsets.tofile(fh)
+            self.lengths.tofile(fh)
+        os.replace(tmp_path, sidecar)
+        return sidecar
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def span(self, n):
+        return self.offsets[n], self.lengths[n]
+
+    def record(self, n):
+        # Zero-copy view of record n's bytes.
+        offset = self.offsets[n]
+        return memoryview(self._mmap)[offset:offset + self.lengths[n]]
+
+    def byte_range(self, start, stop):
+        # Byte range covering records [start, stop), which are contiguous.
+        if start >= stop:
+            return 0, 0
+        return self.offsets[start], self.offsets[stop - 1] + self.lengths[stop - 1]
+
+    def iter_raw(self, start=0, stop=None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        for n in range(start, stop):
+            yield self.record(n)
+
+    def rows(self, start=0, stop=None, fast=False, **options):
+        from marc_converter.logic import marc_to_row
+        from marc_converter.fastpath import extract_row
+        for raw in self.iter_raw(start, stop):
+            if fast:
+                yield extract_row(raw, **options)
+            else:
+                yield marc_to_row(parse_record(bytes(raw), **options))
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _map_file(path):
+    with open(path, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return None
+        # The mapping stays valid after the file object is closed.
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# CLI: count records or preview a slice of a large MARC file
+if __name__ == "__main__":
+    import sys
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m marc_converter.index",
+                                     description="Index a MARC file and preview records.")
+    parser.add_argument("marc_path", metavar="file.mrc")
+    parser.add_argument("--offset", type=int, default=0, help="first record to convert (0-based)")
+    parser.add_argument("--limit", type=int, default=0, help="number of records to convert (default: count only)")
+    parser.add_argument("--fast", action="store_true", help="use the fast-path extractor")
+    parser.add_argument("--no-save", action="store_true", help="do not write a sidecar index")
+    args = parser.parse_args()
+    try:
+        with RecordIndex.open(args.marc_path, save=not args.no_save) as index:
+            print(f"{len(index)} records", file=sys.stderr)
+            if args.limit:
+                rows = list(index.rows(args.offset, args.offset + args.limit, fast=args.fast))
+                print(json.dumps(rows, indent=2, ensure_ascii=False))
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
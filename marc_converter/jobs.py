@@ -0,0 +1,301 @@
+# Background conversion jobs
+#
+# POST /api/jobs stores the upload (or just the URL) under a job id and hands
+# the conversion to a local process pool, so the web worker returns at once.
+# Each job keeps its state in <MARC_JOBS_DIR>/<id>/state.json, rewritten
+# atomically as the conversion progresses, and writes its output next to it.
+# Any gunicorn worker can therefore report progress or serve the output, not
+# only the one that accepted the job. Jobs not accessed for MARC_JOB_TTL
+# seconds are removed.
+#
+# Uploaded files converted to json, ndjson, csv or tsv are checkpointed (see
+# checkpoint.py), so a job whose process died can be resumed with
+# POST /api/jobs/<id>/resume from its last checkpoint instead of from scratch.
+import os
+import re
+import json
+import time
+import shutil
+import secrets
+import tempfile
+import threading
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from marc_converter import cache
+
+logger = logging.getLogger('marc_converter')
+
+JOBS_DIR = os.environ.get('MARC_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'marc_converter', 'jobs'))
+JOB_TTL = int(os.environ.get('MARC_JOB_TTL', '86400'))
+# Conversion processes per web worker.
+JOB_WORKERS = int(os.environ.get('MARC_JOB_WORKERS', '1'))
+# Seconds between progress updates written by a running job.
+PROGRESS_INTERVAL = 1.0
+
+JOB_FORMATS = ('json', 'ndjson', 'csv', 'tsv', 'xlsx')
+JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class JobNotFound(Exception):
+    pass
+
+
+def job_dir(job_id):
+    if not JOB_ID_RE.match(job_id or ''):
+        raise JobNotFound(job_id)
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def output_path(job_id, fmt):
+    return os.path.join(job_dir(job_id), f'output.{fmt}')
+
+
+def _write_state(job_id, state):
+    path = os.path.join(job_dir(job_id), 'state.json')
+    fd, tmp_path = tempfile.mkstemp(dir=job_dir(job_id), suffix='.tmp')
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(state, fh)
+    os.replace(tmp_path, path)
+
+
+def _read_state(job_id):
+    try:
+        with open(os.path.join(job_dir(job_id), 'state.json')) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        raise JobNotFound(job_id)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def checkpoint_path(job_id):
+    return os.path.join(job_dir(job_id), 'checkpoint.json')
+
+
+def get_job(job_id):
+    # Current job state. A job whose process went away (e.g. a web worker
+    # restart) is reported as failed rather than queued or running forever.
+    state = _read_state(job_id)
+    if state['state'] in ('queued', 'running') and not _pid_alive(state['pid']):
+        state.update(state='failed', error='Conversion process exited', finished=time.time(),
+                     resumable=os.path.exists(checkpoint_path(job_id)))
+        _write_state(job_id, state)
+    try:
+        os.utime(job_dir(job_id))
+    except OSError:
+        pass
+    return state
+
+
+def create_job(fmt, fileobj=None, url=None):
+    # Register a job for an uploaded file object or a URL and queue it.
+    expire_jobs()
+    job_id = secrets.token_hex(16)
+    os.makedirs(job_dir(job_id))
+    source = {'url': url} if url else {'file': 'input.mrc'}
+    if fileobj is not None:
+        with open(os.path.join(job_dir(job_id), 'input.mrc'), 'wb') as out:
+            shutil.copyfileobj(fileobj, out, 1024 * 1024)
+    state = {
+        'id': job_id,
+        'state': 'queued',
+        'format': fmt,
+        'source': source,
+        'records': 0,
+        'records_per_sec': 0.0,
+        'bytes_read': 0,
+        'bytes_total': os.path.getsize(os.path.join(job_dir(job_id), 'input.mrc')) if fileobj is not None else None,
+        'created': time.time(),
+        'started': None,
+        'finished': None,
+        'error': None,
+        'cached': False,
+        'skipped_records': 0,
+        'resumable': False,
+        'pid': os.getpid(),
+    }
+    _write_state(job_id, state)
+    _get_executor().submit(run_job, job_id)
+    return state
+
+
+def resume_job(job_id):
+    # Queue a failed job again; a checkpointed job continues where it stopped,
+    # any other starts over. Returns None if the job has not failed.
+    state = get_job(job_id)
+    if state['state'] != 'failed':
+        return None
+    state.update(state='queued', error=None, finished=None, pid=os.getpid())
+    _write_state(job_id, state)
+    _get_executor().submit(run_job, job_id)
+    return state
+
+
+def public_state(state):
+    # Job state as reported by the API.
+    return {k: v for k, v in state.items() if k != 'pid'}
+
+
+def remove_job(job_id):
+    path = job_dir(job_id)
+    if not os.path.isdir(path):
+        return False
+    shutil.rmtree(path, ignore_errors=True)
+    return True
+
+
+def expire_jobs(now=None):
+    now = now or time.time()
+    try:
+        names = os.listdir(JOBS_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not JOB_ID_RE.match(name):
+            continue
+        try:
+            if now - os.path.getmtime(os.path.join(JOBS_DIR, name)) > JOB_TTL:
+                remove_job(name)
+        except OSError:
+            pass
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        # A pool whose process was killed is broken for good; start a new one.
+        if _executor is None or getattr(_executor, '_broken', False):
+            _executor = ProcessPoolExecutor(max_workers=JOB_WORKERS,
+                                            mp_context=multiprocessing.get_context('fork'))
+        return _executor
+
+
+class _Progress:
+    # Counts bytes and records as they pass and writes them to the job state
+    # at most once per PROGRESS_INTERVAL.
+    def __init__(self, job_id, state):
+        self.job_id = job_id
+        self.state = state
+        self.last_write = 0.0
+
+    def chunks(self, chunks):
+        for chunk in chunks:
+            self.state['bytes_read'] += len(chunk)
+            yield chunk
+
+    def rows(self, rows):
+        for row in rows:
+            self.state['records'] += 1
+            now = time.time()
+            if now - self.last_write >= PROGRESS_INTERVAL:
+                self.update(now)
+            yield row
+
+    def checkpoint(self, records, offset):
+        # Progress callback of a checkpointed conversion.
+        self.state['records'] = records
+        self.state['bytes_read'] = offset
+        now = time.time()
+        if now - self.last_write >= PROGRESS_INTERVAL:
+            self.update(now)
+
+    def update(self, now=None):
+        now = now or time.time()
+        elapsed = now - self.state['started']
+        self.state['records_per_sec'] = round(self.state['records'] / elapsed, 1) if elapsed > 0 else 0.0
+        self.last_write = now
+        _write_state(self.job_id, self.state)
+
+
+def run_job(job_id):
+    # Runs in a pool process: convert the job's input to its output file,
+    # or copy it from the conversion cache.
+    state = _read_state(job_id)
+    fmt = state['format']
+    state.update(state='running', started=time.time(), pid=os.getpid())
+    _write_state(job_id, state)
+    progress = _Progress(job_id, state)
+    out_path = output_path(job_id, fmt)
+    tmp_path = out_path + '.tmp'
+    url = state['source'].get('url')
+    source = None
+    try:
+        from marc_converter.logic import DOWNLOAD_CHUNK_SIZE, open_url_source
+        from marc_converter.checkpoint import RESUMABLE_FORMATS
+        if url:
+            source = open_url_source(url, fmt)
+            hit = source.cached_path
+            if source.response is not None and source.response.headers.get('Content-Length'):
+                state['bytes_total'] = int(source.response.headers['Content-Length'])
+        else:
+            input_path = os.path.join(job_dir(job_id), 'input.mrc')
+            with open(input_path, 'rb') as fh:
+                content_hash = cache.file_digest(fh)
+            hit = cache.lookup(content_hash, fmt)
+        if hit:
+            shutil.copyfile(hit, tmp_path)
+        elif url:
+            _convert(source.chunks, fmt, tmp_path, progress)
+        elif fmt in RESUMABLE_FORMATS:
+            _convert_checkpointed(job_id, input_path, fmt, tmp_path, progress)
+        else:
+            with open(input_path, 'rb') as fh:
+                _convert(iter(lambda: fh.read(DOWNLOAD_CHUNK_SIZE), b''), fmt, tmp_path, progress)
+        os.replace(tmp_path, out_path)
+        if not hit and cache.CACHE_ENABLED:
+            try:
+                if url:
+                    content_hash = source.content_hash()
+                    cache.save_url_meta(url, source.response.headers, content_hash)
+                cache.store_file(content_hash, fmt, out_path)
+            except OSError as e:
+                logger.warning(f"Could not cache output of job {job_id}: {e}")
+        state.update(state='done', cached=bool(hit), resumable=False, finished=time.time())
+        progress.update(state['finished'])
+    except Exception as e:
+        logger.exception(f"Job {job_id} failed: {e}")
+        resumable = os.path.exists(checkpoint_path(job_id))
+        if not resumable:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        state.update(state='failed', error=str(e), resumable=resumable, finished=time.time())
+        _write_state(job_id, state)
+    finally:
+        if source is not None:
+            source.close()
+
+
+def _convert(chunks, fmt, path, progress):
+    from marc_converter.app import app
+    from marc_converter.logic import RecordErrors, RecordStream, serialize_rows, write_xlsx
+    errors = RecordErrors()
+    rows = progress.rows(RecordStream(progress.chunks(chunks), errors))
+    if fmt == 'xlsx':
+        write_xlsx(rows, path)
+    else:
+        with app.app_context(), open(path, 'w', encoding='utf-8', newline='') as out:
+            for piece in serialize_rows(rows, fmt):
+                out.write(piece)
+    progress.state['skipped_records'] = errors.count
+
+
+def _convert_checkpointed(job_id, input_path, fmt, path, progress):
+    from marc_converter.app import app
+    from marc_converter.checkpoint import convert_file
+    with app.app_context():
+        summary = convert_file(input_path, path, fmt, checkpoint_path(job_id), progress=progress.checkpoint)
+    progress.state['skipped_records'] = summary['skipped']
@@ -1,378 +1,716 @@
-# CLI harness for direct MARC file processing with error logging
-if __name__ == "__main__":
-    import sys
-    import json
-    if len(sys.argv) < 2:
-        print("Usage: python -m marc_converter.logic <file.mrc>")
-        sys.exit(1)
-    marc_path = sys.argv[1]
-    errors = []
-    records = []
-    try:
-        with open(marc_path, "rb") as fh:
-            reader = MARCReader(fh, to_unicode=True, force_utf8=True, utf8_handling="ignore")
-            for idx, rec in enumerate(reader):
-                try:
-                    row = marc_to_row(rec)
-                    records.append(row)
-                except Exception as rec_err:
-                    errors.append(f"Record {idx+1}: {rec_err}")
-        print(json.dumps(records, indent=2, ensure_ascii=False))
-        if errors:
-            print("\nErrors encountered during parsing:")
-            for err in errors:
-                print(err)
-    except Exception as e:
-        print(f"Error: {e}")
-        sys.exit(1)
-
-# CLI harness for direct MARC file processing with error logging
-if __name__ == "__main__":
-    import sys
-    import json
-    if len(sys.argv) < 2:
-        print("Usage: python -m marc_converter.logic <file.mrc>")
-        sys.exit(1)
-    marc_path = sys.argv[1]
-    errors = []
-    records = []
-    try:
-        with open(marc_path, "rb") as fh:
-            reader = MARCReader(fh, to_unicode=True, force_utf8=True, utf8_handling="ignore")
-            for idx, rec in enumerate(reader):
-                try:
-                    row = marc_to_row(rec)
-                    records.append(row)
-                except Exception as rec_err:
-                    errors.append(f"Record {idx+1}: {rec_err}")
-        print(json.dumps(records, indent=2, ensure_ascii=False))
-        if errors:
-            print("\nErrors encountered during parsing:")
-            for err in errors:
-                print(err)
-    except Exception as e:
-        print(f"Error: {e}")
-        sys.exit(1)
 # Core logic for MARC processing and file generation
-import tempfile
 import os
-import requests
-from flask import send_file, jsonify
-from pymarc import MARCReader, PymarcException
-from openpyxl import Workbook
+import io
+import itertools
+import tempfile
+import logging
+from flask import send_file, jsonify, Response, current_app, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from pymarc import PymarcException
+from marc_converter.framing import iter_record_frames, parse_record
+from marc_converter.fastpath import FASTPATH_ENABLED, extract_values
+from marc_converter.mapping import KBART_PLAN, clean_unicode
+from marc_converter.readers import READERS, sniff_chunks, sniff_file
+from marc_converter.compression import COMPRESSED_FORMATS, CompressedInputError, decompress_chunks
+from marc_converter.rows import iter_batches, json_objects
+from marc_converter.uploads import UploadNotFound, store_upload, open_upload
+from marc_converter import cache, metrics
 import csv
-import unicodedata
-import re
+
+logger = logging.getLogger('marc_converter')
+
+# --- Remote MARC fetching --- #
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Skip unreadable records (logging their byte offsets) instead of failing the
+# whole conversion.
+SKIP_BAD_RECORDS = os.environ.get('MARC_SKIP_BAD_RECORDS', '1').lower() not in ('0', 'false', 'no')
+FETCH_TIMEOUT = (10, float(os.environ.get('MARC_FETCH_TIMEOUT', '60')))
+
+# One pooled session per worker process, so repeated fetches from the same
+# host reuse keep-alive connections instead of paying a new handshake.
+# requests is imported on the first fetch rather than at worker start, and a
+# session made before a fork (e.g. in a preloading master) is not reused.
+_http_session = None
+_http_session_pid = None
+
+def http_session():
+    global _http_session, _http_session_pid
+    if _http_session is None or _http_session_pid != os.getpid():
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=16))
+        session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=16))
+        _http_session, _http_session_pid = session, os.getpid()
+    return _http_session
+
+def fetch_errors():
+    # requests' base exception, for except clauses around fetches; by the
+    # time one can be raised, requests is already imported.
+    from requests.exceptions import RequestException
+    return RequestException
+
+def fetch_marc(marc_url, headers=None):
+    r = http_session().get(marc_url, stream=True, timeout=FETCH_TIMEOUT, headers=headers)
+    try:
+        r.raise_for_status()
+    except fetch_errors():
+        r.close()
+        raise
+    return r
+
+class UrlSource:
+    # A remote MARC file ready for conversion: either a cache hit (cached_path)
+    # or a stream of byte chunks, hashed as they are read.
+    def __init__(self, cached_path=None, chunks=(), on_close=None, response=None, counted=False):
+        # counted: the chunks were already downloaded (and measured) up front.
+        self.cached_path = cached_path
+        self.chunks = cache.HashedChunks(chunks if counted else metrics.timed('download', chunks, 'bytes'))
+        self.response = response
+        self._on_close = on_close
+
+    def content_hash(self):
+        return self.chunks.hexdigest()
+
+    def cache_writer(self, marc_url, kind):
+        if not cache.CACHE_ENABLED:
+            return None
+        headers = self.response.headers if self.response is not None else {}
+        return cache.CacheWriter(kind, self.content_hash, mode=cache_mode(kind),
+                                 on_commit=lambda h: cache.save_url_meta(marc_url, headers, h))
+
+    def close(self):
+        if self._on_close is not None:
+            self._on_close()
+
+def open_url_source(marc_url, kind):
+    # Conditional GET with the validators from the last download. A 304 is
+    # served from the cache. If the server sends no validators but the output
+    # for the previous download is cached, the body is hashed before it is
+    # converted, and an unchanged file is served from the cache. Otherwise
+    # records are converted while the download is still running.
+    headers, meta = cache.conditional_headers(marc_url, kind)
+    r = fetch_marc(marc_url, headers)
+    if r.status_code == 304:
+        r.close()
+        hit = cache.lookup(meta['content_hash'], kind)
+        if hit:
+            return UrlSource(cached_path=hit)
+        r = fetch_marc(marc_url)
+    elif meta is not None and not (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+        spool = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        hashed = cache.HashedChunks(metrics.timed('download', r.iter_content(DOWNLOAD_CHUNK_SIZE), 'bytes'))
+        with r:
+            for chunk in hashed:
+                spool.write(chunk)
+        hit = cache.lookup(hashed.hexdigest(), kind)
+        if hit:
+            spool.close()
+            return UrlSource(cached_path=hit)
+        spool.seek(0)
+        return UrlSource(chunks=iter(lambda: spool.read(DOWNLOAD_CHUNK_SIZE), b''),
+                         on_close=spool.close, response=r, counted=True)
+    return UrlSource(chunks=r.iter_content(DOWNLOAD_CHUNK_SIZE), on_close=r.close, response=r)
 
 def process_marc_url(marc_url, fmt):
     if not marc_url.startswith('http'):
         return "<h3>Invalid URL format. Please provide a valid URL for the MARC file.</h3>"
+    kind = f'kbart.{fmt}'
     try:
-        r = requests.get(marc_url)
-        r.raise_for_status()
-    except requests.exceptions.RequestException as e:
+        source = open_url_source(marc_url, kind)
+    except fetch_errors() as e:
         return f"<h3>Error fetching MARC file: {e}</h3>"
+    if source.cached_path:
+        return send_file(source.cached_path, as_attachment=True, download_name=f'output.{fmt}')
+    # Records are converted as they arrive, so the download never has to be
+    # held in memory or spooled to a temp file.
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mrc") as f:
-            f.write(r.content)
-            temp_path = f.name
-        with open(temp_path, 'rb') as fh:
-            reader = MARCReader(fh)
-            data = [marc_to_row(rec) for rec in reader]
+        try:
+            rows = metrics.timed('map', iter(RecordStream(source.chunks, record_errors())), 'records')
+            with metrics.stage('serialize'):
+                output_path = generate_output_file(rows, fmt)
+        finally:
+            source.close()
+        if cache.CACHE_ENABLED:
+            try:
+                cache.store_file(source.content_hash(), kind, output_path)
+                cache.save_url_meta(marc_url, source.response.headers, source.content_hash())
+            except OSError as e:
+                logger.warning(f"Could not cache output for {marc_url}: {e}")
+        return send_output_file(output_path, fmt)
     except PymarcException as e:
         return f"<h3>Error processing MARC file: {e}</h3>"
-    except Exception as e:
-        return f"<h3>An unexpected error occurred: {e}</h3>"
-    finally:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-    try:
-        output_path = generate_output_file(data, fmt)
-        return send_file(output_path, as_attachment=True)
+    except fetch_errors() as e:
+        return f"<h3>Error fetching MARC file: {e}</h3>"
     except Exception as e:
         return f"<h3>Error generating output file: {e}</h3>"
 
 
-def process_marc_file_upload(file, fmt='json'):
+def process_marc_file_upload(file, fmt='json', stream=False):
+    on_close = None
+    if stream or fmt == 'ndjson':
+        # Request teardown closes uploaded files before a streamed body is sent,
+        # so take over the upload's stream for the lifetime of the response.
+        upload = file
+        file, upload.stream = upload.stream, io.BytesIO()
+        on_close = file.close
     try:
-        reader = MARCReader(file)
-        if fmt == 'json':
-            records = [marc_to_row(rec) for rec in reader]
-            return jsonify(records)
-        elif fmt in ('csv', 'tsv'):
-            records = [marc_to_row(rec) for rec in reader]
-            delimiter = '\t' if fmt == 'tsv' else ','
-            import io
-            output = io.StringIO()
-            headers = list(records[0].keys()) if records else []
-            writer = csv.DictWriter(output, fieldnames=headers, delimiter=delimiter)
-            writer.writeheader()
-            for row in records:
-                writer.writerow(row)
-            output.seek(0)
-            from flask import Response
-            mimetype = 'text/tab-separated-values' if fmt == 'tsv' else 'text/csv'
-            return Response(output.read(), mimetype=mimetype,
-                            headers={"Content-Disposition": f"attachment;filename=output.{fmt}"})
+        cache_writer = None
+        if cache.CACHE_ENABLED and fmt in MIMETYPES:
+            content_hash = cache.file_digest(getattr(file, 'stream', file))
+            hit = cache.lookup(content_hash, fmt)
+            if hit:
+                if on_close is not None:
+                    on_close()
+                return cached_response(hit, fmt)
+            cache_writer = cache.CacheWriter(fmt, content_hash, mode=cache_mode(fmt))
+        from marc_converter.parallel import API_WORKERS, use_parallel, open_buffer, iter_rows_parallel
+        errors = record_errors()
+        if use_parallel(getattr(file, 'stream', file)) and sniff_file(getattr(file, 'stream', file)) == 'marc':
+            rows = iter_rows_parallel(open_buffer(getattr(file, 'stream', file)), API_WORKERS,
+                                      errors=errors, fast=FASTPATH_ENABLED)
         else:
-            return jsonify({'error': f'Unsupported format: {fmt}'}), 400
-    except PymarcException as e:
+            chunks = metrics.timed('read', iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''))
+            rows = iter(RecordStream(chunks, errors))
+        return convert_response(rows, fmt, stream=stream, on_close=on_close, cache_writer=cache_writer,
+                                record_errors=errors)
+    except (PymarcException, CompressedInputError) as e:
         return jsonify({'error': f'Error processing MARC file: {str(e)}'}), 400
     except Exception as e:
         return jsonify({'error': f'Unexpected error: {str(e)}'}), 500
 
-def process_marc_url_api(marc_url, fmt='json'):
+def process_marc_url_api(marc_url, fmt='json', stream=False):
     if not marc_url.startswith('http'):
         return jsonify({'error': 'Invalid URL format'}), 400
     try:
-        r = requests.get(marc_url)
-        r.raise_for_status()
-    except requests.exceptions.RequestException as e:
+        source = open_url_source(marc_url, fmt)
+    except fetch_errors() as e:
         return jsonify({'error': f'Error fetching MARC file: {e}'}), 400
+    if source.cached_path:
+        return cached_response(source.cached_path, fmt)
     try:
-        import io
-        reader = MARCReader(io.BytesIO(r.content))
-        if fmt == 'json':
-            records = [marc_to_row(rec) for rec in reader]
-            return jsonify(records)
-        elif fmt in ('csv', 'tsv'):
-            records = [marc_to_row(rec) for rec in reader]
-            delimiter = '\t' if fmt == 'tsv' else ','
-            output = io.StringIO()
-            headers = list(records[0].keys()) if records else []
-            writer = csv.DictWriter(output, fieldnames=headers, delimiter=delimiter)
-            writer.writeheader()
-            for row in records:
-                writer.writerow(row)
-            output.seek(0)
-            from flask import Response
-            mimetype = 'text/tab-separated-values' if fmt == 'tsv' else 'text/csv'
-            return Response(output.read(), mimetype=mimetype,
-                            headers={"Content-Disposition": f"attachment;filename=output.{fmt}"})
-        else:
-            return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+        errors = record_errors()
+        rows = iter(RecordStream(source.chunks, errors))
+        cache_writer = source.cache_writer(marc_url, fmt) if fmt in MIMETYPES else None
+        return convert_response(rows, fmt, stream=stream, on_close=source.close, cache_writer=cache_writer,
+                                record_errors=errors)
+    except (PymarcException, CompressedInputError) as e:
+        return jsonify({'error': f'Error processing MARC file: {str(e)}'}), 400
+    except fetch_errors() as e:
+        return jsonify({'error': f'Error fetching MARC file: {e}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Unexpected error: {str(e)}'}), 500
+
+# --- Paginated conversion of stored uploads --- #
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def page_response(handle, index, offset, limit):
+    total = len(index)
+    offset = max(0, offset)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    stop = min(offset + limit, total)
+    records = list(metrics.timed('map', index.rows(offset, stop, fast=FASTPATH_ENABLED), 'records'))
+    with metrics.stage('serialize'):
+        return jsonify({
+            'handle': handle,
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'next_offset': stop if stop < total else None,
+            'records': records,
+        })
+
+def process_marc_upload_paginated(file, offset=0, limit=DEFAULT_PAGE_SIZE):
+    # Pages are read through a record offset index, which needs binary MARC.
+    if sniff_file(getattr(file, 'stream', file)) != 'marc':
+        return jsonify({'error': 'Paginated conversion needs uncompressed binary MARC (ISO 2709) input'}), 400
+    try:
+        handle, index = store_upload(getattr(file, 'stream', file))
+        return page_response(handle, index, offset, limit)
     except PymarcException as e:
         return jsonify({'error': f'Error processing MARC file: {str(e)}'}), 400
     except Exception as e:
         return jsonify({'error': f'Unexpected error: {str(e)}'}), 500
 
-# --- MARC/KBART utility functions --- #
-def get_subfield(field, code):
-    return field.get_subfields(code)[0] if field and field.get_subfields(code) else None
+def process_upload_page(handle, offset=0, limit=DEFAULT_PAGE_SIZE):
+    try:
+        index = open_upload(handle)
+        return page_response(handle, index, offset, limit)
+    except UploadNotFound:
+        return jsonify({'error': 'Unknown or expired upload handle'}), 404
+    except PymarcException as e:
+        return jsonify({'error': f'Error processing MARC file: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Unexpected error: {str(e)}'}), 500
+
+# --- Response serialization (buffered and streamed) --- #
+STREAM_CHUNK_SIZE = 64 * 1024
+
+MIMETYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'tsv': 'text/tab-separated-values',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+ATTACHMENT_FORMATS = ('csv', 'tsv', 'xlsx')
+
+class RecordErrors:
+    # Records skipped by a RecordStream: a count, and the byte offset and
+    # error of the first `limit` of them.
+    def __init__(self, limit=100):
+        self.limit = limit
+        self.count = 0
+        self.samples = []
+        self.first = None
+
+    def add(self, offset, exc):
+        self.count += 1
+        if self.first is None:
+            self.first = exc
+        if self.limit is None or len(self.samples) < self.limit:
+            self.samples.append({'offset': offset, 'error': str(exc) or type(exc).__name__})
+        logger.warning(f"Skipping bad MARC record at byte {offset}: {exc!r}")
+        metrics.record_error(exc)
+
+def record_errors():
+    return RecordErrors() if SKIP_BAD_RECORDS else None
+
+# Rows between the converters and the writers are tuples in KBART_PLAN.fields
+# order; the writers serialize them a RowBatch (one list per column) at a time.
+class RecordStream:
+    # Rows from a stream of MARC bytes: binary MARC, MARCXML or MARC-in-JSON,
+    # told apart by the first bytes (see readers.py). With an `errors`
+    # (RecordErrors), a record that cannot be framed or converted is skipped
+    # and recorded there instead of ending the conversion; if no record at
+    # all could be read, the first error is raised. `position` is the stream
+    # offset just past the last record consumed, for checkpoints; `offset` is
+    # where the chunks start in the stream when resuming. Only binary MARC
+    # can be resumed at an offset (`resumable`); for the other formats
+    # `position` is the input read so far, for progress reports. gzip and zip
+    # input is decompressed on the fly (`compressed`); offsets are then
+    # positions in the decompressed data, and the stream is not resumable.
+    def __init__(self, chunks, errors=None, fast=None, offset=0, record_options=None):
+        self.chunks = chunks
+        self.errors = errors
+        self.fast = FASTPATH_ENABLED if fast is None else fast
+        self.position = offset
+        self.records = 0
+        self.record_options = record_options or {}
+        self.input_format = None
+        self.compressed = None
+
+    @property
+    def resumable(self):
+        return self.input_format == 'marc' and not self.compressed
+
+    def __iter__(self):
+        options = self.record_options
+        errors = self.errors
+        on_error = errors.add if errors is not None else None
+        self.input_format, chunks = sniff_chunks(self.chunks)
+        if self.input_format in COMPRESSED_FORMATS:
+            self.compressed = self.input_format
+            self.input_format, chunks = sniff_chunks(decompress_chunks(chunks, self.compressed))
+        # decode turns a frame into a record and counts as the parse stage;
+        # convert maps the record to a row and counts as map (the consumer).
+        if self.input_format != 'marc':
+            # Parsed records are already Unicode: no fast path, no decoding options.
+            read, decode = READERS[self.input_format]
+            frames = read(chunks, on_error, self.position)
+            convert = KBART_PLAN.values
+            end = lambda offset, item: offset
+        else:
+            if self.fast:
+                # The fast-path extractor reads the record bytes itself.
+                decode = lambda raw: raw
+                convert = lambda raw: extract_values(raw, **options)
+            else:
+                decode = lambda raw: parse_record(raw, **options)
+                convert = KBART_PLAN.values
+            frames = iter_record_frames(chunks, on_error, self.position)
+            end = lambda offset, raw: offset + len(raw)
+
+        def decoded():
+            # (offset, record, None), or (offset, None, error) for a record
+            # that could not be decoded.
+            for offset, raw in frames:
+                self.position = end(offset, raw)
+                try:
+                    record = decode(raw)
+                except Exception as e:
+                    yield offset, None, e
+                    continue
+                yield offset, record, None
+
+        for offset, record, exc in metrics.timed('parse', decoded()):
+            if exc is None:
+                try:
+                    row = convert(record)
+                except Exception as e:
+                    exc = e
+            if exc is not None:
+                if errors is None:
+                    raise exc
+                errors.add(offset, exc)
+                continue
+            self.records += 1
+            yield row
+        if errors is not None and not self.records and errors.first is not None:
+            raise errors.first
+
+def json_batch_encoder(provider):
+    # Encode whole batches directly when the app uses Flask's default JSON
+    # settings; otherwise defer to the provider row by row.
+    if type(provider) is DefaultJSONProvider:
+        return lambda batch: json_objects(batch, provider.ensure_ascii, provider.sort_keys)
+    return lambda batch: [provider.dumps(dict(zip(batch.fields, row)), separators=(',', ':'))
+                          for row in batch.rows()]
+
+def serialize_json_array(batches, encode):
+    yield '['
+    separator = ''
+    for batch in batches:
+        yield separator + ','.join(encode(batch))
+        separator = ','
+    yield ']\n'
+
+def serialize_ndjson(batches, encode):
+    for batch in batches:
+        yield '\n'.join(encode(batch)) + '\n'
+
+def serialize_delimited(batches, delimiter):
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter=delimiter)
+    for idx, batch in enumerate(batches):
+        if idx == 0:
+            writer.writerow(batch.fields)
+        writer.writerows(batch.rows())
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate(0)
+
+# Group per-row pieces into ~STREAM_CHUNK_SIZE chunks to keep per-write overhead low
+def coalesce_chunks(pieces, chunk_size=STREAM_CHUNK_SIZE):
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
 
-def clean_unicode(text):
-    if not text:
-        return ""
-    text = unicodedata.normalize("NFC", text)
-    text = text.strip()
-    text = re.sub(r'[\r\n\t]+', ' ', text)
-    text = ''.join(ch for ch in text if ch.isprintable())
-    return text
-
-def get_publication_type(record):
-    bib_level = record.leader[7]
-    if bib_level == 's':
-        return "serial"
-    elif bib_level == 'm':
-        return "monograph"
-    else:
-        return "other"
-
-def get_access_type(record):
-    for field in record.get_fields('506'):
-        restriction_note = " ".join(field.get_subfields('a')).lower()
-        if any(term in restriction_note for term in ['unrestricted', 'open', 'no restrictions']):
-            return "openaccess"
-    for field in record.get_fields('856'):
-        if field.indicator2 == '0':
-            return "openaccess"
-        if 'z' in field and 'subscription' in " ".join(field.get_subfields('z')).lower():
-            return "paid"
-    return "paid"
-
-def get_pub_info(record):
-    publisher_name = date_monograph_published_online = ""
-    for field in record.get_fields('264'):
-        if field.indicator2 == '1':
-            publisher_name = get_subfield(field, 'b') or ""
-            date_monograph_published_online = get_subfield(field, 'c') or ""
-            return publisher_name.strip(), date_monograph_published_online.strip()
-    fields_260 = record.get_fields('260')
-    if fields_260:
-        publisher_name = get_subfield(fields_260[0], 'b') or ""
-        date_monograph_published_online = get_subfield(fields_260[0], 'c') or ""
-    return publisher_name.strip(), date_monograph_published_online.strip()
-
-def marc_to_row(record):
-    title_id = clean_unicode(record['001'].value()) if '001' in record and record['001'] and hasattr(record['001'], 'value') else "unknown"
-    publication_title = clean_unicode(f"{get_subfield(record.get('245'), 'a') or ''} {get_subfield(record.get('245'), 'b') or ''}".strip())
-    first_author = ""
-    for tag in ('100', '110', '111'):
-        for field in record.get_fields(tag) if record.get_fields(tag) else []:
-            name = get_subfield(field, 'a')
-            if name:
-                first_author = clean_unicode(name)
-                break
-        if first_author:
-            break
-    first_editor = ""
+def serialize_rows(rows, fmt, schema=KBART_PLAN):
+    batches = iter_batches(rows, schema)
+    if fmt in ('json', 'ndjson'):
+        encode = json_batch_encoder(current_app.json)
+        if fmt == 'json':
+            return serialize_json_array(batches, encode)
+        return serialize_ndjson(batches, encode)
+    return serialize_delimited(batches, '\t' if fmt == 'tsv' else ',')
+
+def _guarded_stream(chunks, on_close=None, cache_writer=None):
+    # Once the first byte is sent the status code is fixed, so errors past
+    # this point can only be logged and end the response early. The output
+    # is only cached if it was sent completely.
+    completed = False
     try:
-        first_editor = next(
-            (
-                clean_unicode(get_subfield(f, 'a'))
-                for f in record.get_fields('700') if f is not None and hasattr(f, 'get_subfields')
-                and f.get_subfields('e') and any('editor' in s.lower() for s in f.get_subfields('e'))
-            ),
-            ""
-        )
-    except Exception:
-        first_editor = ""
-    online_identifier_list = []
-    for f in record.get_fields('020') if record.get_fields('020') else []:
-        val = get_subfield(f, 'a')
-        if val:
-            online_identifier_list.append(clean_unicode(val))
-    online_identifier = "; ".join(online_identifier_list)
+        for chunk in chunks:
+            if cache_writer is not None:
+                cache_writer.write(chunk)
+            yield chunk
+        completed = True
+    except Exception as e:
+        logger.exception(f"Streaming conversion aborted: {e}")
+    finally:
+        if on_close is not None:
+            on_close()
+        if cache_writer is not None:
+            _finish_cache(cache_writer, completed)
+
+def _finish_cache(cache_writer, completed):
     try:
-        publisher_name, date_monograph_published_online = get_pub_info(record)
-    except Exception:
-        publisher_name, date_monograph_published_online = "", ""
-    publisher_name = clean_unicode(publisher_name)
-    date_monograph_published_online = clean_unicode(date_monograph_published_online)
-    title_url = "N/A"
-    for field in record.get_fields('856') if record.get_fields('856') else []:
-        url = get_subfield(field, 'u')
-        if url:
-            title_url = clean_unicode(url)
-            break
+        if completed:
+            cache_writer.commit()
+        else:
+            cache_writer.discard()
+    except OSError as e:
+        logger.warning(f"Could not cache converted output: {e}")
+
+def cached_response(path, fmt):
+    return send_file(path, mimetype=MIMETYPES[fmt], as_attachment=fmt in ATTACHMENT_FORMATS,
+                     download_name=f'output.{fmt}')
+
+def cache_mode(kind):
+    return 'wb' if kind.endswith('xlsx') else 'w'
+
+def send_output_file(path, fmt):
+    # Send a per-request output file. send_file has already opened it, so the
+    # name can be unlinked at once and the data goes when the response closes.
+    try:
+        return send_file(path, mimetype=MIMETYPES.get(fmt), as_attachment=True, download_name=f'output.{fmt}')
+    finally:
+        remove_output_file(path)
+
+def remove_output_file(path):
     try:
-        publication_type = get_publication_type(record)
+        os.remove(path)
+    except OSError:
+        pass
+
+def xlsx_response(rows, on_close=None, cache_writer=None, schema=KBART_PLAN):
+    # Workbooks are zip files written at the end, so the rows go to a
+    # write-only workbook on disk (constant memory) and the file is sent whole.
+    try:
+        with metrics.stage('serialize'):
+            path = write_xlsx(rows, schema=schema)
     except Exception:
-        publication_type = "other"
+        if cache_writer is not None:
+            cache_writer.discard()
+        raise
+    finally:
+        if on_close is not None:
+            on_close()
+    if cache_writer is not None:
+        try:
+            with open(path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+                    cache_writer.write(chunk)
+        except OSError:
+            cache_writer.discard()
+        else:
+            _finish_cache(cache_writer, True)
+    return send_output_file(path, 'xlsx')
+
+# Buffered mode (the default) converts everything before responding. In streaming
+# mode, and always for ndjson, rows are serialized as they come off the reader and
+# sent as a chunked response, so memory stays bounded regardless of file size.
+# cache_writer, if given, receives the serialized output and is committed once
+# the whole output has been produced. `schema` describes the row tuples
+# (KBART_PLAN, or a RowSchema with extra columns). Buffered responses report
+# records skipped as unreadable (record_errors) in X-Marc-Skipped-Records.
+def convert_response(rows, fmt, stream=False, on_close=None, cache_writer=None, schema=KBART_PLAN, headers=None,
+                     record_errors=None):
+    if fmt not in MIMETYPES:
+        if on_close is not None:
+            on_close()
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    rows = metrics.timed('map', rows, 'records')
+    if fmt == 'xlsx':
+        response = xlsx_response(rows, on_close, cache_writer, schema)
+        response.headers.update(headers or {})
+        if record_errors is not None and record_errors.count:
+            response.headers['X-Marc-Skipped-Records'] = str(record_errors.count)
+        return response
+    headers = dict(headers or {})
+    if fmt in ('csv', 'tsv'):
+        headers["Content-Disposition"] = f"attachment;filename=output.{fmt}"
+    if not stream and fmt != 'ndjson':
+        try:
+            records = list(rows)
+        except Exception:
+            if cache_writer is not None:
+                cache_writer.discard()
+            raise
+        finally:
+            if on_close is not None:
+                on_close()
+        if record_errors is not None and record_errors.count:
+            headers['X-Marc-Skipped-Records'] = str(record_errors.count)
+        with metrics.stage('serialize'):
+            body = ''.join(serialize_rows(records, fmt, schema))
+        if cache_writer is not None:
+            cache_writer.write(body)
+            _finish_cache(cache_writer, True)
+        return Response(body, mimetype=MIMETYPES[fmt], headers=headers)
+    # Convert the first record eagerly so that unreadable input still gets a
+    # proper error status instead of an empty 200.
     try:
-        access_type = get_access_type(record)
+        first = next(rows, None)
     except Exception:
-        access_type = "openaccess"
-
-    # --- Source ID and Type logic (refined DOI recognition) ---
-    source_id = ""
-    source_id_type = ""
-    doi_regex = re.compile(r"(?:10\.\d{4,9}/[-._;()/:A-Z0-9]+)", re.IGNORECASE)
-    doi_url_regex = re.compile(r"https?://(?:dx\.)?doi\.org/(10\.\d{4,9}/[-._;()/:A-Z0-9]+)", re.IGNORECASE)
-
-    # 1. Doc ID (ProQuest)
-    if title_id.startswith("urn:librarysimplified.org/terms/id/ProQuest%20Doc%20ID/"):
-        source_id = title_id.split("/ProQuest%20Doc%20ID/")[-1]
-        source_id_type = "Doc ID"
-    # 2. File Handle (OAPEN)
-    elif title_id.startswith("https://library.oapen.org/handle/"):
-        source_id = title_id.split("/handle/")[-1]
-        source_id_type = "File Handle"
-    # 3. Media ID (Open Research Library)
-    elif title_id.startswith("urn:uuid:"):
-        source_id = title_id
-        source_id_type = "Media ID"
-    # 4. DOI (URL form in title_id or title_url)
-    elif title_id.startswith("https://doi.org/") or title_id.startswith("https://dx.doi.org/"):
-        source_id = title_id
-        source_id_type = "DOI"
-    elif title_url.startswith("https://doi.org/") or title_url.startswith("https://dx.doi.org/"):
-        source_id = title_url
-        source_id_type = "DOI"
-    # 5. DOI (bare string in title_id, online_identifier, or title_url)
-    elif doi_regex.match(title_id):
-        source_id = doi_regex.match(title_id).group(0)
-        source_id_type = "DOI"
-    elif any(doi_regex.match(oid) for oid in online_identifier_list):
-        source_id = next(oid for oid in online_identifier_list if doi_regex.match(oid))
-        source_id_type = "DOI"
-    elif doi_regex.match(title_url):
-        source_id = doi_regex.match(title_url).group(0)
-        source_id_type = "DOI"
-    # 6. ISBN
-    elif online_identifier_list:
-        source_id = online_identifier_list[0]
-        source_id_type = "ISBN"
-    else:
-        source_id = title_id
-        source_id_type = "Unknown"
-
-    return {
-        "title_id": title_id,
-        "publication_title": publication_title,
-        "title_url": title_url,
-        "first_author": first_author,
-        "online_identifier": online_identifier,
-        "publisher_name": publisher_name,
-        "publication_type": publication_type,
-        "date_monograph_published_online": date_monograph_published_online,
-        "first_editor": first_editor,
-        "access_type": access_type,
-        "source_id": source_id,
-        "source_id_type": source_id_type
-    }
-
-def generate_output_file(records, fmt):
-    headers = [
-        "publication_title",
-        "print_identifier",
-        "online_identifier",
-        "date_first_issue_online",
-        "num_first_vol_online",
-        "num_first_issue_online",
-        "date_last_issue_online",
-        "num_last_vol_online",
-        "num_last_issue_online",
-        "title_url",
-        "first_author",
-        "title_id",
-        "embargo_info",
-        "coverage_depth",
-        "notes",
-        "publisher_name",
-        "publication_type",
-        "date_monograph_published_print",
-        "date_monograph_published_online",
-        "monograph_volume",
-        "monograph_edition",
-        "first_editor",
-        "parent_publication_title_id",
-        "preceding_publication_title_id",
-        "access_type",
-        "source_id",
-        "source_id_type"
-    ]
-    delimiter = "\t" if fmt == "tsv" else ","
-    with open(f"output.{fmt}", "w", encoding="utf-8") as f:
-        f.write(delimiter.join(headers) + "\n")
-        for record in records:
-            row = [
-                record.get("publication_title", ""),
-                record.get("print_identifier", ""),
-                record.get("online_identifier", ""),
-                record.get("date_first_issue_online", ""),
-                record.get("num_first_vol_online", ""),
-                record.get("num_first_issue_online", ""),
-                record.get("date_last_issue_online", ""),
-                record.get("num_last_vol_online", ""),
-                record.get("num_last_issue_online", ""),
-                record.get("title_url", ""),
-                record.get("first_author", ""),
-                record.get("title_id", ""),
-                record.get("embargo_info", ""),
-                record.get("coverage_depth", "fulltext"),
-                record.get("notes", ""),
-                record.get("publisher_name", ""),
-                record.get("publication_type", "monograph"),
-                record.get("date_monograph_published_print", ""),
-                record.get("date_monograph_published_online", ""),
-                record.get("monograph_volume", ""),
-                record.get("monograph_edition", ""),
-                record.get("first_editor", ""),
-                record.get("parent_publication_title_id", ""),
-                record.get("preceding_publication_title_id", ""),
-                record.get("access_type", "paid"),
-                record.get("source_id", ""),
-                record.get("source_id_type", "")
-            ]
-            f.write(delimiter.join(row) + "\n")
+        if on_close is not None:
+            on_close()
+        if cache_writer is not None:
+            cache_writer.discard()
+        raise
+    if first is not None:
+        rows = itertools.chain([first], rows)
+    chunks = coalesce_chunks(metrics.timed('serialize', serialize_rows(rows, fmt, schema)))
+    return Response(stream_with_context(_guarded_stream(chunks, on_close, cache_writer)),
+                    mimetype=MIMETYPES[fmt], headers=headers)
+
+# --- MARC/KBART utility functions --- #
+def get_subfield(field, code):
+    return field.get_subfields(code)[0] if field and field.get_subfields(code) else None
+
+def marc_to_row(record, plan=KBART_PLAN):
+    # Column mapping lives in marc_converter.mapping as a compiled plan; pass
+    # another plan for a custom column profile.
+    return plan.row(record)
+
+# KBART columns in file order, and the values used when a row lacks one.
+KBART_HEADERS = [
+    "publication_title",
+    "print_identifier",
+    "online_identifier",
+    "date_first_issue_online",
+    "num_first_vol_online",
+    "num_first_issue_online",
+    "date_last_issue_online",
+    "num_last_vol_online",
+    "num_last_issue_online",
+    "title_url",
+    "first_author",
+    "title_id",
+    "embargo_info",
+    "coverage_depth",
+    "notes",
+    "publisher_name",
+    "publication_type",
+    "date_monograph_published_print",
+    "date_monograph_published_online",
+    "monograph_volume",
+    "monograph_edition",
+    "first_editor",
+    "parent_publication_title_id",
+    "preceding_publication_title_id",
+    "access_type",
+    "source_id",
+    "source_id_type"
+]
+KBART_DEFAULTS = {"coverage_depth": "fulltext", "publication_type": "monograph", "access_type": "paid"}
+
+def kbart_sources(schema=KBART_PLAN):
+    # KBART headers for rows of `schema`, plus where each column comes from:
+    # a position in the row tuple, or None for columns the rows do not have
+    # (filled with their default). Extra schema fields (e.g. source) are
+    # appended after the KBART columns.
+    headers = KBART_HEADERS + [name for name in schema.fields if name not in KBART_HEADERS]
+    return headers, [(schema.fields.index(name) if name in schema.fields else None, KBART_DEFAULTS.get(name, ""))
+                     for name in headers]
+
+KBART_SOURCES = kbart_sources()[1]
+
+def kbart_values(row, sources=KBART_SOURCES):
+    return [row[idx] if idx is not None else default for idx, default in sources]
+
+def kbart_rows(batch, sources=KBART_SOURCES):
+    # A batch's KBART rows, assembled column-wise; constant columns are shared.
+    n = len(batch)
+    columns = [batch.columns[idx] if idx is not None else itertools.repeat(default, n)
+               for idx, default in sources]
+    return zip(*columns)
+
+def kbart_writer(f, fmt):
+    # Fields holding the delimiter, quotes or newlines are quoted.
+    return csv.writer(f, dialect="excel-tab" if fmt == "tsv" else "excel", lineterminator="\n")
+
+def kbart_line(row, fmt):
+    buffer = io.StringIO()
+    kbart_writer(buffer, fmt).writerow(kbart_values(row))
+    return buffer.getvalue()
+
+def serialize_kbart(rows, fmt, schema=KBART_PLAN):
+    # KBART text (tsv or csv) for row tuples, one piece per batch.
+    headers, sources = kbart_sources(schema)
+    buffer = io.StringIO()
+    writer = kbart_writer(buffer, fmt)
+    writer.writerow(headers)
+    for batch in iter_batches(rows, schema):
+        writer.writerows(kbart_rows(batch, sources))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def output_file_path(fmt):
+    # A fresh temp file per conversion, so concurrent requests never share one.
+    fd, path = tempfile.mkstemp(prefix="marc_output_", suffix=f".{fmt}")
+    os.close(fd)
+    return path
+
+def write_xlsx(rows, path=None, kbart=False, schema=KBART_PLAN):
+    # Stream rows into a write-only workbook, which keeps memory flat however
+    # many rows there are. With kbart=True the sheet has the KBART columns,
+    # otherwise the schema's own fields.
+    path = path or output_file_path("xlsx")
+    headers, sources = kbart_sources(schema) if kbart else (list(schema.fields), None)
+    # openpyxl takes longer to import than the rest of the app; only xlsx needs it.
+    from openpyxl import Workbook
+    try:
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append(headers)
+        for batch in iter_batches(rows, schema):
+            for row in (kbart_rows(batch, sources) if kbart else batch.rows()):
+                ws.append(row)
+        wb.save(path)
+    except BaseException:
+        remove_output_file(path)
+        raise
+    return path
+
+def generate_output_file(records, fmt, path=None, schema=KBART_PLAN):
+    # Write a KBART file (tsv, csv or xlsx) from row tuples; returns its path.
+    if fmt == "xlsx":
+        return write_xlsx(records, path, kbart=True, schema=schema)
+    path = path or output_file_path(fmt)
+    try:
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            for piece in serialize_kbart(records, fmt, schema):
+                f.write(piece)
+    except BaseException:
+        remove_output_file(path)
+        raise
+    return path
+
+
+# CLI harness for direct MARC file processing with error logging
+if __name__ == "__main__":
+    import sys
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m marc_converter.logic",
+                                     description="Convert a MARC file (binary MARC, MARCXML or MARC-in-JSON, "
+                                                 "optionally gzip or zip compressed) to JSON rows.")
+    parser.add_argument("marc_path", metavar="file.mrc")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes for binary MARC (default: 1, serial)")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="records per worker batch when --workers > 1")
+    parser.add_argument("--fast", action="store_true",
+                        help="use the fast-path extractor instead of full pymarc records")
+    args = parser.parse_args()
+    record_options = {"to_unicode": True, "force_utf8": True, "utf8_handling": "ignore"}
+    records = []
+    try:
+        with open(args.marc_path, "rb") as fh:
+            input_format = sniff_file(fh)
+        # Bad records are skipped and reported with their byte offsets.
+        skipped = RecordErrors(limit=None)
+        if args.workers > 1 and input_format == "marc":
+            from marc_converter.parallel import iter_file_rows_parallel
+            records = [KBART_PLAN.as_dict(row) for row in
+                       iter_file_rows_parallel(args.marc_path, args.workers, args.batch_size,
+                                               record_options=record_options, errors=skipped,
+                                               fast=args.fast)]
+        else:
+            with open(args.marc_path, "rb") as fh:
+                stream = RecordStream(iter(lambda: fh.read(DOWNLOAD_CHUNK_SIZE), b''), skipped,
+                                      fast=args.fast, record_options=record_options)
+                records = [KBART_PLAN.as_dict(row) for row in stream]
+        errors = [f"Record at byte {e['offset']}: {e['error']}" for e in skipped.samples]
+        print(json.dumps(records, indent=2, ensure_ascii=False))
+        if errors:
+            print("\nErrors encountered during parsing:")
+            for err in errors:
+                print(err)
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
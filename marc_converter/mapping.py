@@ -0,0 +1,276 @@
+# Declarative MARC-to-KBART column mapping, compiled once into a single-pass extractor
+import re
+import sys
+from marc_converter.normalize import clean_unicode, column_cleaner, cache_stats
+
+
+_RAISE = object()
+
+
+class Column:
+    # One output column and where its value comes from:
+    #   tags       MARC tags to read, in priority order
+    #   subfields  subfield codes; the first value of each is used (several are
+    #              joined with a space). None reads a control field's data.
+    #   select     'field' - the first matching field, whatever its value
+    #              'value' - per tag, the first field with a non-empty value
+    #              'all'   - every non-empty value, joined with `sep`
+    #              or a callable(fields_by_tag, leader) returning the value
+    #   where      optional {tag: predicate(field)} filter on candidate fields
+    #   clean      cleaner applied to extracted values
+    #   default    value when no field matches
+    #   fallback   value when extraction raises (by default errors propagate)
+    #   intern     share one copy of each distinct value across rows (for
+    #              columns with few distinct values, such as publisher_name)
+    __slots__ = ('name', 'tags', 'subfields', 'select', 'where', 'clean', 'default', 'fallback', 'sep', 'intern')
+
+    def __init__(self, name, tags=(), subfields=('a',), select='field', where=None,
+                 clean=clean_unicode, default="", fallback=_RAISE, sep="; ", intern=False):
+        self.name = name
+        self.tags = tuple(tags)
+        self.subfields = tuple(subfields) if subfields is not None else None
+        self.select = select
+        self.where = where or {}
+        self.clean = clean
+        self.default = default
+        self.fallback = fallback
+        self.sep = sep
+        self.intern = intern
+
+
+class Derived:
+    # Columns computed from other columns once a record has been extracted:
+    # func(*input values, parts) returns one value per output name. `parts`
+    # holds the individual values of 'all' columns.
+    __slots__ = ('outputs', 'inputs', 'func')
+
+    def __init__(self, outputs, inputs, func):
+        self.outputs = tuple(outputs)
+        self.inputs = tuple(inputs)
+        self.func = func
+
+
+def _field_value(field, subfields):
+    if subfields is None:
+        return field.value()
+    if len(subfields) == 1:
+        values = field.get_subfields(subfields[0])
+        return values[0] if values else None
+    parts = []
+    for code in subfields:
+        values = field.get_subfields(code)
+        parts.append(values[0] if values and values[0] else '')
+    return " ".join(parts).strip()
+
+
+def _compile_column(column, clean=None):
+    tags, subfields, where, default = column.tags, column.subfields, column.where, column.default
+    clean = clean or column.clean
+
+    def candidates(fields_by_tag, tag):
+        fields = fields_by_tag.get(tag, ())
+        predicate = where.get(tag)
+        return fields if predicate is None else [f for f in fields if predicate(f)]
+
+    if callable(column.select):
+        select = column.select
+        extract = lambda fields_by_tag, leader, parts: select(fields_by_tag, leader)
+    elif column.select == 'field':
+        def extract(fields_by_tag, leader, parts):
+            for tag in tags:
+                for field in candidates(fields_by_tag, tag):
+                    return clean(_field_value(field, subfields))
+            return default
+    elif column.select == 'value':
+        def extract(fields_by_tag, leader, parts):
+            value = default
+            for tag in tags:
+                for field in candidates(fields_by_tag, tag):
+                    raw = _field_value(field, subfields)
+                    if raw:
+                        value = clean(raw)
+                        break
+                if value:
+                    break
+            return value
+    elif column.select == 'all':
+        sep, name = column.sep, column.name
+
+        def extract(fields_by_tag, leader, parts):
+            values = []
+            for tag in tags:
+                for field in candidates(fields_by_tag, tag):
+                    raw = _field_value(field, subfields)
+                    if raw:
+                        values.append(clean(raw))
+            # Keep the individual values for derived columns.
+            parts[name] = values
+            return sep.join(values) if values else default
+    else:
+        raise ValueError(f"Unknown select rule for column {column.name}: {column.select!r}")
+
+    if column.fallback is _RAISE:
+        return extract
+    fallback = column.fallback
+
+    def guarded(fields_by_tag, leader, parts):
+        try:
+            return extract(fields_by_tag, leader, parts)
+        except Exception:
+            return fallback
+    return guarded
+
+
+class MappingPlan:
+    # A compiled list of columns. values() walks the record's fields once,
+    # bucketing the tags any column reads, then fills each column from the
+    # buckets. `derive` (a Derived) runs last and appends computed columns.
+    # Rows are tuples in `fields` order; row() gives the same data as a dict.
+    def __init__(self, columns, derive=None):
+        self.columns = tuple(columns)
+        self.names = tuple(column.name for column in self.columns)
+        self.tags = frozenset(tag for column in self.columns for tag in column.tags)
+        self.derive = derive
+        self.fields = self.names + (derive.outputs if derive is not None else ())
+        self.interned = frozenset(column.name for column in self.columns if column.intern)
+        # Columns using clean_unicode get their own memo, for per-column stats.
+        self.cleaners = {column.name: column_cleaner() for column in self.columns
+                         if column.clean is clean_unicode and not callable(column.select)}
+        self._extractors = tuple(_compile_column(column, self.cleaners.get(column.name)) for column in self.columns)
+        self._intern_positions = tuple(idx for idx, column in enumerate(self.columns) if column.intern)
+        self._derive_inputs = tuple(self.names.index(name) for name in derive.inputs) if derive is not None else ()
+
+    def values(self, record):
+        tags = self.tags
+        fields_by_tag = {}
+        for field in record.fields:
+            tag = field.tag
+            if tag in tags:
+                bucket = fields_by_tag.get(tag)
+                if bucket is None:
+                    fields_by_tag[tag] = [field]
+                else:
+                    bucket.append(field)
+        leader = record.leader
+        parts = {}
+        values = [extract(fields_by_tag, leader, parts) for extract in self._extractors]
+        for idx in self._intern_positions:
+            value = values[idx]
+            if type(value) is str:
+                values[idx] = sys.intern(value)
+        if self.derive is not None:
+            values.extend(self.derive.func(*[values[idx] for idx in self._derive_inputs], parts))
+        return tuple(values)
+
+    def row(self, record):
+        return dict(zip(self.fields, self.values(record)))
+
+    def as_dict(self, values):
+        return dict(zip(self.fields, values))
+
+    def clean_stats(self):
+        # Per-column clean_unicode memo hit rates in this process.
+        return cache_stats(self.cleaners)
+
+
+def compile_plan(columns, derive=None):
+    return MappingPlan(columns, derive)
+
+
+# --- KBART column spec --- #
+OPEN_ACCESS_TERMS = ('unrestricted', 'open', 'no restrictions')
+
+
+def is_editor(field):
+    relators = field.get_subfields('e')
+    return bool(relators) and any('editor' in s.lower() for s in relators)
+
+
+def publication_type(fields_by_tag, leader):
+    bib_level = leader[7]
+    if bib_level == 's':
+        return "serial"
+    elif bib_level == 'm':
+        return "monograph"
+    return "other"
+
+
+def access_type(fields_by_tag, leader):
+    for field in fields_by_tag.get('506', ()):
+        restriction_note = " ".join(field.get_subfields('a')).lower()
+        if any(term in restriction_note for term in OPEN_ACCESS_TERMS):
+            return "openaccess"
+    for field in fields_by_tag.get('856', ()):
+        if field.indicator2 == '0':
+            return "openaccess"
+        if 'z' in field and 'subscription' in " ".join(field.get_subfields('z')).lower():
+            return "paid"
+    return "paid"
+
+
+PUBLISHER_WHERE = {'264': lambda field: field.indicator2 == '1'}
+
+KBART_COLUMNS = [
+    Column('title_id', ('001',), subfields=None, default="unknown"),
+    Column('publication_title', ('245',), ('a', 'b')),
+    Column('title_url', ('856',), ('u',), select='value', default="N/A"),
+    Column('first_author', ('100', '110', '111'), ('a',), select='value'),
+    Column('online_identifier', ('020',), ('a',), select='all'),
+    Column('publisher_name', ('264', '260'), ('b',), where=PUBLISHER_WHERE, fallback="", intern=True),
+    Column('publication_type', select=publication_type, fallback="other", intern=True),
+    Column('date_monograph_published_online', ('264', '260'), ('c',), where=PUBLISHER_WHERE, fallback=""),
+    Column('first_editor', ('700',), ('a',), where={'700': is_editor}, fallback=""),
+    Column('access_type', ('506', '856'), select=access_type, fallback="openaccess", intern=True),
+]
+
+
+# --- Source ID rules --- #
+# Checked against title_id in order: (prefix, source_id_type, marker). With a
+# marker, the source ID is the text after its last occurrence; otherwise it is
+# the whole title_id.
+SOURCE_ID_PREFIXES = (
+    ("urn:librarysimplified.org/terms/id/ProQuest%20Doc%20ID/", "Doc ID", "/ProQuest%20Doc%20ID/"),
+    ("https://library.oapen.org/handle/", "File Handle", "/handle/"),
+    ("urn:uuid:", "Media ID", None),
+    ("https://doi.org/", "DOI", None),
+    ("https://dx.doi.org/", "DOI", None),
+)
+DOI_URL_PREFIXES = ("https://doi.org/", "https://dx.doi.org/")
+DOI_PATTERN = r"10\.\d{4,9}/[-._;()/:A-Z0-9]+"
+
+doi_regex = re.compile(DOI_PATTERN, re.IGNORECASE)
+# One anchored alternation for the title_id: a named group per prefix rule,
+# then a bare DOI.
+source_id_regex = re.compile(
+    "(?:" + "|".join(f"(?P<p{idx}>{re.escape(prefix)})" for idx, (prefix, _, _) in enumerate(SOURCE_ID_PREFIXES))
+    + f"|(?P<doi>(?i:{DOI_PATTERN})))"
+)
+
+
+def derive_source_id(title_id, title_url, parts):
+    match = source_id_regex.match(title_id)
+    kind = match.lastgroup if match else None
+    if kind is not None and kind != 'doi':
+        _, source_id_type, marker = SOURCE_ID_PREFIXES[int(kind[1:])]
+        source_id = title_id.rpartition(marker)[2] if marker else title_id
+    elif title_url.startswith(DOI_URL_PREFIXES):
+        source_id, source_id_type = title_url, "DOI"
+    elif kind == 'doi':
+        source_id, source_id_type = match.group('doi'), "DOI"
+    else:
+        online_identifiers = parts.get("online_identifier", ())
+        doi = next((oid for oid in online_identifiers if doi_regex.match(oid)), None)
+        if doi is not None:
+            source_id, source_id_type = doi, "DOI"
+        elif doi_regex.match(title_url):
+            source_id, source_id_type = doi_regex.match(title_url).group(0), "DOI"
+        elif online_identifiers:
+            source_id, source_id_type = online_identifiers[0], "ISBN"
+        else:
+            source_id, source_id_type = title_id, "Unknown"
+    return source_id, source_id_type
+
+
+SOURCE_ID = Derived(('source_id', 'source_id_type'), ('title_id', 'title_url'), derive_source_id)
+
+KBART_PLAN = compile_plan(KBART_COLUMNS, derive=SOURCE_ID)
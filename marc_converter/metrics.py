@@ -0,0 +1,404 @@
+# Per-request conversion metrics in Prometheus text format, and ?profile=1
+#
+# Each request gets a RequestMetrics tracker (in flask.g). The conversion
+# pipeline is a chain of generators (download -> parse -> map -> serialize),
+# so stages are timed by wrapping each iterator with timed(); a stage's time
+# excludes the time spent in the stages it pulls from. When the response has
+# been sent, the stage durations, bytes, records and per-record errors are
+# added to this process's counters and histograms.
+#
+# Every gunicorn worker writes its totals to <MARC_METRICS_DIR>/<pid>-<id>.json
+# (atomically, after each request), and GET /metrics sums the files of all
+# workers. Files of workers that have exited are folded into retired.json
+# under an flock, so totals survive worker restarts.
+#
+# With DEBUG set, ?profile=1 on a conversion endpoint runs the request under
+# cProfile and answers with the hot spots instead of the converted output.
+import io
+import os
+import json
+import time
+import fcntl
+import pstats
+import secrets
+import cProfile
+import tempfile
+import threading
+import functools
+from contextlib import contextmanager
+from flask import g, has_request_context, request, current_app, Response
+
+METRICS_ENABLED = os.environ.get('MARC_METRICS', '1').lower() not in ('0', 'false', 'no')
+METRICS_DIR = os.environ.get('MARC_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'marc_converter', 'metrics'))
+RETIRED_PATH = os.path.join(METRICS_DIR, 'retired.json')
+LOCK_PATH = os.path.join(METRICS_DIR, '.lock')
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+PROFILE_LINES = 40
+
+HELP = {
+    'marc_requests_total': ('counter', 'Requests handled, by endpoint and status.'),
+    'marc_request_seconds': ('histogram', 'Request duration, including streaming the response.'),
+    'marc_stage_seconds': ('histogram', 'Time per request spent in each conversion stage.'),
+    'marc_bytes_in_total': ('counter', 'Bytes received: request bodies and downloaded MARC files.'),
+    'marc_bytes_out_total': ('counter', 'Response bytes sent.'),
+    'marc_records_total': ('counter', 'MARC records converted.'),
+    'marc_record_errors_total': ('counter', 'Records that could not be read or converted, by error type.'),
+}
+
+
+# --- Process-local totals --- #
+class _Registry:
+    # {name: {labels: value}} for counters and {name: {labels: [buckets..., sum, count]}}
+    # for histograms, where labels is the rendered label text ('stage="parse"').
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.path = os.path.join(METRICS_DIR, f'{self.pid}-{secrets.token_hex(4)}.json')
+        self.counters = {}
+        self.histograms = {}
+
+    def _check_fork(self):
+        # A forked worker starts from a copy of its parent's totals; drop them
+        # so they are not counted twice.
+        if os.getpid() != self.pid:
+            self.reset()
+
+    def inc(self, name, labels='', value=1):
+        with self.lock:
+            self._check_fork()
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            self._check_fork()
+            series = self.histograms.setdefault(name, {})
+            hist = series.get(labels)
+            if hist is None:
+                hist = series[labels] = [0] * (len(SECONDS_BUCKETS) + 2)
+            for idx, bound in enumerate(SECONDS_BUCKETS):
+                if value <= bound:
+                    hist[idx] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def snapshot(self):
+        # A copy: with threaded workers, other requests keep adding series
+        # and observations while the snapshot is serialized.
+        with self.lock:
+            self._check_fork()
+            return {'counters': {name: dict(series) for name, series in self.counters.items()},
+                    'histograms': {name: {key: list(hist) for key, hist in series.items()}
+                                   for name, series in self.histograms.items()}}
+
+    def flush(self):
+        data = json.dumps(self.snapshot())
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+registry = _Registry()
+
+
+def labels(**pairs):
+    return ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(pairs.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# --- Per-request tracking --- #
+class RequestMetrics:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.bytes_in = {}
+        self.bytes_out = 0
+        self.records = 0
+        self.errors = {}
+        self.status = None
+        self.finished = False
+        # Time spent in nested stages, one entry per stage being timed.
+        self._stack = []
+        self._counted_errors = set()
+
+    def add_bytes_in(self, source, n):
+        self.bytes_in[source] = self.bytes_in.get(source, 0) + n
+
+    def record_error(self, exc):
+        if id(exc) in self._counted_errors:
+            return
+        self._counted_errors.add(id(exc))
+        name = type(exc).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def _enter(self):
+        self._stack.append(0.0)
+        return time.perf_counter()
+
+    def _exit(self, stage, start):
+        elapsed = time.perf_counter() - start
+        nested = self._stack.pop()
+        self.stages[stage] = self.stages.get(stage, 0.0) + elapsed - nested
+        if self._stack:
+            self._stack[-1] += elapsed
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        status = str(self.status or 500)
+        registry.inc('marc_requests_total', labels(endpoint=self.endpoint, status=status))
+        registry.observe('marc_request_seconds', labels(endpoint=self.endpoint),
+                         time.perf_counter() - self.started)
+        for name, seconds in self.stages.items():
+            registry.observe('marc_stage_seconds', labels(stage=name), seconds)
+        for source, n in self.bytes_in.items():
+            registry.inc('marc_bytes_in_total', labels(source=source), n)
+        if self.bytes_out:
+            registry.inc('marc_bytes_out_total', labels(endpoint=self.endpoint), self.bytes_out)
+        if self.records:
+            registry.inc('marc_records_total', '', self.records)
+        for name, n in self.errors.items():
+            registry.inc('marc_record_errors_total', labels(error=name), n)
+        registry.flush()
+
+
+def current():
+    # This request's tracker, or None outside a tracked request (e.g. jobs).
+    if not METRICS_ENABLED or not has_request_context():
+        return None
+    return g.get('marc_metrics')
+
+
+def record_error(exc):
+    tracker = current()
+    if tracker is not None:
+        tracker.record_error(exc)
+
+
+def timed(stage, iterable, count=None):
+    # Time a pipeline stage as its items are pulled. count='bytes' adds the
+    # item sizes to the downloaded bytes, count='records' counts items as
+    # converted records. Errors raised by the stage are counted per type.
+    tracker = current()
+    if tracker is None:
+        return iterable
+    return _timed(tracker, stage, iter(iterable), count)
+
+
+def _timed(tracker, stage, iterator, count):
+    while True:
+        start = tracker._enter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            tracker._exit(stage, start)
+            return
+        except Exception as e:
+            tracker._exit(stage, start)
+            if stage in ('parse', 'map'):
+                tracker.record_error(e)
+            raise
+        tracker._exit(stage, start)
+        if count == 'bytes':
+            tracker.add_bytes_in('download', len(item))
+        elif count == 'records':
+            tracker.records += 1
+        yield item
+
+
+@contextmanager
+def stage(name):
+    # Context manager form of timed(), for stages that are one call (e.g.
+    # writing a workbook from a row iterator).
+    tracker = current()
+    if tracker is None:
+        yield
+        return
+    start = tracker._enter()
+    try:
+        yield
+    finally:
+        tracker._exit(name, start)
+
+
+def _count_out(chunks, tracker):
+    for chunk in chunks:
+        tracker.bytes_out += len(chunk)
+        yield chunk
+
+
+def init_app(app):
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def start_request_metrics():
+        if request.endpoint in (None, 'metrics_endpoint', 'static'):
+            return
+        tracker = g.marc_metrics = RequestMetrics(request.endpoint)
+        if request.content_length:
+            tracker.add_bytes_in('request', request.content_length)
+
+    @app.after_request
+    def finish_request_metrics(response):
+        tracker = g.get('marc_metrics')
+        if tracker is None:
+            return response
+        tracker.status = response.status_code
+        if response.is_streamed and not response.direct_passthrough:
+            # The body is produced while it is sent; finish once it is done.
+            response.response = _count_out(response.iter_encoded(), tracker)
+            response.call_on_close(tracker.finish)
+        else:
+            tracker.bytes_out = response.content_length or 0
+            tracker.finish()
+        return response
+
+    @app.teardown_request
+    def abort_request_metrics(exc):
+        # Requests that raised never reach after_request.
+        tracker = g.get('marc_metrics')
+        if tracker is not None and tracker.status is None:
+            tracker.finish()
+
+
+# --- Aggregation across workers --- #
+def _merge(total, data):
+    for name, series in data.get('counters', {}).items():
+        dest = total['counters'].setdefault(name, {})
+        for key, value in series.items():
+            dest[key] = dest.get(key, 0) + value
+    for name, series in data.get('histograms', {}).items():
+        dest = total['histograms'].setdefault(name, {})
+        for key, values in series.items():
+            if key in dest:
+                dest[key] = [a + b for a, b in zip(dest[key], values)]
+            else:
+                dest[key] = list(values)
+
+
+def _read(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _retire_dead_workers():
+    # Fold the files of exited workers into retired.json. Skipped if another
+    # process holds the lock; it is doing the same.
+    with open(LOCK_PATH, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        dead = []
+        for name in os.listdir(METRICS_DIR):
+            pid = name.split('-', 1)[0]
+            if name.endswith('.json') and pid.isdigit() and not _pid_alive(int(pid)):
+                dead.append(os.path.join(METRICS_DIR, name))
+        if not dead:
+            return
+        retired = {'counters': {}, 'histograms': {}}
+        _merge(retired, _read(RETIRED_PATH))
+        for path in dead:
+            _merge(retired, _read(path))
+        fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(retired, fh)
+        os.replace(tmp_path, RETIRED_PATH)
+        for path in dead:
+            os.remove(path)
+
+
+def collect():
+    # Totals of all workers, past and present.
+    registry.flush()
+    total = {'counters': {}, 'histograms': {}}
+    try:
+        _retire_dead_workers()
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return registry.snapshot()
+    for name in names:
+        if name.endswith('.json'):
+            _merge(total, _read(os.path.join(METRICS_DIR, name)))
+    return total
+
+
+def render(data):
+    lines = []
+    for name, (kind, text) in HELP.items():
+        series = data['counters' if kind == 'counter' else 'histograms'].get(name)
+        if not series:
+            continue
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for key in sorted(series):
+            if kind == 'counter':
+                lines.append(f'{name}{{{key}}} {series[key]}' if key else f'{name} {series[key]}')
+                continue
+            values = series[key]
+            prefix = key + ',' if key else ''
+            for bound, n in zip(SECONDS_BUCKETS, values):
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {n}')
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {values[-1]}')
+            lines.append(f'{name}_sum{{{key}}} {round(values[-2], 6)}')
+            lines.append(f'{name}_count{{{key}}} {values[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_response():
+    return Response(render(collect()), mimetype='text/plain; version=0.0.4')
+
+
+# --- ?profile=1 --- #
+def profiled(view):
+    # With DEBUG set, ?profile=1 runs the view (and sends its body nowhere)
+    # under cProfile and returns the top functions by cumulative time.
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not (current_app.config.get('DEBUG') and request.args.get('profile') in ('1', 'true', 'yes')):
+            return view(*args, **kwargs)
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+            size = sum(len(chunk) for chunk in response.iter_encoded())
+            response.close()
+        finally:
+            profiler.disable()
+        elapsed = time.perf_counter() - started
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+        header = (f'{request.method} {request.full_path} -> {response.status_code}, '
+                  f'{size} bytes in {elapsed:.3f}s\n\n')
+        return Response(header + out.getvalue(), mimetype='text/plain')
+    return wrapper
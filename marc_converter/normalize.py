@@ -0,0 +1,66 @@
+# Text normalization for extracted MARC values (clean_unicode)
+#
+# clean_unicode NFC-normalizes a value, strips it, turns runs of CR/LF/TAB
+# into one space and drops non-printable characters. Most values are plain
+# printable ASCII, for which all of that reduces to strip(), so they skip the
+# rest. Other values go through the full path behind a bounded LRU memo, since
+# publisher names and similar values repeat across thousands of records.
+# Each mapping column gets its own memo (column_cleaner) so hit rates can be
+# reported per column.
+import os
+import re
+import unicodedata
+from functools import lru_cache
+
+CLEAN_MEMO_SIZE = int(os.environ.get('MARC_CLEAN_CACHE_SIZE', '4096'))
+
+_LINE_BREAKS = re.compile(r'[\r\n\t]+')
+# Deletes the non-printable ASCII characters (C0 controls and DEL).
+_ASCII_CONTROLS = dict.fromkeys(code for code in range(128) if not chr(code).isprintable())
+
+
+def _clean(text):
+    text = unicodedata.normalize("NFC", text).strip()
+    if '\r' in text or '\n' in text or '\t' in text:
+        text = _LINE_BREAKS.sub(' ', text)
+    if not text.isprintable():
+        text = text.translate(_ASCII_CONTROLS)
+        if not text.isprintable():
+            text = ''.join(ch for ch in text if ch.isprintable())
+    return text
+
+
+def column_cleaner(maxsize=CLEAN_MEMO_SIZE):
+    # A clean_unicode with its own memo; cache_info() reports its hit rate.
+    memo = lru_cache(maxsize=maxsize)(_clean)
+
+    def clean(text):
+        if not text:
+            return ""
+        if text.isascii() and text.isprintable():
+            return text.strip()
+        return memo(text)
+    clean.cache_info = memo.cache_info
+    clean.cache_clear = memo.cache_clear
+    return clean
+
+
+clean_unicode = column_cleaner()
+
+
+def clean_column(values, clean=clean_unicode):
+    # Clean a whole column of values, each distinct value once.
+    cleaned = {}
+    return [cleaned[value] if value in cleaned else cleaned.setdefault(value, clean(value))
+            for value in values]
+
+
+def cache_stats(cleaners):
+    # {name: {'hits', 'misses', 'size', 'hit_rate'}} for named column cleaners.
+    stats = {}
+    for name, clean in cleaners.items():
+        info = clean.cache_info()
+        lookups = info.hits + info.misses
+        stats[name] = {'hits': info.hits, 'misses': info.misses, 'size': info.currsize,
+                       'hit_rate': round(info.hits / lookups, 4) if lookups else 0.0}
+    return stats
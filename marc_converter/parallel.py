@@ -0,0 +1,174 @@
+# Multi-core conversion of a single MARC file
+import os
+import mmap
+import io
+import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from marc_converter.framing import iter_record_frames, parse_record
+
+DEFAULT_BATCH_SIZE = 500
+# Bytes of the input framed at a time when splitting it into batches.
+SCAN_CHUNK_SIZE = 1024 * 1024
+
+# API defaults: parallel conversion is off unless MARC_WORKERS > 1, and then
+# only used for uploads of at least MARC_PARALLEL_MIN_BYTES.
+API_WORKERS = int(os.environ.get('MARC_WORKERS', '1'))
+API_PARALLEL_MIN_BYTES = int(os.environ.get('MARC_PARALLEL_MIN_BYTES', str(20 * 1024 * 1024)))
+
+
+def _convert_batch(blob, offset, record_options, collect_errors, fast):
+    # Runs in a worker process: blob is a run of whole, contiguous records
+    # starting at byte `offset` of the input. Rows come back as compact
+    # tuples, which are also cheaper to pickle; with collect_errors, records
+    # that fail to convert come back as (offset, exception).
+    from marc_converter.mapping import KBART_PLAN
+    from marc_converter.fastpath import extract_values
+    rows = []
+    errors = []
+    for record_offset, raw in iter_record_frames([blob], offset=offset):
+        try:
+            if fast:
+                rows.append(extract_values(raw, **record_options))
+            else:
+                rows.append(KBART_PLAN.values(parse_record(raw, **record_options)))
+        except Exception as e:
+            if not collect_errors:
+                raise
+            errors.append((record_offset, _portable(e)))
+    return rows, errors
+
+
+def _portable(exc):
+    # The exception itself if it survives the trip back to the parent
+    # process, otherwise a RuntimeError with its type and message.
+    try:
+        return pickle.loads(pickle.dumps(exc))
+    except Exception:
+        return RuntimeError(f"{type(exc).__name__}: {exc}")
+
+
+_mapped_files = {}
+
+
+def _convert_file_batch(path, start, end, record_options, collect_errors, fast):
+    # Runs in a worker process: each worker maps the file once and slices
+    # its batch out of the mapping.
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    mm = _mapped_files.get(key)
+    if mm is None:
+        with open(path, 'rb') as fh:
+            mm = _mapped_files[key] = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    return _convert_batch(mm[start:end], start, record_options, collect_errors, fast)
+
+
+def iter_batches(buffer, batch_size=DEFAULT_BATCH_SIZE, on_error=None):
+    # Yield (start, end) byte ranges of up to batch_size contiguous records.
+    # Records are framed as in RecordStream: with on_error, a record whose
+    # leader length or terminator is wrong is reported there and skipped, and
+    # a batch never spans a skipped record.
+    start = end = count = 0
+    for offset, raw in iter_record_frames(_buffer_chunks(buffer), on_error):
+        if count and offset != end:
+            yield start, end
+            count = 0
+        if count == 0:
+            start = offset
+        end = offset + len(raw)
+        count += 1
+        if count == batch_size:
+            yield start, end
+            count = 0
+    if count:
+        yield start, end
+
+
+def _buffer_chunks(buffer, size=SCAN_CHUNK_SIZE):
+    for pos in range(0, len(buffer), size):
+        yield buffer[pos:pos + size]
+
+
+def iter_rows_parallel(buffer, workers=None, batch_size=DEFAULT_BATCH_SIZE,
+                       record_options=None, errors=None, fast=False):
+    # Convert a bytes-like buffer of MARC records on a process pool and yield
+    # rows in the original record order. Only about two batches per worker are
+    # in flight at once, so memory stays bounded for very large inputs.
+    # If `errors` (a logic.RecordErrors) is passed, records that cannot be
+    # framed or converted are reported there with their byte offsets and
+    # skipped; otherwise the first error is raised.
+    on_error = errors.add if errors is not None else None
+    options = (record_options or {}, errors is not None, fast)
+    tasks = ((_convert_batch, (bytes(buffer[start:end]), start) + options)
+             for start, end in iter_batches(buffer, batch_size, on_error))
+    yield from _run_ordered(tasks, workers, errors)
+
+
+def iter_file_rows_parallel(path, workers=None, batch_size=DEFAULT_BATCH_SIZE,
+                            record_options=None, errors=None, fast=False):
+    # Same as iter_rows_parallel for a file on disk: workers map the file
+    # themselves and are only sent byte ranges, so no record data is copied
+    # through the parent process.
+    with open(path, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    with mm:
+        on_error = errors.add if errors is not None else None
+        options = (record_options or {}, errors is not None, fast)
+        tasks = ((_convert_file_batch, (path, start, end) + options)
+                 for start, end in iter_batches(mm, batch_size, on_error))
+        yield from _run_ordered(tasks, workers, errors)
+
+
+def _run_ordered(tasks, workers, errors):
+    workers = workers or os.cpu_count() or 1
+    converted = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for fn, args in tasks:
+            pending.append(executor.submit(fn, *args))
+            if len(pending) >= workers * 2:
+                rows = _drain(pending.popleft(), errors)
+                converted += len(rows)
+                yield from rows
+        while pending:
+            rows = _drain(pending.popleft(), errors)
+            converted += len(rows)
+            yield from rows
+    # As with RecordStream: input with no readable record at all is an error.
+    if errors is not None and not converted and errors.first is not None:
+        raise errors.first
+
+
+def _drain(future, errors):
+    rows, batch_errors = future.result()
+    for offset, exc in batch_errors:
+        errors.add(offset, exc)
+    return rows
+
+
+def open_buffer(fileobj):
+    # Memory-map file-backed inputs (including uploads spooled to disk) and
+    # fall back to reading small in-memory uploads into bytes.
+    try:
+        fileobj.seek(0)
+        return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        fileobj.seek(0)
+        return fileobj.read()
+
+
+def upload_size(fileobj):
+    try:
+        pos = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(pos)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def use_parallel(fileobj):
+    return API_WORKERS > 1 and upload_size(fileobj) >= API_PARALLEL_MIN_BYTES
@@ -0,0 +1,222 @@
+# Streaming readers for MARCXML and MARC-in-JSON input
+#
+# Input is sniffed from its first non-blank bytes: '<' is MARCXML, '{' or '['
+# is MARC-in-JSON (one object per line, concatenated objects, or an array),
+# anything else is binary MARC (ISO 2709, see framing.py). gzip and zip input
+# is recognized by its magic bytes and decompressed first (compression.py). Both readers work
+# on the same byte chunks as iter_record_frames and yield (offset, item)
+# pairs, where offset is how much input had been read when the record was
+# complete (so approximate), and item is turned into a pymarc Record by
+# xml_record or json_record. Only the record being read is held in memory:
+# MARCXML is parsed with iterparse and every <record> element is dropped
+# once it has been converted; JSON is decoded one object at a time.
+import json
+import codecs
+import itertools
+import xml.etree.ElementTree as ET
+from pymarc import Field, Indicators, Leader, Record, Subfield
+
+MARCXML_NS = 'http://www.loc.gov/MARC21/slim'
+INPUT_FORMATS = ('marc', 'marcxml', 'marcjson')
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+# Leading bytes that do not decide the format: UTF-8 BOM and whitespace.
+_BLANK = b'\xef\xbb\xbf \t\r\n'
+# A JSON record still not complete after this many characters is broken.
+MAX_JSON_RECORD_CHARS = 16 * 1024 * 1024
+
+
+def sniff_format(head):
+    # One of INPUT_FORMATS, or 'gzip' / 'zip' for compressed input.
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZIP_MAGIC):
+        return 'zip'
+    text = head.lstrip(_BLANK)
+    if text.startswith(b'<'):
+        return 'marcxml'
+    if text[:1] in (b'{', b'['):
+        return 'marcjson'
+    return 'marc'
+
+
+def sniff_chunks(chunks):
+    # (input format, chunks), with the chunks read to decide put back.
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(ZIP_MAGIC) and head.lstrip(_BLANK):
+            break
+    return sniff_format(head), itertools.chain((head,), chunks) if head else chunks
+
+
+def sniff_file(fileobj):
+    # Input format of a seekable file, which is left where it was.
+    start = fileobj.tell()
+    head = fileobj.read(4096)
+    fileobj.seek(start)
+    return sniff_format(head)
+
+
+class _ChunkReader:
+    # File-like read() over byte chunks, for iterparse.
+    def __init__(self, chunks, offset=0):
+        self.chunks = iter(chunks)
+        self.pending = b''
+        self.consumed = offset
+
+    def read(self, size=-1):
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return b''
+            self.pending = chunk
+        data = self.pending if size < 0 else self.pending[:size]
+        self.pending = self.pending[len(data):]
+        self.consumed += len(data)
+        return data
+
+
+def _is_marc_record(tag):
+    # <record> in the MARCXML namespace or in none (an OAI-PMH <record>
+    # wrapper has its own namespace and is not a MARC record).
+    return tag == 'record' or tag == '{' + MARCXML_NS + '}record'
+
+
+def iter_marcxml_records(chunks, on_error=None, offset=0):
+    # Yields (offset, <record> element). The element is cleared and detached
+    # when the caller asks for the next one, as is everything outside records
+    # (collection, OAI-PMH headers), so memory does not grow with the file.
+    # A document that is not well-formed ends the stream there: with
+    # on_error it is reported as on_error(offset, exc), otherwise raised.
+    source = _ChunkReader(chunks, offset)
+    parents = []
+    open_records = 0
+    try:
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if _is_marc_record(elem.tag):
+                    open_records += 1
+                parents.append(elem)
+                continue
+            parents.pop()
+            if _is_marc_record(elem.tag):
+                open_records -= 1
+                yield source.consumed, elem
+            elif open_records:
+                continue
+            elem.clear()
+            if parents:
+                parents[-1].remove(elem)
+    except ET.ParseError as e:
+        if on_error is None:
+            raise
+        on_error(source.consumed, e)
+
+
+def _local(tag):
+    return tag.rpartition('}')[2]
+
+
+def xml_record(elem):
+    # pymarc Record for a MARCXML <record> element.
+    record = Record()
+    for child in elem:
+        name = _local(child.tag)
+        if name == 'leader':
+            record.leader = Leader(child.text or '')
+        elif name == 'controlfield':
+            record.add_field(Field(tag=child.get('tag'), data=child.text or ''))
+        elif name == 'datafield':
+            subfields = [Subfield(code=sub.get('code', ''), value=sub.text or '')
+                         for sub in child if _local(sub.tag) == 'subfield']
+            record.add_field(Field(tag=child.get('tag'),
+                                   indicators=Indicators(child.get('ind1', ' '), child.get('ind2', ' ')),
+                                   subfields=subfields))
+    return record
+
+
+def iter_marcjson_records(chunks, on_error=None, offset=0):
+    # Yields (offset, object) for MARC-in-JSON: one object per line
+    # (NDJSON), objects one after another, or one array of objects. A syntax
+    # error in a line-per-record file loses that line only; in an array it
+    # ends the stream (reported to on_error, or raised).
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder('utf-8-sig')('replace').decode
+    chunks = iter(chunks)
+    buffer = ''
+    pos = 0
+    consumed = offset
+    in_array = None
+    done = False
+    while not done:
+        chunk = next(chunks, None)
+        if chunk is None:
+            done = True
+            buffer += decode(b'', final=True)
+        else:
+            consumed += len(chunk)
+            buffer += decode(chunk)
+        while True:
+            # Separators between records: whitespace, commas, array brackets.
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if in_array is None:
+                in_array = buffer[pos] == '['
+                if in_array:
+                    pos += 1
+                continue
+            if in_array and buffer[pos] == ']':
+                pos = len(buffer)
+                done = True
+                break
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                # The record may just not be complete yet. JSON strings
+                # cannot hold raw newlines, so a record cut off by the end of
+                # the buffer fails after its last newline: an error with a
+                # newline after it, or at the end of the input, is real.
+                if not done and buffer.find('\n', e.pos) < 0 and len(buffer) - pos < MAX_JSON_RECORD_CHARS:
+                    break
+                if on_error is None:
+                    raise
+                on_error(consumed, e)
+                # Carry on with the line after the one the record started on.
+                next_line = buffer.find('\n', pos)
+                if in_array or next_line < 0:
+                    return
+                pos = next_line + 1
+                continue
+            pos = end
+            yield consumed, obj
+        buffer = buffer[pos:]
+        pos = 0
+
+
+def json_record(obj):
+    # pymarc Record for a MARC-in-JSON object
+    # ({"leader": ..., "fields": [{"001": ...}, {"245": {"ind1", "ind2", "subfields"}}]}).
+    if not isinstance(obj, dict) or 'fields' not in obj:
+        raise ValueError('Not a MARC-in-JSON record')
+    record = Record()
+    record.leader = Leader(obj.get('leader') or ' ' * 24)
+    for field in obj['fields']:
+        (tag, value), = field.items()
+        if isinstance(value, dict):
+            subfields = [Subfield(code=code, value=text)
+                         for sub in value.get('subfields', ()) for code, text in sub.items()]
+            record.add_field(Field(tag=tag, indicators=Indicators(value.get('ind1', ' '), value.get('ind2', ' ')),
+                                   subfields=subfields))
+        else:
+            record.add_field(Field(tag=tag, data=value))
+    return record
+
+
+READERS = {
+    'marcxml': (iter_marcxml_records, xml_record),
+    'marcjson': (iter_marcjson_records, json_record),
+}
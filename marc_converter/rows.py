@@ -0,0 +1,100 @@
+# Compact rows and column-oriented row batches
+#
+# Converted rows travel through the pipeline as tuples in a plan's `fields`
+# order (KBART_PLAN by default) instead of one dict per record. Writers take
+# them in batches of BATCH_SIZE, transposed into one list per column, so
+# per-column work such as JSON string encoding runs once per batch and values
+# of interned columns are encoded once per distinct value.
+from json import dumps
+from json.encoder import encode_basestring, encode_basestring_ascii
+from itertools import islice
+from marc_converter.mapping import KBART_PLAN
+
+BATCH_SIZE = 1000
+
+
+class RowSchema:
+    # Field names of a row tuple and which of them are interned. A
+    # MappingPlan is itself a schema for the rows it produces.
+    __slots__ = ('fields', 'interned')
+
+    def __init__(self, fields, interned=()):
+        self.fields = tuple(fields)
+        self.interned = frozenset(interned)
+
+    def extend(self, names, interned=()):
+        return RowSchema(self.fields + tuple(names), self.interned | frozenset(interned))
+
+
+class RowBatch:
+    __slots__ = ('plan', 'columns', 'length')
+
+    def __init__(self, plan, columns, length):
+        self.plan = plan
+        self.columns = columns
+        self.length = length
+
+    @classmethod
+    def from_rows(cls, rows, plan=KBART_PLAN):
+        rows = list(rows)
+        columns = [list(column) for column in zip(*rows)] if rows else [[] for _ in plan.fields]
+        return cls(plan, columns, len(rows))
+
+    @property
+    def fields(self):
+        return self.plan.fields
+
+    def __len__(self):
+        return self.length
+
+    def column(self, name):
+        return self.columns[self.plan.fields.index(name)]
+
+    def rows(self):
+        return zip(*self.columns)
+
+
+def iter_batches(rows, plan=KBART_PLAN, size=BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield RowBatch.from_rows(chunk, plan)
+
+
+def _json_value(value, ensure_ascii):
+    return dumps(value, ensure_ascii=ensure_ascii, separators=(',', ':'))
+
+
+def _encode_column(column, encode, ensure_ascii, memo):
+    # Every row value is a str in practice; anything else goes through json.dumps.
+    if memo:
+        cache = {}
+        out = []
+        for value in column:
+            encoded = cache.get(value)
+            if encoded is None:
+                try:
+                    encoded = encode(value)
+                except TypeError:
+                    encoded = _json_value(value, ensure_ascii)
+                cache[value] = encoded
+            out.append(encoded)
+        return out
+    try:
+        return list(map(encode, column))
+    except TypeError:
+        return [encode(value) if type(value) is str else _json_value(value, ensure_ascii) for value in column]
+
+
+def json_objects(batch, ensure_ascii=True, sort_keys=False):
+    # One compact JSON object string per row, the same text as
+    # json.dumps(dict(zip(fields, row)), separators=(',', ':'), ...).
+    encode = encode_basestring_ascii if ensure_ascii else encode_basestring
+    fields = batch.fields
+    order = sorted(range(len(fields)), key=fields.__getitem__) if sort_keys else range(len(fields))
+    template = '{' + ','.join(encode(fields[idx]).replace('%', '%%') + ':%s' for idx in order) + '}'
+    interned = batch.plan.interned
+    columns = [_encode_column(batch.columns[idx], encode, ensure_ascii, fields[idx] in interned) for idx in order]
+    return [template % values for values in zip(*columns)]
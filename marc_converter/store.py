@@ -0,0 +1,267 @@
+# Local SQLite inventory store of converted rows
+#
+# Loading a collection writes its rows into a new snapshot table
+# (records_<snapshot id>), in transactions of STORE_BATCH rows, and builds
+# the indexes once the rows are in: title_id, source_id, online_identifier,
+# publisher_name (case-insensitive), and a keys_<snapshot id> table with the
+# normalized ISBN-13s and DOIs of each row (see dedup.row_keys). Only then is
+# the snapshot marked ready, so readers in other gunicorn workers see either
+# the previous snapshot or the complete new one. Lookups go to the latest
+# ready snapshot of each collection; older snapshots beyond MARC_STORE_KEEP
+# are dropped.
+#
+#   python -m marc_converter.store load oapen OAPENSample.mrc
+#   python -m marc_converter.store find --isbn 9780472902842
+#   python -m marc_converter.store export oapen kbart.tsv
+import os
+import time
+import sqlite3
+import tempfile
+import logging
+from itertools import islice
+from marc_converter.dedup import normalize_doi, normalize_isbn, row_keys
+from marc_converter.mapping import KBART_PLAN
+
+logger = logging.getLogger('marc_converter')
+
+STORE_PATH = os.environ.get('MARC_STORE_PATH', os.path.join(tempfile.gettempdir(), 'marc_converter', 'inventory.sqlite'))
+STORE_KEEP = int(os.environ.get('MARC_STORE_KEEP', '2'))
+# Rows per insert transaction.
+STORE_BATCH = 50000
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+FIELDS = KBART_PLAN.fields
+INDEXED = ('title_id', 'source_id', 'online_identifier')
+# Query parameters matched exactly against a column.
+COLUMN_FILTERS = {'title_id': 'title_id', 'source_id': 'source_id', 'publisher': 'publisher_name'}
+
+
+class CollectionNotFound(Exception):
+    pass
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def connect(path=None):
+    path = path or STORE_PATH
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    db = sqlite3.connect(path, timeout=30)
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+               'id INTEGER PRIMARY KEY, collection TEXT NOT NULL, source TEXT, created REAL NOT NULL, '
+               'records INTEGER NOT NULL DEFAULT 0, skipped INTEGER NOT NULL DEFAULT 0, '
+               'ready INTEGER NOT NULL DEFAULT 0)')
+    return db
+
+
+def load_rows(collection, rows, source=None, path=None, skipped=None):
+    # Store row tuples (KBART_PLAN.fields order) as a new snapshot of
+    # `collection`; returns the snapshot's description. skipped, if given,
+    # is called once the rows are consumed for the count of bad records.
+    db = connect(path)
+    try:
+        with db:
+            snapshot = db.execute('INSERT INTO snapshots (collection, source, created) VALUES (?, ?, ?)',
+                                  (collection, source, time.time())).lastrowid
+        table, keys_table = f'records_{snapshot}', f'keys_{snapshot}'
+        columns = ', '.join(_quote(name) + ' TEXT' for name in FIELDS)
+        with db:
+            db.execute(f'CREATE TABLE {table} (id INTEGER PRIMARY KEY, {columns})')
+            db.execute(f'CREATE TABLE {keys_table} (key TEXT NOT NULL, row INTEGER NOT NULL)')
+        insert = (f'INSERT INTO {table} ({", ".join(_quote(name) for name in FIELDS)}) '
+                  f'VALUES ({", ".join("?" * len(FIELDS))})')
+        key_columns = [FIELDS.index(name) for name in ('online_identifier', 'source_id', 'source_id_type')]
+        rows = iter(rows)
+        count = 0
+        try:
+            while True:
+                batch = list(islice(rows, STORE_BATCH))
+                if not batch:
+                    break
+                with db:
+                    db.executemany(insert, batch)
+                    db.executemany(f'INSERT INTO {keys_table} (key, row) VALUES (?, ?)',
+                                   ((key, count + idx + 1) for idx, row in enumerate(batch)
+                                    for key in row_keys(*(row[i] for i in key_columns))))
+                count += len(batch)
+            with db:
+                for name in INDEXED:
+                    db.execute(f'CREATE INDEX {table}_{name} ON {table} ({_quote(name)})')
+                db.execute(f'CREATE INDEX {table}_publisher ON {table} (publisher_name COLLATE NOCASE)')
+                db.execute(f'CREATE INDEX {keys_table}_key ON {keys_table} (key)')
+                db.execute('UPDATE snapshots SET records = ?, skipped = ?, ready = 1 WHERE id = ?',
+                           (count, skipped() if skipped else 0, snapshot))
+        except BaseException:
+            _drop_snapshot(db, snapshot)
+            raise
+        _prune(db, collection)
+        logger.info(f"Stored {count} records as snapshot {snapshot} of collection {collection}")
+        return describe(db, snapshot)
+    finally:
+        db.close()
+
+
+def load_marc(collection, chunks, source=None, path=None):
+    # Convert a stream of MARC bytes (bad records skipped) into a new snapshot.
+    from marc_converter.logic import RecordErrors, RecordStream
+    errors = RecordErrors()
+    return load_rows(collection, RecordStream(chunks, errors), source, path, skipped=lambda: errors.count)
+
+
+def _drop_snapshot(db, snapshot):
+    with db:
+        db.execute(f'DROP TABLE IF EXISTS records_{snapshot}')
+        db.execute(f'DROP TABLE IF EXISTS keys_{snapshot}')
+        db.execute('DELETE FROM snapshots WHERE id = ?', (snapshot,))
+
+
+def _prune(db, collection):
+    old = db.execute('SELECT id FROM snapshots WHERE collection = ? AND ready = 1 ORDER BY id DESC LIMIT -1 OFFSET ?',
+                     (collection, STORE_KEEP)).fetchall()
+    for (snapshot,) in old:
+        _drop_snapshot(db, snapshot)
+
+
+def describe(db, snapshot):
+    row = db.execute('SELECT id, collection, source, created, records, skipped FROM snapshots WHERE id = ?',
+                     (snapshot,)).fetchone()
+    return dict(zip(('snapshot', 'collection', 'source', 'created', 'records', 'skipped'), row))
+
+
+def collections(path=None):
+    # Ready snapshots, latest first within each collection.
+    db = connect(path)
+    try:
+        ids = db.execute('SELECT id FROM snapshots WHERE ready = 1 ORDER BY collection, id DESC').fetchall()
+        return [describe(db, snapshot) for (snapshot,) in ids]
+    finally:
+        db.close()
+
+
+def _latest(db, collection=None):
+    # [(collection, snapshot)] of the latest ready snapshot per collection.
+    query = 'SELECT collection, MAX(id) FROM snapshots WHERE ready = 1'
+    args = ()
+    if collection is not None:
+        query += ' AND collection = ?'
+        args = (collection,)
+    found = db.execute(query + ' GROUP BY collection ORDER BY collection', args).fetchall()
+    if collection is not None and not found:
+        raise CollectionNotFound(collection)
+    return found
+
+
+def find_records(filters, collection=None, offset=0, limit=DEFAULT_LIMIT, path=None):
+    # Records matching all filters (isbn, doi, title_id, source_id, publisher)
+    # in the latest snapshot of one or every collection. Returns a page like
+    # the paginated /api/convert: records, offset, limit and next_offset.
+    offset = max(0, offset)
+    limit = max(1, min(limit, MAX_LIMIT))
+    clauses, args = [], []
+    for name, column in COLUMN_FILTERS.items():
+        value = filters.get(name)
+        if value:
+            collate = ' COLLATE NOCASE' if name == 'publisher' else ''
+            clauses.append(f'{_quote(column)} = ?{collate}')
+            args.append(value)
+    keys = []
+    if filters.get('isbn'):
+        keys.append('isbn:' + (normalize_isbn(filters['isbn'].strip()) or filters['isbn'].strip()))
+    if filters.get('doi'):
+        keys.append('doi:' + (normalize_doi(filters['doi']) or filters['doi'].strip().lower()))
+    db = connect(path)
+    try:
+        parts, params = [], []
+        columns = ', '.join(_quote(name) for name in FIELDS)
+        for name, snapshot in _latest(db, collection):
+            where = list(clauses)
+            where += [f'id IN (SELECT row FROM keys_{snapshot} WHERE key = ?)'] * len(keys)
+            parts.append(f'SELECT ? AS collection, ? AS snapshot, id, {columns} FROM records_{snapshot}'
+                         + (' WHERE ' + ' AND '.join(where) if where else ''))
+            params += [name, snapshot] + args + keys
+        if not parts:
+            return {'records': [], 'offset': offset, 'limit': limit, 'next_offset': None}
+        query = ' UNION ALL '.join(parts) + ' ORDER BY collection, id LIMIT ? OFFSET ?'
+        found = db.execute(query, params + [limit + 1, offset]).fetchall()
+    finally:
+        db.close()
+    records = [dict(zip(FIELDS, row[3:]), collection=row[0], snapshot=row[1]) for row in found[:limit]]
+    return {'records': records, 'offset': offset, 'limit': limit,
+            'next_offset': offset + limit if len(found) > limit else None}
+
+
+def iter_snapshot_rows(collection, path=None):
+    # Row tuples of a collection's latest snapshot, in load order, fetched in
+    # batches; the snapshot is read in one transaction, so a concurrent load
+    # or prune does not cut it short.
+    db = connect(path)
+    try:
+        [(_, snapshot)] = _latest(db, collection)
+        columns = ', '.join(_quote(name) for name in FIELDS)
+        db.execute('BEGIN')
+        cursor = db.execute(f'SELECT {columns} FROM records_{snapshot} ORDER BY id')
+        while True:
+            batch = cursor.fetchmany(STORE_BATCH // 10)
+            if not batch:
+                break
+            yield from batch
+        db.execute('COMMIT')
+    finally:
+        db.close()
+
+
+# CLI: load, query and export the inventory store
+if __name__ == "__main__":
+    import sys
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m marc_converter.store",
+                                     description="Local SQLite inventory of converted MARC collections.")
+    parser.add_argument("--db", help=f"store file (default: {STORE_PATH})")
+    commands = parser.add_subparsers(dest="command", required=True)
+    load = commands.add_parser("load", help="convert a MARC file or URL into a new snapshot")
+    load.add_argument("collection")
+    load.add_argument("source", help="file.mrc or http(s) URL")
+    commands.add_parser("list", help="list stored snapshots")
+    find = commands.add_parser("find", help="look up records")
+    for name in ("isbn", "doi", "title_id", "source_id", "publisher", "collection"):
+        find.add_argument(f"--{name.replace('_', '-')}", dest=name)
+    find.add_argument("--offset", type=int, default=0)
+    find.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+    export = commands.add_parser("export", help="write a collection's latest snapshot as KBART")
+    export.add_argument("collection")
+    export.add_argument("output", help="kbart file (.tsv, .csv or .xlsx)")
+    args = parser.parse_args()
+    try:
+        if args.command == "load":
+            from marc_converter.logic import DOWNLOAD_CHUNK_SIZE, fetch_marc
+            if args.source.startswith("http"):
+                response = fetch_marc(args.source)
+                chunks = response.iter_content(DOWNLOAD_CHUNK_SIZE)
+            else:
+                response = open(args.source, "rb")
+                chunks = iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b"")
+            with response:
+                result = load_marc(args.collection, chunks, args.source, args.db)
+            print(json.dumps(result))
+        elif args.command == "list":
+            print(json.dumps(collections(args.db), indent=2))
+        elif args.command == "find":
+            filters = {name: getattr(args, name) for name in ("isbn", "doi", "title_id", "source_id", "publisher")}
+            print(json.dumps(find_records(filters, args.collection, args.offset, args.limit, args.db),
+                             indent=2, ensure_ascii=False))
+        else:
+            from marc_converter.logic import generate_output_file
+            fmt = os.path.splitext(args.output)[1].lstrip(".").lower()
+            generate_output_file(iter_snapshot_rows(args.collection, args.db),
+                                 fmt if fmt in ("csv", "xlsx") else "tsv", args.output)
+    except CollectionNotFound as e:
+        print(f"Error: no stored snapshot of collection {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
@@ -0,0 +1,127 @@
+# Stored uploads for paginated conversion
+#
+# An uploaded MARC file is written once to MARC_UPLOAD_DIR under a random
+# handle, together with its RecordIndex sidecar. Later page requests open the
+# index (cached per worker process) and convert only the requested records,
+# so any gunicorn worker can serve any page and no page re-reads the whole
+# file. Uploads not accessed for MARC_UPLOAD_TTL seconds are removed; access
+# is recorded on the sidecar, so the MARC file and its index stay unchanged.
+import os
+import re
+import time
+import shutil
+import secrets
+import tempfile
+import threading
+from collections import OrderedDict
+from marc_converter.index import RecordIndex, SIDECAR_SUFFIX
+
+UPLOAD_DIR = os.environ.get('MARC_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'marc_converter', 'uploads'))
+UPLOAD_TTL = int(os.environ.get('MARC_UPLOAD_TTL', '3600'))
+OPEN_INDEX_LIMIT = 8
+
+HANDLE_RE = re.compile(r'^[0-9a-f]{32}$')
+
+_open_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+class UploadNotFound(Exception):
+    pass
+
+
+def upload_path(handle):
+    if not HANDLE_RE.match(handle or ''):
+        raise UploadNotFound(handle)
+    return os.path.join(UPLOAD_DIR, f'{handle}.mrc')
+
+
+def store_upload(fileobj):
+    # Copy the upload into the store and index it; returns (handle, index).
+    expire_uploads()
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    handle = secrets.token_hex(16)
+    path = upload_path(handle)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        shutil.copyfileobj(fileobj, out, 1024 * 1024)
+    os.replace(tmp_path, path)
+    try:
+        index = RecordIndex.build(path)
+        index.save()
+    except Exception:
+        remove_upload(handle)
+        raise
+    _remember(handle, index)
+    return handle, index
+
+
+def open_upload(handle):
+    path = upload_path(handle)
+    with _lock:
+        index = _open_indexes.get(handle)
+        if index is not None:
+            _open_indexes.move_to_end(handle)
+    if index is None:
+        if not os.path.exists(path):
+            raise UploadNotFound(handle)
+        index = RecordIndex.open(path)
+        _remember(handle, index)
+    # Keep the upload alive while it is being paged through. The sidecar is
+    # touched, not the MARC file: the sidecar is only valid for the file's
+    # mtime, and other workers would otherwise have to re-index it.
+    try:
+        os.utime(path + SIDECAR_SUFFIX)
+    except OSError:
+        with _lock:
+            _open_indexes.pop(handle, None)
+        raise UploadNotFound(handle)
+    return index
+
+
+def remove_upload(handle):
+    path = upload_path(handle)
+    with _lock:
+        _open_indexes.pop(handle, None)
+    removed = False
+    for p in (path, path + SIDECAR_SUFFIX):
+        try:
+            os.remove(p)
+            removed = True
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def expire_uploads(now=None):
+    now = now or time.time()
+    try:
+        names = os.listdir(UPLOAD_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        handle, ext = os.path.splitext(name)
+        if ext != '.mrc' or not HANDLE_RE.match(handle):
+            continue
+        try:
+            if now - last_access(os.path.join(UPLOAD_DIR, name)) > UPLOAD_TTL:
+                remove_upload(handle)
+        except OSError:
+            pass
+
+
+def last_access(path):
+    # When the upload was stored or last paged through (the sidecar's mtime).
+    try:
+        return os.path.getmtime(path + SIDECAR_SUFFIX)
+    except OSError:
+        return os.path.getmtime(path)
+
+
+def _remember(handle, index):
+    with _lock:
+        _open_indexes[handle] = index
+        _open_indexes.move_to_end(handle)
+        # Evicted indexes are unmapped once the last page using them is done.
+        while len(_open_indexes) > OPEN_INDEX_LIMIT:
+            _open_indexes.popitem(last=False)
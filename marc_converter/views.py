@@ -3,6 +3,7 @@
 from flask import render_template_string, request, send_file
 from marc_converter.app import app
 from marc_converter.logic import process_marc_url
+from marc_converter.batch import process_marc_urls, parse_url_list
 
 HTML_FORM = """
 <!DOCTYPE html>
@@ -22,5 +23,9 @@ def index():
     if request.method == 'POST':
         marc_url = request.form['marc_url']
         fmt = request.form['format']
-        return process_marc_url(marc_url, fmt)
+        # Several URLs (one per line) are merged into one file.
+        urls = parse_url_list(marc_url)
+        if len(urls) > 1:
+            return process_marc_urls(urls, fmt)
+        return process_marc_url(marc_url.strip(), fmt)
     return render_template_string(HTML_FORM)
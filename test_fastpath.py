@@ -0,0 +1,33 @@
+from pymarc import MARCReader
+from marc_converter.framing import iter_raw_records
+from marc_converter.fastpath import extract_row
+from marc_converter.logic import marc_to_row
+
+# Parity check: the fast-path extractor must produce exactly the rows that
+# MARCReader + marc_to_row produce.
+if __name__ == "__main__":
+    import sys
+    marc_paths = sys.argv[1:] or ["sample.mrc", "OAPENSample.mrc"]
+    mismatches = []
+    for marc_path in marc_paths:
+        try:
+            with open(marc_path, "rb") as fh:
+                data = fh.read()
+            expected = [marc_to_row(rec) for rec in MARCReader(data)]
+            actual = [extract_row(raw) for raw in iter_raw_records([data])]
+        except Exception as e:
+            print(f"Fatal error in {marc_path}: {e}")
+            sys.exit(1)
+        if len(expected) != len(actual):
+            mismatches.append(f"{marc_path}: {len(expected)} records via pymarc, {len(actual)} via fast path")
+        for idx, (exp, act) in enumerate(zip(expected, actual)):
+            for key in exp:
+                if exp[key] != act.get(key):
+                    mismatches.append(f"{marc_path} record {idx+1} {key}: {exp[key]!r} != {act.get(key)!r}")
+        print(f"{marc_path}: {len(actual)} records checked")
+    if mismatches:
+        print("\nMismatches:")
+        for mismatch in mismatches:
+            print(mismatch)
+        sys.exit(1)
+    print("All rows match.")
@@ -0,0 +1,56 @@
+import os
+import sys
+from pymarc.exceptions import TruncatedRecord
+from marc_converter.framing import iter_raw_records, iter_record_frames
+from marc_converter.parallel import iter_batches
+
+# Resynchronizing framer: a record whose leader length is corrupt is skipped
+# on its own, also near the end of the input, where the bad length points
+# past the last byte. Corrupts the length of one record of sample.mrc (or the
+# file given) in a few positions and checks that every other record is still
+# framed, by iter_record_frames and by the multi-process batch splitter.
+CORRUPT_LENGTH = b"99999"
+
+
+def frames(data, chunk_size):
+    errors = []
+    chunks = (data[pos:pos + chunk_size] for pos in range(0, len(data), chunk_size))
+    records = [offset for offset, _ in iter_record_frames(chunks, lambda offset, e: errors.append((offset, e)))]
+    return records, errors
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.mrc")
+    with open(path, "rb") as fh:
+        data = fh.read()
+    offsets, pos = [], 0
+    for raw in iter_raw_records([data]):
+        offsets.append(pos)
+        pos += len(raw)
+    failures = []
+    for idx in sorted({len(offsets) - 39, len(offsets) - 2, len(offsets) - 1, len(offsets) // 2}):
+        bad = offsets[idx]
+        corrupt = data[:bad] + CORRUPT_LENGTH + data[bad + 5:]
+        expected = offsets[:idx] + offsets[idx + 1:]
+        for chunk_size in (len(corrupt), 64 * 1024, 1000):
+            records, errors = frames(corrupt, chunk_size)
+            if records != expected or [offset for offset, _ in errors] != [bad]:
+                failures.append(f"record {idx + 1}, {chunk_size}-byte chunks: {len(records)} records framed "
+                                f"(expected {len(expected)}), errors at {[offset for offset, _ in errors]}")
+        batched = []
+        for start, end in iter_batches(corrupt, 100, lambda offset, e: None):
+            batched.extend(offset + start for offset, _ in iter_record_frames([corrupt[start:end]]))
+        if batched != expected:
+            failures.append(f"record {idx + 1}: batches cover {len(batched)} records (expected {len(expected)})")
+        print(f"record {idx + 1} of {len(offsets)} corrupted: checked")
+    try:
+        list(iter_record_frames([data[:-10]]))
+        failures.append("strict framing accepted a truncated last record")
+    except TruncatedRecord:
+        pass
+    if failures:
+        print("\nFailures:")
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print("Only the corrupt record is skipped.")
@@ -0,0 +1,66 @@
+import os
+import sys
+import subprocess
+
+# Import-time budget for worker start: every gunicorn worker imports
+# marc_converter.app, so a heavy module pulled in at import time slows every
+# cold start. Runs `python -X importtime -c "import marc_converter.app"` a few
+# times in fresh interpreters and checks that
+#   - the modules that load on first use (LAZY_MODULES) are not imported, and
+#   - the best import time is within the budget.
+# With --preload it checks the opposite for MARC_PRELOAD=1: the lazy modules
+# are imported up front, in the master.
+LAZY_MODULES = ("requests", "openpyxl")
+DEFAULT_BUDGET_MS = 250
+
+
+def import_times(preload=False):
+    # {module: (self_us, cumulative_us)} for one fresh import of the app.
+    env = dict(os.environ, MARC_PRELOAD="1" if preload else "", LOG_LEVEL="WARNING")
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import marc_converter.app"],
+                          cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed")
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Check the import-time budget of marc_converter.app.")
+    parser.add_argument("--budget-ms", type=float,
+                        default=float(os.environ.get("MARC_IMPORT_BUDGET_MS", DEFAULT_BUDGET_MS)))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--preload", action="store_true", help="check MARC_PRELOAD=1 instead")
+    args = parser.parse_args()
+    try:
+        runs = [import_times(args.preload) for _ in range(args.runs)]
+    except Exception as e:
+        print(f"Fatal error: {e}")
+        sys.exit(1)
+    failures = []
+    imported = [name for name in LAZY_MODULES if name in runs[0]]
+    if args.preload:
+        failures += [f"{name} is not preloaded" for name in LAZY_MODULES if name not in imported]
+    else:
+        failures += [f"{name} is imported at startup ({runs[0][name][1] / 1000:.1f} ms)" for name in imported]
+    best = min(runs, key=lambda times: times["marc_converter.app"][1])
+    total_ms = best["marc_converter.app"][1] / 1000
+    print(f"import marc_converter.app: best {total_ms:.1f} ms of {args.runs} runs (budget {args.budget_ms:g} ms)")
+    if not args.preload and total_ms > args.budget_ms:
+        failures.append(f"import time {total_ms:.1f} ms is over the {args.budget_ms:g} ms budget")
+        print("Slowest imports (cumulative):")
+        for name, (_, cumulative_us) in sorted(best.items(), key=lambda item: -item[1][1])[:15]:
+            print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+    if failures:
+        print("\nFailures:")
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print("Import-time budget OK.")
@@ -0,0 +1,38 @@
+import os
+import re
+import sys
+import tempfile
+
+# Stage split of the conversion metrics: on the pymarc path, decoding a
+# record (parse_record) is reported as the `parse` stage and marc_to_row as
+# `map`, so parse must not be near zero. Converts sample.mrc (or the file
+# given) through /api/convert and reads the stage totals from /metrics.
+MIN_PARSE_SHARE = 0.2
+
+os.environ["MARC_METRICS_DIR"] = tempfile.mkdtemp(prefix="marc-metrics-")
+os.environ["MARC_CACHE_MAX_BYTES"] = "0"
+os.environ["MARC_FASTPATH"] = "0"
+
+
+def stage_seconds(text):
+    # {stage: seconds} from the marc_stage_seconds histogram sums.
+    return {stage: float(value) for stage, value in
+            re.findall(r'^marc_stage_seconds_sum\{[^}]*stage="(\w+)"[^}]*\} (\S+)$', text, re.M)}
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.mrc")
+    from marc_converter.app import app
+    client = app.test_client()
+    with open(path, "rb") as fh:
+        r = client.post("/api/convert?format=json", data={"file": (fh, os.path.basename(path))})
+    if r.status_code != 200:
+        print(f"Fatal error: /api/convert answered {r.status_code}")
+        sys.exit(1)
+    stages = stage_seconds(client.get("/metrics").get_data(as_text=True))
+    parse, map_ = stages.get("parse", 0.0), stages.get("map", 0.0)
+    print(f"parse {parse:.3f}s, map {map_:.3f}s")
+    if not parse + map_ or parse / (parse + map_) < MIN_PARSE_SHARE:
+        print(f"parse is under {MIN_PARSE_SHARE:.0%} of parse + map: pymarc decoding is not timed as parse")
+        sys.exit(1)
+    print("Stage split OK.")